@@ -3,19 +3,17 @@
 import os
 import signal
 import sys
+import time
+from collections import deque
 
-from PyQt5.QtCore import QCoreApplication, QObject, QTimer, pyqtSignal
-from PyQt5.QtXml import QDomDocument
+from PyQt5.QtCore import (QCoreApplication, QObject, QTimer, pyqtSignal,
+                          QByteArray, QXmlStreamReader, QXmlStreamWriter)
 
 #from shared import *
 import jacklib
 import nsm_client
 import ray
 
-connection_list = []
-saved_connections = []
-port_list = []
-
 PORT_MODE_OUTPUT = 0
 PORT_MODE_INPUT = 1
 PORT_MODE_NULL = 2
@@ -24,24 +22,207 @@ PORT_TYPE_AUDIO = 0
 PORT_TYPE_MIDI = 1
 PORT_TYPE_NULL = 2
 
+COMPACT_HEADER = 'RAY-JACKPATCH-COMPACT 1'
+
+EVENT_PORT_ADDED = 0
+EVENT_PORT_REMOVED = 1
+EVENT_PORT_RENAMED = 2
+EVENT_CONNECTION_ADDED = 3
+EVENT_CONNECTION_REMOVED = 4
+
 file_path = ""
+# save in compact format instead of xml
+use_compact = False
+# write reconnections infos
+debug = False
 
 is_dirty = False
 
-pending_connection = False
+# JACK callbacks append events here from the JACK thread,
+# they are applied by batch in the main thread by processEvents.
+# deque append and popleft are atomic, no lock is needed.
+event_queue = deque()
+events_scheduled = False
 
 def signalHandler(sig, frame):
     if sig in (signal.SIGINT, signal.SIGTERM):
         app.quit()
 
 class JackPort:
-    #is_new is used to prevent reconnections
-    # when a disconnection has not been saved and one new port append.
     id = 0
     name = ''
     mode = PORT_MODE_NULL
     type = PORT_TYPE_NULL
-    is_new = False
+
+class PatchGraph:
+    # ports are keyed by (name, mode),
+    # connections are (output_name, input_name) tuples.
+    def __init__(self):
+        self.ports = {}
+        # keys of ports added or renamed since last makeMayConnections.
+        # used to prevent reconnections
+        # when a disconnection has not been saved and one new port append.
+        self.new_ports = set()
+        self.connections = set()
+        self.saved_connections = set()
+        # adjacency of saved connections,
+        # output name -> input names and input name -> output names
+        self.saved_outputs = {}
+        self.saved_inputs = {}
+
+        # diff between saved and live graphs, kept up to date
+        # by all changes, graph is dirty if one of them is not 0.
+        # unsaved: connected but not saved.
+        # missing: saved, not connected, but its two ports exist.
+        self.n_unsaved = 0
+        self.n_missing = 0
+
+    def isDirty(self):
+        return bool(self.n_unsaved or self.n_missing)
+
+    def portExists(self, name, mode):
+        return (name, mode) in self.ports
+
+    def getSavedConnectionsOf(self, name, mode):
+        if mode == PORT_MODE_OUTPUT:
+            return [(name, port_in)
+                    for port_in in self.saved_outputs.get(name, ())]
+        if mode == PORT_MODE_INPUT:
+            return [(port_out, name)
+                    for port_out in self.saved_inputs.get(name, ())]
+        return []
+
+    def countConnection(self, connection, count):
+        # count is 1 to add connection to the diff, -1 to remove it
+        if connection in self.connections:
+            if not connection in self.saved_connections:
+                self.n_unsaved += count
+
+        elif (connection in self.saved_connections
+                and self.portExists(connection[0], PORT_MODE_OUTPUT)
+                and self.portExists(connection[1], PORT_MODE_INPUT)):
+            self.n_missing += count
+
+    def countConnections(self, connections, count):
+        for connection in connections:
+            self.countConnection(connection, count)
+
+    def addPort(self, port):
+        connections = self.getSavedConnectionsOf(port.name, port.mode)
+        self.countConnections(connections, -1)
+        self.ports[(port.name, port.mode)] = port
+        self.new_ports.add((port.name, port.mode))
+        self.countConnections(connections, 1)
+
+    def removePort(self, name, mode, port_type):
+        port = self.ports.get((name, mode))
+        if port is None or port.type != port_type:
+            return
+
+        connections = self.getSavedConnectionsOf(name, mode)
+        self.countConnections(connections, -1)
+        del self.ports[(name, mode)]
+        self.new_ports.discard((name, mode))
+        self.countConnections(connections, 1)
+
+    def renamePort(self, old_name, new_name, mode, port_type):
+        port = self.ports.get((old_name, mode))
+        if port is None or port.type != port_type:
+            return False
+
+        connections = self.getSavedConnectionsOf(old_name, mode)
+        self.countConnections(connections, -1)
+        del self.ports[(old_name, mode)]
+        self.new_ports.discard((old_name, mode))
+        self.countConnections(connections, 1)
+
+        port.name = new_name
+        self.addPort(port)
+        return True
+
+    def addConnection(self, connection):
+        if connection in self.connections:
+            return
+
+        self.countConnection(connection, -1)
+        self.connections.add(connection)
+        self.countConnection(connection, 1)
+
+    def removeConnection(self, connection):
+        if not connection in self.connections:
+            return
+
+        self.countConnection(connection, -1)
+        self.connections.discard(connection)
+        self.countConnection(connection, 1)
+
+    def addSavedConnection(self, connection):
+        if connection in self.saved_connections:
+            return
+
+        self.countConnection(connection, -1)
+        self.saved_connections.add(connection)
+        port_out, port_in = connection
+        self.saved_outputs.setdefault(port_out, set()).add(port_in)
+        self.saved_inputs.setdefault(port_in, set()).add(port_out)
+        self.countConnection(connection, 1)
+
+    def removeSavedConnection(self, connection):
+        if not connection in self.saved_connections:
+            return
+
+        self.countConnection(connection, -1)
+        self.saved_connections.discard(connection)
+        port_out, port_in = connection
+
+        port_ins = self.saved_outputs.get(port_out)
+        if port_ins is not None:
+            port_ins.discard(port_in)
+            if not port_ins:
+                del self.saved_outputs[port_out]
+
+        port_outs = self.saved_inputs.get(port_in)
+        if port_outs is not None:
+            port_outs.discard(port_out)
+            if not port_outs:
+                del self.saved_inputs[port_in]
+
+        self.countConnection(connection, 1)
+
+    def clearSavedConnections(self):
+        self.saved_connections.clear()
+        self.saved_outputs.clear()
+        self.saved_inputs.clear()
+        self.n_unsaved = len(self.connections)
+        self.n_missing = 0
+
+    def getMissingConnections(self, port_keys):
+        # returns saved connections of these ports
+        # which are not connected and could be.
+        missing_connections = []
+
+        for name, mode in port_keys:
+            if mode == PORT_MODE_OUTPUT:
+                for port_in in self.saved_outputs.get(name, ()):
+                    connection = (name, port_in)
+                    if (not connection in self.connections
+                            and self.portExists(port_in, PORT_MODE_INPUT)):
+                        missing_connections.append(connection)
+
+            elif mode == PORT_MODE_INPUT:
+                for port_out in self.saved_inputs.get(name, ()):
+                    connection = (port_out, name)
+                    if (not connection in self.connections
+                            and self.portExists(port_out, PORT_MODE_OUTPUT)
+                            and not (port_out, PORT_MODE_OUTPUT)
+                                in port_keys):
+                        # connection is already in list
+                        # if output port is in port_keys
+                        missing_connections.append(connection)
+
+        return missing_connections
+
+graph = PatchGraph()
 
 class ConnectTimer(QObject):
     def __init__(self):
@@ -53,70 +234,34 @@ class ConnectTimer(QObject):
     def start(self):
         self.timer.start()
 
-def portExists(name, mode):
-    for port in port_list:
-        if port.name == name and port.mode == mode:
-            return True
-    return False
-
 def setDirtyClean():
     global is_dirty
     is_dirty = False
     NSMServer.sendDirtyState(False)
 
-def timerDirtyFinish():
+def checkDirty():
     global is_dirty
 
-    if is_dirty:
+    if graph.isDirty() == is_dirty:
         return
 
-    if isDirtyNow():
-        is_dirty = True
-        NSMServer.sendDirtyState(True)
-
-def isDirtyNow():
-    for connection in connection_list:
-        if not connection in saved_connections:
-            return True
-
-    output_ports = []
-    input_ports = []
-
-    for port in port_list:
-        if port.mode == PORT_MODE_OUTPUT:
-            output_ports.append(port.name)
-        elif port.mode == PORT_MODE_INPUT:
-            input_ports.append(port.name)
-
-    for connection in saved_connections:
-        if connection in connection_list:
-            continue
-
-        if connection[0] in output_ports and connection[1] in input_ports:
-            return True
-
-    return False
-
-class DirtyChecker(QObject):
-    timer = QTimer()
-
-    def __init__(self):
-        self.timer.setInterval(500)
-        self.timer.setSingleShot(True)
-        self.timer.timeout.connect(timerDirtyFinish)
-
-    def start(self):
-        self.timer.start()
+    is_dirty = not is_dirty
+    NSMServer.sendDirtyState(is_dirty)
 
 def readyToConnect():
     pass
 
 class Signaler(nsm_client.NSMSignaler):
-    port_added = pyqtSignal(str, int, int)
-    port_removed = pyqtSignal(str, int, int)
-    port_renamed = pyqtSignal(str, str, int, int)
-    connection_added = pyqtSignal(str, str)
-    connection_removed = pyqtSignal(str, str)
+    events_queued = pyqtSignal()
+
+def queueEvent(*event):
+    # executed in the JACK thread
+    global events_scheduled
+    event_queue.append(event)
+
+    if not events_scheduled:
+        events_scheduled = True
+        signaler.events_queued.emit()
 
 def JackShutdownCallback(arg=None):
     app.quit()
@@ -143,9 +288,9 @@ def JackPortRegistrationCallback(portId, registerYesNo, arg=None):
         port_type = PORT_TYPE_MIDI
 
     if registerYesNo:
-        signaler.port_added.emit(port_name, port_mode, port_type)
+        queueEvent(EVENT_PORT_ADDED, port_name, port_mode, port_type)
     else:
-        signaler.port_removed.emit(port_name, port_mode, port_type)
+        queueEvent(EVENT_PORT_REMOVED, port_name, port_mode, port_type)
 
     return 0
 
@@ -168,10 +313,8 @@ def JackPortRenameCallback(portId, oldName, newName, arg=None):
     elif portTypeStr == jacklib.JACK_DEFAULT_MIDI_TYPE:
         port_type = PORT_TYPE_MIDI
 
-    signaler.port_renamed.emit(str(oldName, encoding='utf-8'),
-                               str(newName, encoding='utf-8'),
-                               port_mode,
-                               port_type)
+    queueEvent(EVENT_PORT_RENAMED, str(oldName, encoding='utf-8'),
+               str(newName, encoding='utf-8'), port_mode, port_type)
 
     return 0
 
@@ -184,62 +327,65 @@ def JackPortConnectCallback(port_id_A, port_id_B, connect_yesno, arg=None):
     port_str_B = str(jacklib.port_name(port_ptr_B), encoding="utf-8")
 
     if connect_yesno:
-        signaler.connection_added.emit(port_str_A, port_str_B)
+        queueEvent(EVENT_CONNECTION_ADDED, port_str_A, port_str_B)
     else:
-        signaler.connection_removed.emit(port_str_A, port_str_B)
+        queueEvent(EVENT_CONNECTION_REMOVED, port_str_A, port_str_B)
 
     return 0
 
+# event functions return (needs_connect, needs_dirty_check)
+
 def portAdded(port_name, port_mode, port_type):
     port = JackPort()
     port.name = port_name
     port.mode = port_mode
     port.type = port_type
-    port.is_new = True
 
-    port_list.append(port)
-
-    connect_timer.start()
+    graph.addPort(port)
+    return (True, False)
 
 def portRemoved(port_name, port_mode, port_type):
-    for i in range(len(port_list)):
-        port = port_list[i]
-        if (port.name == port_name
-                and port.mode == port_mode
-                and port.type == port_type):
-            break
-    else:
-        return
-
-    port_list.__delitem__(i)
+    graph.removePort(port_name, port_mode, port_type)
+    return (False, True)
 
 def portRenamed(old_name, new_name, port_mode, port_type):
-    for port in port_list:
-        if (port.name == old_name
-                and port.mode == port_mode
-                and port.type == port_type):
-            port.name = new_name
-            port.is_new = True
-            connect_timer.start()
-            break
+    return (graph.renamePort(old_name, new_name, port_mode, port_type),
+            True)
 
 def connectionAdded(port_str_A, port_str_B):
-    connection_list.append((port_str_A, port_str_B))
-
-    if pending_connection:
-        makeMayConnections()
-
-    if (port_str_A, port_str_B) not in saved_connections:
-        dirty_checker.start()
+    graph.addConnection((port_str_A, port_str_B))
+    return (False, True)
 
 def connectionRemoved(port_str_A, port_str_B):
-    for i in range(len(connection_list)):
-        if (connection_list[i][0] == port_str_A
-                and connection_list[i][1] == port_str_B):
-            connection_list.__delitem__(i)
-            break
-
-    dirty_checker.start()
+    graph.removeConnection((port_str_A, port_str_B))
+    return (False, True)
+
+event_functions = {EVENT_PORT_ADDED: portAdded,
+                   EVENT_PORT_REMOVED: portRemoved,
+                   EVENT_PORT_RENAMED: portRenamed,
+                   EVENT_CONNECTION_ADDED: connectionAdded,
+                   EVENT_CONNECTION_REMOVED: connectionRemoved}
+
+def processEvents():
+    # apply all queued events,
+    # connect timer is started once for the whole batch.
+    global events_scheduled
+    events_scheduled = False
+
+    needs_connect = False
+    needs_dirty_check = False
+
+    while event_queue:
+        event = event_queue.popleft()
+        connect, dirty_check = event_functions[event[0]](*event[1:])
+        needs_connect = needs_connect or connect
+        needs_dirty_check = needs_dirty_check or dirty_check
+
+    if needs_connect:
+        # dirty state will be checked once new ports are connected
+        connect_timer.start()
+    elif needs_dirty_check:
+        checkDirty()
 
 def makeAllSavedConnections(port):
     if port.mode == PORT_MODE_OUTPUT:
@@ -251,74 +397,46 @@ def connectAllInputs(port):
     if port.mode != PORT_MODE_OUTPUT:
         return
 
-    input_ports = []
-
-    for jack_port in port_list:
-        if jack_port.mode == PORT_MODE_INPUT:
-            input_ports.append(jack_port.name)
-
-    for connection in saved_connections:
-        if connection in connection_list:
-            continue
-
-        if connection[0] == port.name and connection[1] in input_ports:
-            jacklib.connect(jack_client, port.name, connection[1])
+    makeConnections(graph.getMissingConnections(((port.name, port.mode),)))
 
 def connectAllOutputs(port):
     if port.mode != PORT_MODE_INPUT:
         return
 
-    output_ports = []
+    makeConnections(graph.getMissingConnections(((port.name, port.mode),)))
 
-    for jack_port in port_list:
-        if jack_port.mode == PORT_MODE_OUTPUT:
-            output_ports.append(jack_port.name)
+def makeConnections(connections):
+    # connect all connections in one pass,
+    # returns the number of successful connections.
+    n_connected = 0
 
-    for connection in saved_connections:
-        if connection in connection_list:
+    for port_out, port_in in connections:
+        if jacklib.connect(jack_client, port_out, port_in):
             continue
 
-        if connection[0] in output_ports and connection[1] == port.name:
-            jacklib.connect(jack_client, connection[0], port.name)
+        # connection added event will come later,
+        # add it now to not connect it twice.
+        graph.addConnection((port_out, port_in))
+        n_connected += 1
+
+    return n_connected
 
 def makeMayConnections():
-    output_ports = []
-    input_ports = []
-    new_output_ports = []
-    new_input_ports = []
-
-    for port in port_list:
-        if port.mode == PORT_MODE_OUTPUT:
-            output_ports.append(port.name)
-            if port.is_new:
-                new_output_ports.append(port.name)
-
-        elif port.mode == PORT_MODE_INPUT:
-            input_ports.append(port.name)
-            if port.is_new:
-                new_input_ports.append(port.name)
-
-    global pending_connection
-    one_connected = False
-
-    for connection in saved_connections:
-        if (not connection in connection_list
-                and connection[0] in output_ports
-                and connection[1] in input_ports
-                and (connection[0] in new_output_ports
-                     or connection[1] in new_input_ports)):
-
-            if one_connected:
-                pending_connection = True
-                break
-
-            jacklib.connect(jack_client, connection[0], connection[1])
-            one_connected = True
-    else:
-        pending_connection = False
+    connections = graph.getMissingConnections(graph.new_ports)
+    graph.new_ports.clear()
 
-        for port in port_list:
-            port.is_new = False
+    if not connections:
+        checkDirty()
+        return
+
+    start_time = time.monotonic()
+    n_connected = makeConnections(connections)
+
+    if debug:
+        sys.stderr.write('%i/%i connections restored in %.1f ms\n'
+                         % (n_connected, len(connections),
+                            (time.monotonic() - start_time) * 1000))
+    checkDirty()
 
 def c_char_p_p_to_list(c_char_p_p):
     i = 0
@@ -339,95 +457,182 @@ def c_char_p_p_to_list(c_char_p_p):
     return retList
 
 
+def readXmlFile(path):
+    # returns saved connections, None if path is not a jackpatch file.
+    # raises OSError if file can't be read.
+    file = open(path, 'rb')
+    reader = QXmlStreamReader(file.read())
+    file.close()
+
+    connections = []
+    is_jackpatch = False
+
+    while not reader.atEnd():
+        reader.readNext()
+        if not reader.isStartElement():
+            continue
+
+        if not is_jackpatch:
+            if reader.name() != 'RAY-JACKPATCH':
+                return None
+            is_jackpatch = True
+
+        elif reader.name() == 'connection':
+            attributes = reader.attributes()
+            connections.append((attributes.value('from'),
+                                attributes.value('to')))
+
+    if reader.hasError() or not is_jackpatch:
+        return None
+
+    return connections
+
+def readCompactFile(path):
+    # compact file is a header line, then one 'p port_name' line per port,
+    # then one 'c output_index input_index' line per connection.
+    file = open(path, 'r')
+
+    if file.readline().rstrip('\n') != COMPACT_HEADER:
+        file.close()
+        return None
+
+    connections = []
+    port_names = []
+
+    for line in file:
+        line = line.rstrip('\n')
+
+        if line.startswith('p '):
+            port_names.append(line[2:])
+
+        elif line.startswith('c '):
+            try:
+                i_out, i_in = [int(i) for i in line[2:].split()]
+                connections.append((port_names[i_out], port_names[i_in]))
+            except (ValueError, IndexError):
+                continue
+
+    file.close()
+    return connections
+
+def writeXmlFile(path, connections):
+    data = QByteArray()
+    writer = QXmlStreamWriter(data)
+    writer.setAutoFormatting(True)
+    writer.writeStartElement('RAY-JACKPATCH')
+
+    for port_out, port_in in connections:
+        writer.writeEmptyElement('connection')
+        writer.writeAttribute('from', port_out)
+        writer.writeAttribute('to', port_in)
+
+    writer.writeEndElement()
+
+    file = open(path, 'wb')
+    file.write(bytes(data))
+    file.close()
+
+def writeCompactFile(path, connections):
+    port_indexes = {}
+    port_lines = []
+    connection_lines = []
+
+    for port_out, port_in in connections:
+        for port_name in (port_out, port_in):
+            if not port_name in port_indexes:
+                port_indexes[port_name] = len(port_indexes)
+                port_lines.append('p %s\n' % port_name)
+
+        connection_lines.append('c %i %i\n' % (port_indexes[port_out],
+                                               port_indexes[port_in]))
+
+    file = open(path, 'w')
+    file.write(''.join([COMPACT_HEADER + '\n'] + port_lines
+                       + connection_lines))
+    file.close()
+
+def getReadPath(project_path):
+    # read the most recent file of both formats,
+    # so nothing is lost if compact option has been changed.
+    read_path = ''
+    read_mtime = 0
+
+    for extension in ('xml', 'jackpatch'):
+        path = "%s.%s" % (project_path, extension)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+
+        if not read_path or mtime > read_mtime:
+            read_path = path
+            read_mtime = mtime
+
+    return read_path
+
 def openFile(project_path, session_name, full_client_id):
-    saved_connections.clear()
+    graph.clearSavedConnections()
 
     global file_path
-    file_path = "%s.xml" % project_path
+    if use_compact:
+        file_path = "%s.jackpatch" % project_path
+    else:
+        file_path = "%s.xml" % project_path
+
+    read_path = getReadPath(project_path)
 
-    if os.path.isfile(file_path):
+    if read_path:
         try:
-            file = open(file_path, 'r')
+            if read_path.endswith('.jackpatch'):
+                connections = readCompactFile(read_path)
+            else:
+                connections = readXmlFile(read_path)
         except:
-            sys.stderr.write('unable to read file %s\n' % file_path)
+            sys.stderr.write('unable to read file %s\n' % read_path)
             app.quit()
             return
 
-        xml = QDomDocument()
-        xml.setContent(file.read())
-
-        content = xml.documentElement()
-
-        if content.tagName() != "RAY-JACKPATCH":
-            file.close()
+        if connections is None:
             NSMServer.openReply()
             return
 
-        cte = content.toElement()
-        node = cte.firstChild()
-
-        while not node.isNull():
-            el = node.toElement()
-            if el.tagName() != "connection":
-                continue
-
-            port_from = el.attribute('from')
-            port_to = el.attribute('to')
-
-            saved_connections.append((port_from, port_to))
-
-            node = node.nextSibling()
+        for connection in connections:
+            graph.addSavedConnection(connection)
 
         makeMayConnections()
 
     NSMServer.openReply()
     setDirtyClean()
-    dirty_checker.start()
+    checkDirty()
 
 
 def saveFile():
     if not file_path:
         return
 
-    for connection in connection_list:
-        if not connection in saved_connections:
-            saved_connections.append(connection)
-
-    delete_list = []
+    for connection in graph.connections - graph.saved_connections:
+        graph.addSavedConnection(connection)
 
     # delete connection of the saved_connections
     # if its two ports are still presents and not connected
-    for i in range(len(saved_connections)):
-        if (portExists(saved_connections[i][0], PORT_MODE_OUTPUT)
-                and portExists(saved_connections[i][1], PORT_MODE_INPUT)):
-            if not saved_connections[i] in connection_list:
-                delete_list.append(i)
+    for connection in graph.saved_connections - graph.connections:
+        if (graph.portExists(connection[0], PORT_MODE_OUTPUT)
+                and graph.portExists(connection[1], PORT_MODE_INPUT)):
+            graph.removeSavedConnection(connection)
 
-    delete_list.reverse()
-    for i in delete_list:
-        saved_connections.__delitem__(i)
+    # sorted to keep the file stable between saves
+    connections = sorted(graph.saved_connections)
 
     try:
-        file = open(file_path, 'w')
+        if use_compact:
+            writeCompactFile(file_path, connections)
+        else:
+            writeXmlFile(file_path, connections)
     except:
         sys.stderr.write('unable to write file %s\n' % file_path)
         app.quit()
         return
 
-    xml = QDomDocument()
-    p = xml.createElement('RAY-JACKPATCH')
-
-    for con in saved_connections:
-        ct = xml.createElement('connection')
-        ct.setAttribute('from', con[0])
-        ct.setAttribute('to', con[1])
-        p.appendChild(ct)
-
-    xml.appendChild(p)
-
-    file.write(xml.toString())
-    file.close()
-
     NSMServer.saveReply()
 
     setDirtyClean()
@@ -440,6 +645,9 @@ if __name__ == '__main__':
 
     daemon_address = ray.getLibloAddress(NSM_URL)
 
+    use_compact = '--compact' in sys.argv[1:]
+    debug = '--debug' in sys.argv[1:]
+
     jack_client = jacklib.client_open(
         "ray-patcher",
         jacklib.JackNoStartServer | jacklib.JackSessionID,
@@ -463,11 +671,7 @@ if __name__ == '__main__':
     jacklib.activate(jack_client)
 
     signaler = Signaler()
-    signaler.port_added.connect(portAdded)
-    signaler.port_removed.connect(portRemoved)
-    signaler.port_renamed.connect(portRenamed)
-    signaler.connection_added.connect(connectionAdded)
-    signaler.connection_removed.connect(connectionRemoved)
+    signaler.events_queued.connect(processEvents)
     signaler.server_sends_open.connect(openFile)
     signaler.server_sends_save.connect(saveFile)
 
@@ -508,9 +712,7 @@ if __name__ == '__main__':
         else:
             jack_port.type = PORT_TYPE_NULL
 
-        jack_port.is_new = True
-
-        port_list.append(jack_port)
+        graph.addPort(jack_port)
 
         if jacklib.port_flags(portPtr) & jacklib.JackPortIsInput:
             continue
@@ -520,7 +722,7 @@ if __name__ == '__main__':
                                                                  portPtr))
 
         for portConName in portConnectionNames:
-            connection_list.append((portName, portConName))
+            graph.addConnection((portName, portConName))
 
     app = QCoreApplication(sys.argv)
 
@@ -532,7 +734,6 @@ if __name__ == '__main__':
     timer.timeout.connect(lambda: None)
 
     connect_timer = ConnectTimer()
-    dirty_checker = DirtyChecker()
 
     app.exec()
 
@@ -25,6 +25,7 @@ class OscServer(liblo.Server):
         liblo.Server.__init__(self)
         self.m_daemon_address = None
         self.add_method('/reply', None, self.replyMessage)
+        self.add_method('/reply_chunk', None, self.replyChunkMessage)
         self.add_method('/error', 'sis', self.errorMessage)
         self.add_method('/minor_error', 'sis', self.minorErrorMessage)
         self.add_method('/ray/control/message', 's', self.rayControlMessage)
@@ -41,6 +42,11 @@ class OscServer(liblo.Server):
         self._osc_order_path = ''
         self._osc_order_args = []
 
+        # received chunks of list reply waiting for previous ones
+        self._reply_chunks = {}
+        self._next_chunk = 0
+        self._n_chunks = -1
+
     def replyMessage(self, path, args, types, src_addr):
         if not areTheyAllString(args):
             return
@@ -73,25 +79,10 @@ class OscServer(liblo.Server):
                                 highlightText(self._osc_order_path)))
             return
 
-        if reply_path.endswith('/list_snapshots'):
-            if len(args) >= 2:
-                snapshots = args[1:]
-                out_message = ""
-                for snapshot_and_info in snapshots:
-                    snapshot, slash, info = snapshot_and_info.partition(':')
-                    out_message += "%s\n" % snapshot
-                sys.stdout.write(out_message)
-                return
-            else:
-                self._final_err = 0
-
-        elif os.path.basename(reply_path).startswith(('list_', 'get_')):
+        if (reply_path.endswith('/list_snapshots')
+                or os.path.basename(reply_path).startswith(('list_', 'get_'))):
             if len(args) >= 2:
-                sessions = args[1:]
-                out_message = ""
-                for session in sessions:
-                    out_message += "%s\n" % session
-                sys.stdout.write(out_message)
+                self.writeListItems(reply_path, args[1:])
                 return
             else:
                 self._final_err = 0
@@ -102,6 +93,49 @@ class OscServer(liblo.Server):
                 sys.stdout.write("%s\n" % message)
             self._final_err = 0
 
+    def writeListItems(self, reply_path, items):
+        out_message = ""
+
+        if reply_path.endswith('/list_snapshots'):
+            for snapshot_and_info in items:
+                snapshot, slash, info = snapshot_and_info.partition(':')
+                out_message += "%s\n" % snapshot
+        else:
+            for item in items:
+                out_message += "%s\n" % item
+
+        sys.stdout.write(out_message)
+
+    def replyChunkMessage(self, path, args, types, src_addr):
+        if not (len(args) >= 2 and isinstance(args[0], str)
+                and isinstance(args[1], int)
+                and areTheyAllString(args[2:])):
+            return
+
+        reply_path, seq = args[:2]
+        items = args[2:]
+
+        if reply_path != self._osc_order_path:
+            sys.stdout.write('bug: reply for a wrong path:%s instead of %s\n'
+                             % (highlightText(reply_path),
+                                highlightText(self._osc_order_path)))
+            return
+
+        if items:
+            self._reply_chunks[seq] = items
+        else:
+            # end of list, seq is the number of chunks
+            self._n_chunks = seq
+
+        # write chunks in their order, even if received in disorder
+        while self._next_chunk in self._reply_chunks:
+            self.writeListItems(reply_path,
+                                self._reply_chunks.pop(self._next_chunk))
+            self._next_chunk += 1
+
+        if 0 <= self._n_chunks <= self._next_chunk:
+            self._final_err = 0
+
     def errorMessage(self, path, args, types, src_addr):
         error_path, err, message = args
 
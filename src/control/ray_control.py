@@ -25,12 +25,14 @@ control_operations = ('start', 'start_new', 'start_new_hidden', 'stop',
 server_operations = (
     'quit', 'change_root', 'list_session_templates',
     'list_user_client_templates', 'list_factory_client_templates',
-    'remove_client_template', 'list_sessions', 'new_session',
+    'remove_client_template', 'list_sessions',
+    'list_sessions_details', 'new_session',
     'open_session', 'open_session_off', 'save_session_template',
     'rename_session', 'set_options', 'has_option',
     'script_info', 'hide_script_info', 'script_user_action')
 
 session_operations = ('save', 'save_as_template', 'take_snapshot',
+                      'clean_snapshots',
                       'close', 'abort', 'duplicate', 'open_snapshot',
                       'rename', 'set_notes', 'get_notes',
                       'add_executable', 'add_proxy',
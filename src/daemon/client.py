@@ -14,6 +14,7 @@ from server_sender import ServerSender
 from daemon_tools  import TemplateRoots, Terminal, RS, getCodeRoot
 from signaler import Signaler
 from scripter import ClientScripter
+import client_stats
 
 NSM_API_VERSION_MAJOR = 1
 NSM_API_VERSION_MINOR = 0
@@ -24,6 +25,10 @@ OSC_SRC_SAVE = 2
 OSC_SRC_SAVE_TP = 3
 OSC_SRC_STOP = 4
 
+# seconds after which a launching client which didn't announce
+# doesn't delay the launch of other clients anymore
+LAUNCH_SETTLE_TIME = 1.0
+
 _translate = QCoreApplication.translate
 signaler = Signaler.instance()
 
@@ -68,11 +73,16 @@ class Client(ServerSender, ray.ClientData):
     net_duplicate_state = -1
 
     ignored_extensions = ray.getGitIgnoredExtensions()
+    # client_ids of clients to save before this one
+    save_after = ''
 
     last_save_time = 0.00
     last_dirty = 0.00
     _last_announce_time = 0.00
     last_open_duration = 0.00
+    _start_time = 0.00
+    _save_start_time = 0.00
+    last_save_duration = 0.00
 
     has_been_started = False
 
@@ -190,6 +200,7 @@ class Client(ServerSender, ray.ClientData):
         self.check_last_save = bool(ctx.attribute('check_last_save') != '0')
         self.start_gui_hidden = bool(ctx.attribute('gui_visible') == '0')
         self._from_nsm_file = bool(ctx.attribute('from_nsm_file') == '1')
+        self.save_after = ctx.attribute('save_after')
 
         self.updateInfosFromDesktopFile()
 
@@ -300,6 +311,8 @@ class Client(ServerSender, ray.ClientData):
             ctx.setAttribute('icon', self.icon)
         if not self.check_last_save:
             ctx.setAttribute('check_last_save', 0)
+        if self.save_after:
+            ctx.setAttribute('save_after', self.save_after)
         if self.arguments:
             ctx.setAttribute('arguments', self.arguments)
 
@@ -389,10 +402,20 @@ class Client(ServerSender, ray.ClientData):
         else:
             if self.pending_command == ray.Command.SAVE:
                 self.last_save_time = time.time()
-
-                self.sendGuiMessage(
-                    _translate('GUIMSG', '  %s: saved')
-                        % self.guiMsgStyle())
+                if self._save_start_time:
+                    self.last_save_duration = \
+                        self.last_save_time - self._save_start_time
+                    self.recordStat(client_stats.SAVE,
+                                    self.last_save_duration)
+                    self._save_start_time = 0.00
+
+                    self.sendGuiMessage(
+                        _translate('GUIMSG', '  %s: saved in %.2f s')
+                            % (self.guiMsgStyle(), self.last_save_duration))
+                else:
+                    self.sendGuiMessage(
+                        _translate('GUIMSG', '  %s: saved')
+                            % self.guiMsgStyle())
 
                 self.sendReplyToCaller(OSC_SRC_SAVE, 'client saved.')
 
@@ -403,6 +426,7 @@ class Client(ServerSender, ray.ClientData):
 
                 self.last_open_duration = \
                                         time.time() - self._last_announce_time
+                self.recordStat(client_stats.OPEN, self.last_open_duration)
                 self.sendReplyToCaller(OSC_SRC_OPEN, 'client opened')
 
             self.setStatus(ray.ClientStatus.READY)
@@ -444,6 +468,36 @@ class Client(ServerSender, ray.ClientData):
 
         return bool(not self.did_announce)
 
+    def recordStat(self, kind, duration):
+        stats = client_stats.ClientStats.getInstance()
+        if stats:
+            stats.record(self.executable_path, kind, duration)
+
+    def getTimeout(self, kind, default)->int:
+        stats = client_stats.ClientStats.getInstance()
+        if not stats:
+            return default
+        return stats.getTimeout(self.executable_path, kind, default)
+
+    def getSaveAfterIds(self)->list:
+        return [c for c in self.save_after.split(' ') if c]
+
+    def isLaunchSettled(self, launch_time)->bool:
+        # True when clients launched after this one can be started
+        if self.active:
+            return True
+
+        if self.process.state() == QProcess.NotRunning:
+            return True
+
+        if self.isRunning():
+            if self.isRayHack():
+                return True
+            if self.executable_path in RS.non_active_clients:
+                return True
+
+        return bool(time.time() - launch_time >= LAUNCH_SETTLE_TIME)
+
     def isCapableOf(self, capability)->bool:
         return bool(capability in self.capabilities)
 
@@ -698,6 +752,7 @@ class Client(ServerSender, ray.ClientData):
             process_env.insert('RAY_CLIENT_ID', self.client_id)
             self.process.setProcessEnvironment(process_env)
 
+        self._start_time = time.time()
         self.process.start(self.executable_path, arguments)
 
         ## Here for another way to debug clients.
@@ -995,6 +1050,7 @@ class Client(ServerSender, ray.ClientData):
             elif self.canSaveNow():
                 Terminal.message("Telling %s to save" % self.name)
                 self.sendToSelfAddress("/nsm/client/save")
+                self._save_start_time = time.time()
 
                 self.pending_command = ray.Command.SAVE
                 self.setStatus(ray.ClientStatus.SAVE)
@@ -1082,6 +1138,7 @@ class Client(ServerSender, ray.ClientData):
         self.auto_start = new_client.auto_start
         self.check_last_save = new_client.check_last_save
         self.ignored_extensions = new_client.ignored_extensions
+        self.save_after = new_client.save_after
         self.custom_data = new_client.custom_data
         self.description = new_client.description
         self._from_nsm_file = new_client._from_nsm_file
@@ -1152,6 +1209,9 @@ class Client(ServerSender, ray.ClientData):
                     self.check_last_save = bool(int(value))
             elif prop == 'ignored_extensions':
                 self.ignored_extensions = value
+            elif prop == 'save_after':
+                self.save_after = ' '.join(
+                    [c for c in value.split(' ') if c and c != self.client_id])
             elif prop == 'protocol':
                 # do not change protocol value
                 continue
@@ -1199,7 +1259,8 @@ desktop_file:%s
 label:%s
 icon:%s
 check_last_save:%i
-ignored_extensions:%s""" % (self.client_id,
+ignored_extensions:%s
+save_after:%s""" % (self.client_id,
                             protocol_str,
                             self.executable_path,
                             self.arguments,
@@ -1210,7 +1271,8 @@ ignored_extensions:%s""" % (self.client_id,
                             self.label,
                             self.icon,
                             int(self.check_last_save),
-                            self.ignored_extensions)
+                            self.ignored_extensions,
+                            self.save_after)
 
         if self.protocol == ray.Protocol.NSM:
             message += "\ncapabilities:%s" % self.capabilities
@@ -1943,3 +2005,8 @@ no_save_level:%i""" % (self.ray_hack.config_file,
                 self.send(src_addr, "/nsm/client/hide_optional_gui")
 
         self._last_announce_time = time.time()
+
+        if self._start_time:
+            self.recordStat(client_stats.ANNOUNCE,
+                            self._last_announce_time - self._start_time)
+            self._start_time = 0.00
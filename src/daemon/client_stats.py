@@ -0,0 +1,147 @@
+import math
+import os
+from PyQt5.QtCore import QTimer
+from PyQt5.QtXml import QDomDocument
+
+import ray
+from daemon_tools import Terminal, CommandLineArgs, getAppConfigPath
+
+instance = None
+
+ANNOUNCE = 'announce'
+OPEN = 'open'
+SAVE = 'save'
+
+MAX_SAMPLES = 50
+# timeouts are learned only with at least this number of samples
+MIN_SAMPLES = 5
+TIMEOUT_RATIO = 1.5
+TIMEOUT_MARGIN = 2.0
+
+def percentile(values, ratio):
+    values = sorted(values)
+    index = min(len(values) - 1, math.ceil(ratio * len(values)) - 1)
+    return values[max(0, index)]
+
+
+class ClientStats:
+    def __init__(self):
+        # executable -> kind -> list of durations in seconds
+        self._stats = {}
+        self._dirty = False
+
+        self.write_timer = QTimer()
+        self.write_timer.setInterval(5000)
+        self.write_timer.setSingleShot(True)
+        self.write_timer.timeout.connect(self.writeFile)
+
+        global instance
+        instance = self
+
+        self.readFile()
+
+    @staticmethod
+    def getInstance():
+        return instance
+
+    def getFilePath(self):
+        if CommandLineArgs.config_dir:
+            return "%s/client_stats.xml" % CommandLineArgs.config_dir
+        return "%s/client_stats.xml" % getAppConfigPath()
+
+    def record(self, executable, kind, duration):
+        if not executable or duration < 0:
+            return
+
+        samples = self._stats.setdefault(executable, {}).setdefault(kind, [])
+        samples.append(duration)
+        if len(samples) > MAX_SAMPLES:
+            samples.__delitem__(0)
+
+        self._dirty = True
+        if not self.write_timer.isActive():
+            self.write_timer.start()
+
+    def getTimeout(self, executable, kind, default):
+        # returns timeout in ms for this executable,
+        # default if there is not enough history.
+        samples = self._stats.get(executable, {}).get(kind, [])
+        if len(samples) < MIN_SAMPLES:
+            return default
+
+        return int(1000 * (percentile(samples, 0.99) * TIMEOUT_RATIO
+                           + TIMEOUT_MARGIN))
+
+    def readFile(self):
+        stats_file = self.getFilePath()
+        if not os.path.isfile(stats_file):
+            return
+
+        try:
+            file = open(stats_file, 'r')
+            xml = QDomDocument()
+            xml.setContent(file.read())
+            file.close()
+        except:
+            return
+
+        content = xml.documentElement()
+        if content.tagName() != 'CLIENT-STATS':
+            return
+
+        nodes = content.childNodes()
+        for i in range(nodes.count()):
+            el = nodes.at(i).toElement()
+            if el.tagName() != 'Executable':
+                continue
+
+            executable = el.attribute('name')
+            if not executable:
+                continue
+
+            for kind in (ANNOUNCE, OPEN, SAVE):
+                samples = []
+                for value in el.attribute(kind).split(' '):
+                    try:
+                        samples.append(float(value))
+                    except ValueError:
+                        continue
+
+                if samples:
+                    self._stats.setdefault(executable, {})[kind] = \
+                        samples[-MAX_SAMPLES:]
+
+    def writeFile(self):
+        self.write_timer.stop()
+
+        if not self._dirty:
+            return
+
+        xml = QDomDocument()
+        content = xml.createElement('CLIENT-STATS')
+        content.setAttribute('VERSION', ray.VERSION)
+
+        for executable in sorted(self._stats):
+            el = xml.createElement('Executable')
+            el.setAttribute('name', executable)
+            for kind, samples in self._stats[executable].items():
+                el.setAttribute(kind, ' '.join(['%.3f' % s for s in samples]))
+            content.appendChild(el)
+
+        xml.appendChild(content)
+
+        stats_file = self.getFilePath()
+
+        try:
+            if not os.path.isdir(os.path.dirname(stats_file)):
+                os.makedirs(os.path.dirname(stats_file))
+
+            file = open(stats_file, 'w')
+            file.write(xml.toString())
+            file.close()
+        except:
+            Terminal.warning("unable to write client stats file %s"
+                             % stats_file)
+            return
+
+        self._dirty = False
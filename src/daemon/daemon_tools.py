@@ -16,6 +16,14 @@ def getAppConfigPath():
             QStandardPaths.writableLocation(QStandardPaths.ConfigLocation),
             QCoreApplication.organizationName())
 
+def getAppCachePath():
+    if CommandLineArgs.config_dir:
+        return "%s/cache" % CommandLineArgs.config_dir
+
+    return "%s/%s" % (
+            QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation),
+            QCoreApplication.organizationName())
+
 def getCodeRoot():
     return dirname(dirname(dirname(os.path.realpath(__file__))))
 
@@ -1,17 +1,200 @@
+import errno
+import fcntl
+import hashlib
 import os
-import subprocess
-from PyQt5.QtCore import QProcess, QTimer
+import shutil
+import stat
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QTimer, pyqtSignal
+from PyQt5.QtXml import QDomDocument
 from osc_server_thread import OscServerThread
 from server_sender import ServerSender
+from daemon_tools import RS, Terminal
 import ray
 
+# ioctl number of FICLONE (btrfs, XFS reflinks)
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# media files smaller than this are copied, even in link_media mode
+LINK_MIN_SIZE = 1024 * 1024
+
+# manifest left in destination by a sync, to compare with at next sync
+SYNC_MANIFEST = '.ray-sync-manifest.xml'
+SYNC_BLOCK_SIZE = 1024 * 1024
+
+# (src_dev, dest_dev) couples where reflink failed
+_no_reflink_devs = set()
+
+
+class CopyAborted(Exception):
+    pass
+
+
+def _initWorker():
+    # copies must not disturb audio clients
+    try:
+        os.nice(15)
+    except OSError:
+        pass
+
+def reflinkFile(src_fd, dest_fd, devs):
+    if devs in _no_reflink_devs:
+        return False
+
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                       errno.ENOTTY, errno.ENOSYS):
+            _no_reflink_devs.add(devs)
+            return False
+        raise
+
+    return True
+
+def kernelCopy(src_fd, dest_fd, abort_event, progress_callback):
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    use_sendfile = True
+
+    while True:
+        if abort_event.is_set():
+            raise CopyAborted
+
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(src_fd, dest_fd, COPY_CHUNK_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP):
+                    use_copy_file_range = False
+                    continue
+                raise
+        elif use_sendfile:
+            try:
+                n = os.sendfile(dest_fd, src_fd, None, COPY_CHUNK_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EINVAL, errno.ENOSYS):
+                    use_sendfile = False
+                    continue
+                raise
+        else:
+            data = os.read(src_fd, COPY_CHUNK_SIZE)
+            n = len(data)
+            while data:
+                data = data[os.write(dest_fd, data):]
+
+        if not n:
+            break
+
+        progress_callback(n)
+
+def copyRegularFile(orig_path, dest_path, abort_event, progress_callback):
+    src_fd = os.open(orig_path, os.O_RDONLY)
+
+    try:
+        src_stat = os.fstat(src_fd)
+        dest_fd = os.open(dest_path, os.O_WRONLY|os.O_CREAT|os.O_TRUNC,
+                          stat.S_IMODE(src_stat.st_mode))
+
+        try:
+            devs = (src_stat.st_dev, os.fstat(dest_fd).st_dev)
+            if reflinkFile(src_fd, dest_fd, devs):
+                progress_callback(src_stat.st_size)
+            else:
+                kernelCopy(src_fd, dest_fd, abort_event, progress_callback)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+
+
+def hashBlock(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def hashingCopy(orig_path, dest_path, abort_event, progress_callback):
+    # byte copy which also returns the block checksums of the file
+    blocks = []
+
+    with open(orig_path, 'rb') as src_file:
+        mode = stat.S_IMODE(os.fstat(src_file.fileno()).st_mode)
+        dest_fd = os.open(dest_path, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, mode)
+
+        with open(dest_fd, 'wb') as dest_file:
+            while True:
+                if abort_event.is_set():
+                    raise CopyAborted
+
+                data = src_file.read(SYNC_BLOCK_SIZE)
+                if not data:
+                    break
+
+                dest_file.write(data)
+                blocks.append(hashBlock(data))
+                progress_callback(len(data))
+
+    return blocks
+
+def deltaCopy(orig_path, dest_path, old_blocks, abort_event,
+              progress_callback):
+    # rewrite only blocks of dest_path which differ from orig_path
+    blocks = []
+
+    with open(orig_path, 'rb') as src_file, \
+            open(dest_path, 'r+b') as dest_file:
+        while True:
+            if abort_event.is_set():
+                raise CopyAborted
+
+            data = src_file.read(SYNC_BLOCK_SIZE)
+            if not data:
+                break
+
+            block = hashBlock(data)
+            index = len(blocks)
+
+            if index >= len(old_blocks) or old_blocks[index] != block:
+                dest_file.seek(index * SYNC_BLOCK_SIZE)
+                dest_file.write(data)
+
+            blocks.append(block)
+            progress_callback(len(data))
+
+        dest_file.truncate(src_file.tell())
+
+    return blocks
+
+
 class CopyFile:
     orig_path = ""
     dest_path = ""
     state = 0
     size = 0
+    n_jobs = 0
+    error = ''
+    dest_existed = True
+
+
+class CopyJob:
+    def __init__(self, copy_file, orig_path, dest_path, size):
+        self.copy_file = copy_file
+        self.orig_path = orig_path
+        self.dest_path = dest_path
+        self.size = size
+        self.copied = 0
+
+        # sync only
+        self.old_blocks = None
+        self.with_blocks = False
+        self.blocks = []
+        self.error = ''
+
 
 class FileCopier(ServerSender):
+    job_finished = pyqtSignal(object, str)
+
     def __init__(self, session):
         ServerSender.__init__(self)
         self.session = session
@@ -21,13 +204,27 @@ class FileCopier(ServerSender):
         self.next_args = []
         self.copy_files = []
         self.copy_size = 0
+        self.copied_size = 0
         self.aborted = False
         self.is_active = False
 
-        self.process = QProcess()
-        self.process.finished.connect(self.processFinished)
-        if ray.QT_VERSION >= (5, 6):
-            self.process.errorOccurred.connect(self.errorOccurred)
+        self.executor = None
+        self._abort_event = threading.Event()
+        self._n_running_jobs = 0
+        self._dest_dir_created = ''
+        self._link_media = False
+        self._media_exts = ()
+
+        self._sync_dir = ''
+        self._sync_files = {}
+        self._sync_jobs = {}
+
+        # copied_size is increased by workers
+        self._size_lock = threading.Lock()
+        # (time, copied_size) of the last seconds, used for throughput
+        self._size_samples = deque()
+
+        self.job_finished.connect(self.jobFinished)
 
         self.timer = QTimer()
         self.timer.setInterval(250)
@@ -44,120 +241,236 @@ class FileCopier(ServerSender):
 
         server.informCopytoGui(copy_state)
 
-    def getFileSize(self, filepath):
-        if not os.path.exists(filepath):
-            return 0
+    def getExecutor(self):
+        if self.executor is None:
+            n_workers = RS.settings.value('daemon/copy_workers', 4, type=int)
+            self.executor = ThreadPoolExecutor(
+                max_workers=max(1, n_workers), initializer=_initWorker)
+        return self.executor
 
-        try:
-            du_full = subprocess.check_output(
-                ['nice', '-n', '15', 'du', '-sb', filepath]).decode()
-        except:
-            du_full = ""
+    def addCopiedSize(self, job, size):
+        # executed in a worker thread
+        with self._size_lock:
+            job.copied += size
+            self.copied_size += size
+
+    def getSpeedAndEta(self):
+        now = time.monotonic()
+        self._size_samples.append((now, self.copied_size))
 
-        if not du_full:
-            return 0
+        while (len(self._size_samples) > 2
+                and now - self._size_samples[0][0] > 3.0):
+            self._size_samples.popleft()
 
-        du_str = du_full.split('\t')[0]
-        if not du_str.isdigit():
-            return 0
+        first_time, first_size = self._size_samples[0]
+        if now <= first_time or self.copied_size <= first_size:
+            return (0.0, -1.0)
 
-        return int(du_str)
+        # speed in bytes per second
+        speed = (self.copied_size - first_size) / (now - first_time)
+        eta = max(0.0, (self.copy_size - self.copied_size) / speed)
+        return (speed, eta)
 
     def checkProgressSize(self):
-        current_size = 0
         self.timer.stop()
 
-        for copy_file in self.copy_files:
-            if copy_file.state == 2:
-                current_size += copy_file.size
-            elif copy_file.state == 1:
-                current_size += self.getFileSize(copy_file.dest_path)
-                break
-
-        if current_size and self.copy_size:
-            progress = float(current_size/self.copy_size)
+        if self.copied_size and self.copy_size:
+            progress = min(1.0, float(self.copied_size/self.copy_size))
+            speed, eta = self.getSpeedAndEta()
+            mb_speed = speed / 1000000
 
             if self.client_id:
-                self.sendGui('/ray/gui/client/progress', self.client_id, progress)
+                self.sendGui('/ray/gui/client/progress', self.client_id,
+                             progress, mb_speed, eta)
             else:
-                self.sendGui('/ray/gui/server/progress', progress)
+                self.sendGui('/ray/gui/server/progress',
+                             progress, mb_speed, eta)
 
             self.session.oscReply('/ray/net_daemon/duplicate_state', progress)
 
         self.timer.start()
 
-    def processFinished(self, exit_code, exit_status):
-        self.timer.stop()
+    def runJob(self, job):
+        # executed in a worker thread
+        error = ''
 
-        for copy_file in self.copy_files:
-            if copy_file.state == 1:
-                copy_file.state = 2
-                break
+        if not self._abort_event.is_set():
+            # copy of this file or directory has started
+            if job.copy_file.state == 0:
+                job.copy_file.state = 1
 
-        if self.aborted:
-            ##remove all created files
-            for copy_file in self.copy_files:
-                if copy_file.state > 0:
-                    file_to_remove = copy_file.dest_path
-
-                    if os.path.exists(file_to_remove):
-                        try:
-                            subprocess.run(['rm', '-R', file_to_remove])
-                        except:
-                            if self._abort_src_addr and self._abort_src_path:
-                                self.send(self._abort_src_addr,
-                                          '/error_minor',
-                                          self._abort_src_path,
-                                          ray.Err.SUBPROCESS_CRASH,
-                                          "%s hasn't been removed !")
+            progress_callback = lambda size: self.addCopiedSize(job, size)
 
+            try:
+                if job.old_blocks:
+                    job.blocks = deltaCopy(
+                        job.orig_path, job.dest_path, job.old_blocks,
+                        self._abort_event, progress_callback)
+                elif job.with_blocks:
+                    job.blocks = hashingCopy(
+                        job.orig_path, job.dest_path,
+                        self._abort_event, progress_callback)
+                else:
+                    copyRegularFile(
+                        job.orig_path, job.dest_path,
+                        self._abort_event, progress_callback)
+            except CopyAborted:
+                pass
+            except OSError as e:
+                error = str(e)
+
+        # failed, aborted or changed files must not stop progress
+        self.addCopiedSize(job, job.size - job.copied)
+        self.job_finished.emit(job, error)
+
+    def jobFinished(self, job, error):
+        if error:
+            Terminal.warning("copy of %s failed: %s" % (job.orig_path, error))
+            job.error = error
+
+        copy_file = job.copy_file
+        copy_file.n_jobs -= 1
+        if not copy_file.n_jobs and copy_file.state:
+            # state stays 0 if all jobs have been skipped by abort
+            copy_file.state = 2
+
+        self._n_running_jobs -= 1
+
+        if not self._n_running_jobs:
+            self.copyFinished()
+
+    def removeCopiedFiles(self):
+        files_to_remove = []
+
+        if self._dest_dir_created:
+            files_to_remove.append(self._dest_dir_created)
+        else:
+            # remove started copies, and directories or links
+            # created at prepare where nothing existed
+            files_to_remove = [copy_file.dest_path
+                               for copy_file in self.copy_files
+                               if (copy_file.state > 0
+                                   or not copy_file.dest_existed)]
+
+        for file_to_remove in files_to_remove:
+            try:
+                if (os.path.isdir(file_to_remove)
+                        and not os.path.islink(file_to_remove)):
+                    shutil.rmtree(file_to_remove)
+                elif os.path.lexists(file_to_remove):
+                    os.remove(file_to_remove)
+            except OSError:
+                if self._abort_src_addr and self._abort_src_path:
+                    self.send(self._abort_src_addr, '/minor_error',
+                              self._abort_src_path, ray.Err.SUBPROCESS_CRASH,
+                              "%s hasn't been removed !" % file_to_remove)
+
+    def copyFinished(self):
+        self.timer.stop()
+        self.is_active = False
+        self.informCopytoGui(False)
 
-            self.is_active = False
-            self.informCopytoGui(False)
+        if self.aborted:
+            self.removeCopiedFiles()
             self.abort_function(*self.next_args)
             return
 
-        #run next_function if copy is terminated
-        for copy_file in self.copy_files:
-            if copy_file.state != 2:
-                break
-        else:
-            self.is_active = False
-            self.informCopytoGui(False)
+        if self._sync_dir:
+            self.writeSyncManifest()
 
-            if self.next_function:
-                self.next_function(*self.next_args)
+        if self.next_function:
+            self.next_function(*self.next_args)
 
+    def linkMedia(self, src, dest, size):
+        if not (self._link_media and size >= LINK_MIN_SIZE
+                and os.path.splitext(src)[1].lower() in self._media_exts):
+            return False
+
+        try:
+            os.link(src, dest)
+        except OSError:
+            # other filesystem, or no hardlink support
+            return False
+
+        return True
+
+    def copySymlink(self, src, dest):
+        # replace dest as cp -R would do
+        if os.path.lexists(dest) and not (os.path.isdir(dest)
+                                          and not os.path.islink(dest)):
+            os.remove(dest)
+        os.symlink(os.readlink(src), dest)
+
+    def prepareError(self, copy_file, path, error):
+        Terminal.warning("copy of %s failed: %s" % (path, error))
+        copy_file.error = str(error)
+
+    def prepareCopy(self, copy_file, jobs):
+        # create directories and symlinks,
+        # and list regular files to copy in workers
+        orig_path = copy_file.orig_path
+        dest_path = copy_file.dest_path
+
+        if os.path.islink(orig_path):
+            self.copySymlink(orig_path, dest_path)
             return
 
-        self.nextProcess()
+        if not os.path.isdir(orig_path):
+            if os.path.isfile(orig_path):
+                size = os.path.getsize(orig_path)
+                if not self.linkMedia(orig_path, dest_path, size):
+                    copy_file.size += size
+                    jobs.append(
+                        CopyJob(copy_file, orig_path, dest_path, size))
+            return
 
-    def errorOccurred(self):
-        #todo make something else
-        self.processFinished(0, 0)
+        for root, dirs, files in os.walk(orig_path):
+            dest_root = dest_path + root[len(orig_path):]
+            try:
+                os.makedirs(dest_root, exist_ok=True)
+                shutil.copymode(root, dest_root)
+            except OSError as e:
+                # errors are recorded, and the copy goes on
+                self.prepareError(copy_file, root, e)
+                dirs.clear()
+                continue
+
+            for name in dirs + files:
+                src = "%s/%s" % (root, name)
+                dest = "%s/%s" % (dest_root, name)
 
-    def nextProcess(self):
-        self.is_active = True
+                try:
+                    src_stat = os.lstat(src)
+                    if stat.S_ISLNK(src_stat.st_mode):
+                        self.copySymlink(src, dest)
+                except OSError as e:
+                    self.prepareError(copy_file, src, e)
+                    continue
 
-        for copy_file in self.copy_files:
-            if copy_file.state == 0:
-                copy_file.state = 1
-                self.process.start('nice',
-                                   ['-n', '+15', 'cp', '-R',
-                                    copy_file.orig_path, copy_file.dest_path])
-                break
+                if stat.S_ISREG(src_stat.st_mode):
+                    if self.linkMedia(src, dest, src_stat.st_size):
+                        continue
 
-        self.timer.start()
+                    copy_file.size += src_stat.st_size
+                    jobs.append(CopyJob(copy_file, src, dest,
+                                        src_stat.st_size))
 
     def start(self, src_list, dest_dir, next_function,
-              abort_function, next_args=[]):
+              abort_function, next_args=[], link_media=False):
         self.abort_function = abort_function
         self.next_function = next_function
         self.next_args = next_args
 
         self.aborted = False
         self.copy_size = 0
+        self.copied_size = 0
         self.copy_files.clear()
+        self._dest_dir_created = ''
+        self._sync_dir = ''
+
+        self._link_media = link_media
+        self._media_exts = tuple(
+            e.lower() for e in ray.getGitIgnoredExtensions().split(' ') if e)
 
         dest_path_exists = bool(os.path.exists(dest_dir))
         if dest_path_exists:
@@ -181,7 +494,7 @@ class FileCopier(ServerSender):
                 return
 
             for path in tmp_list:
-                if path == '.ray-snapshots':
+                if path in ('.ray-snapshots', SYNC_MANIFEST):
                     continue
 
                 full_path = "%s/%s" % (src_dir, path)
@@ -194,13 +507,14 @@ class FileCopier(ServerSender):
                     self.abort_function(*self.next_args)
                     return
 
+                self._dest_dir_created = dest_dir
+                dest_path_exists = True
+
+        jobs = []
+
         for orig_path in src_list:
             copy_file = CopyFile()
-            copy_file.state = 0
             copy_file.orig_path = orig_path
-            copy_file.size = self.getFileSize(orig_path)
-
-            self.copy_size += copy_file.size
 
             if dest_path_exists:
                 copy_file.dest_path = "%s/%s" % (dest_dir,
@@ -209,14 +523,49 @@ class FileCopier(ServerSender):
                 #WARNING works only with one file !!!
                 copy_file.dest_path = dest_dir
 
+            copy_file.dest_existed = os.path.lexists(copy_file.dest_path)
             self.copy_files.append(copy_file)
 
+            n_jobs = len(jobs)
 
-        if self.copy_files:
-            self.informCopytoGui(True)
-            self.nextProcess()
-        else:
-            self.next_function(*self.next_args)
+            try:
+                self.prepareCopy(copy_file, jobs)
+            except OSError as e:
+                self.prepareError(copy_file, orig_path, e)
+
+            copy_file.n_jobs = len(jobs) - n_jobs
+            if not copy_file.n_jobs:
+                copy_file.state = 2
+
+            self.copy_size += copy_file.size
+
+        self.runJobs(jobs)
+
+    def runJobs(self, jobs):
+        if not jobs:
+            self.is_active = False
+            if self._sync_dir:
+                self.writeSyncManifest()
+
+            if self.next_function:
+                self.next_function(*self.next_args)
+            return
+
+        self.is_active = True
+        self.informCopytoGui(True)
+
+        self._abort_event = threading.Event()
+        self._n_running_jobs = len(jobs)
+        self._size_samples.clear()
+
+        # biggest files first, so workers end together
+        jobs.sort(key=lambda job: job.size, reverse=True)
+
+        executor = self.getExecutor()
+        for job in jobs:
+            executor.submit(self.runJob, job)
+
+        self.timer.start()
 
     def startClientCopy(self, client_id, src_list, dest_dir, next_function,
                         abort_function, next_args=[]):
@@ -225,10 +574,293 @@ class FileCopier(ServerSender):
                    abort_function, next_args)
 
     def startSessionCopy(self, src_dir, dest_dir, next_function,
-                         abort_function, next_args=[]):
+                         abort_function, next_args=[], link_media=False):
         self.client_id = ''
         self.start(src_dir, dest_dir, next_function,
-                   abort_function, next_args)
+                   abort_function, next_args, link_media)
+
+    def readSyncManifest(self, dest_dir):
+        manifest = {}
+
+        try:
+            file = open("%s/%s" % (dest_dir, SYNC_MANIFEST), 'r')
+            xml = QDomDocument()
+            xml.setContent(file.read())
+            file.close()
+        except:
+            return manifest
+
+        content = xml.documentElement()
+        if content.tagName() != 'RAY-SYNC-MANIFEST':
+            return manifest
+
+        nodes = content.childNodes()
+        for i in range(nodes.count()):
+            el = nodes.at(i).toElement()
+            if el.tagName() != 'File':
+                continue
+
+            try:
+                manifest[el.attribute('path')] = (
+                    int(el.attribute('size')),
+                    int(el.attribute('mtime')),
+                    int(el.attribute('inode')),
+                    int(el.attribute('dest_mtime')),
+                    [b for b in el.attribute('blocks').split(' ') if b])
+            except ValueError:
+                continue
+
+        return manifest
+
+    def writeSyncManifest(self):
+        xml = QDomDocument()
+        content = xml.createElement('RAY-SYNC-MANIFEST')
+        content.setAttribute('VERSION', ray.VERSION)
+
+        for rel_path, src_stat_blocks in self._sync_files.items():
+            size, mtime, blocks = src_stat_blocks
+            job = self._sync_jobs.get(rel_path)
+            if job is not None:
+                if job.error:
+                    # not in manifest, so it will be copied next time
+                    continue
+                blocks = job.blocks
+
+            try:
+                dest_stat = os.lstat("%s/%s" % (self._sync_dir, rel_path))
+            except OSError:
+                continue
+
+            el = xml.createElement('File')
+            el.setAttribute('path', rel_path)
+            el.setAttribute('size', str(size))
+            el.setAttribute('mtime', str(mtime))
+            el.setAttribute('inode', str(dest_stat.st_ino))
+            el.setAttribute('dest_mtime', str(dest_stat.st_mtime_ns))
+            if blocks:
+                el.setAttribute('blocks', ' '.join(blocks))
+            content.appendChild(el)
+
+        xml.appendChild(content)
+
+        try:
+            file = open("%s/%s" % (self._sync_dir, SYNC_MANIFEST), 'w')
+            file.write(xml.toString())
+            file.close()
+        except:
+            Terminal.warning("unable to write sync manifest in %s"
+                             % self._sync_dir)
+
+        self._sync_files.clear()
+        self._sync_jobs.clear()
+
+    def removePath(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def prepareSync(self, src_dir, dest_dir, with_blocks, jobs):
+        copy_file = CopyFile()
+        copy_file.orig_path = src_dir
+        copy_file.dest_path = dest_dir
+        copy_file.dest_existed = os.path.lexists(dest_dir)
+        self.copy_files.append(copy_file)
+
+        src_dirs = set()
+        src_links = {}
+
+        for root, dirs, files in os.walk(src_dir):
+            rel_root = root[len(src_dir)+1:]
+            if not rel_root:
+                for skipped in ('.ray-snapshots', SYNC_MANIFEST):
+                    if skipped in dirs:
+                        dirs.remove(skipped)
+                    if skipped in files:
+                        files.remove(skipped)
+            else:
+                src_dirs.add(rel_root)
+
+            for name in dirs + files:
+                rel_path = "%s/%s" % (rel_root, name) if rel_root else name
+                src_stat = os.lstat("%s/%s" % (root, name))
+
+                if stat.S_ISLNK(src_stat.st_mode):
+                    src_links[rel_path] = os.readlink("%s/%s" % (root, name))
+                elif stat.S_ISREG(src_stat.st_mode):
+                    self._sync_files[rel_path] = (
+                        src_stat.st_size, src_stat.st_mtime_ns, [])
+
+        manifest = self.readSyncManifest(dest_dir)
+
+        # regular files in destination, found by inode.
+        # files of the previous sync may have been renamed after copy.
+        dest_inodes = {}
+        dest_mtimes = {}
+        dest_dirs = []
+
+        for root, dirs, files in os.walk(dest_dir):
+            rel_root = root[len(dest_dir)+1:]
+            if rel_root:
+                dest_dirs.append(rel_root)
+
+            for name in files:
+                rel_path = "%s/%s" % (rel_root, name) if rel_root else name
+                if rel_path == SYNC_MANIFEST:
+                    continue
+
+                dest_stat = os.lstat("%s/%s" % (root, name))
+                if stat.S_ISREG(dest_stat.st_mode):
+                    dest_inodes[dest_stat.st_ino] = rel_path
+                    dest_mtimes[rel_path] = dest_stat.st_mtime_ns
+
+        kept = set()
+        moves = []
+        to_copy = []
+
+        for rel_path, src_stat_blocks in self._sync_files.items():
+            size, mtime, blocks = src_stat_blocks
+            old = manifest.get(rel_path)
+
+            if old is None or not old[2] in dest_inodes:
+                to_copy.append((rel_path, None))
+                continue
+
+            old_size, old_mtime, inode, old_dest_mtime, old_blocks = old
+            current_path = dest_inodes.pop(inode)
+
+            if dest_mtimes.get(current_path) != old_dest_mtime:
+                # file has been modified in destination since last sync
+                to_copy.append((rel_path, None))
+                continue
+
+            kept.add(rel_path)
+            if current_path != rel_path:
+                moves.append((current_path, rel_path))
+
+            if old_size == size and old_mtime == mtime:
+                self._sync_files[rel_path] = (size, mtime, old_blocks)
+            else:
+                to_copy.append((rel_path, old_blocks))
+
+        # move back files renamed in destination
+        # to a temporary name first, names could be swapped.
+        tmp_moves = []
+        for current_path, rel_path in moves:
+            tmp_path = ".ray-sync-tmp-%i" % len(tmp_moves)
+            os.rename("%s/%s" % (dest_dir, current_path),
+                      "%s/%s" % (dest_dir, tmp_path))
+            tmp_moves.append((tmp_path, rel_path))
+
+        # remove all what is not in source anymore
+        for rel_path in dest_inodes.values():
+            if not rel_path in kept:
+                self.removePath("%s/%s" % (dest_dir, rel_path))
+
+        for rel_path in sorted(dest_dirs, reverse=True):
+            full_path = "%s/%s" % (dest_dir, rel_path)
+            if (os.path.islink(full_path)
+                    or (not rel_path in src_dirs
+                        and os.path.isdir(full_path))):
+                self.removePath(full_path)
+
+        for root, dirs, files in os.walk(dest_dir):
+            rel_root = root[len(dest_dir)+1:]
+            for name in files:
+                rel_path = "%s/%s" % (rel_root, name) if rel_root else name
+                if (rel_path != SYNC_MANIFEST
+                        and not rel_path.startswith('.ray-sync-tmp-')
+                        and not rel_path in kept
+                        and not rel_path in self._sync_files):
+                    self.removePath("%s/%s" % (root, name))
+
+        for rel_path in sorted(src_dirs):
+            full_path = "%s/%s" % (dest_dir, rel_path)
+            if os.path.lexists(full_path) and not os.path.isdir(full_path):
+                os.remove(full_path)
+            os.makedirs(full_path, exist_ok=True)
+            shutil.copymode("%s/%s" % (src_dir, rel_path), full_path)
+
+        for tmp_path, rel_path in tmp_moves:
+            full_path = "%s/%s" % (dest_dir, rel_path)
+            if os.path.lexists(full_path):
+                self.removePath(full_path)
+            os.rename("%s/%s" % (dest_dir, tmp_path), full_path)
+
+        for rel_path, link_target in src_links.items():
+            full_path = "%s/%s" % (dest_dir, rel_path)
+            if os.path.lexists(full_path):
+                self.removePath(full_path)
+            os.symlink(link_target, full_path)
+
+        for rel_path, old_blocks in to_copy:
+            size = self._sync_files[rel_path][0]
+            full_path = "%s/%s" % (dest_dir, rel_path)
+
+            if old_blocks is None and os.path.lexists(full_path):
+                self.removePath(full_path)
+
+            job = CopyJob(copy_file, "%s/%s" % (src_dir, rel_path),
+                          full_path, size)
+            job.old_blocks = old_blocks
+            job.with_blocks = with_blocks and size >= 2 * SYNC_BLOCK_SIZE
+            self._sync_jobs[rel_path] = job
+            copy_file.size += size
+            jobs.append(job)
+
+        copy_file.n_jobs = len(jobs)
+        if not jobs:
+            copy_file.state = 2
+
+        self.copy_size += copy_file.size
+
+    def startSessionSync(self, src_dir, dest_dir, next_function,
+                         abort_function, next_args=[], with_blocks=False):
+        # copy src_dir to dest_dir, transferring only files or blocks
+        # changed since the last sync to dest_dir.
+        self.client_id = ''
+        self.abort_function = abort_function
+        self.next_function = next_function
+        self.next_args = next_args
+
+        self.aborted = False
+        self.copy_size = 0
+        self.copied_size = 0
+        self.copy_files.clear()
+        self._link_media = False
+        self._sync_files.clear()
+        self._sync_jobs.clear()
+
+        if not os.path.isdir(src_dir):
+            self.abort_function(*self.next_args)
+            return
+
+        if os.path.exists(dest_dir) and not os.path.isdir(dest_dir):
+            self.abort_function(*self.next_args)
+            return
+
+        try:
+            os.makedirs(dest_dir, exist_ok=True)
+        except OSError:
+            self.abort_function(*self.next_args)
+            return
+
+        # if aborted, destination is removed, as for a copy
+        self._dest_dir_created = dest_dir
+        self._sync_dir = dest_dir
+
+        jobs = []
+
+        try:
+            self.prepareSync(src_dir, dest_dir, with_blocks, jobs)
+        except OSError as e:
+            Terminal.warning("sync of %s failed: %s" % (src_dir, e))
+            self._sync_dir = ''
+            self.removeCopiedFiles()
+            self.abort_function(*self.next_args)
+            return
+
+        self.runJobs(jobs)
 
     def abort(self, abort_function=None, next_args=[]):
         if abort_function:
@@ -236,9 +868,9 @@ class FileCopier(ServerSender):
             self.next_args = next_args
 
         self.timer.stop()
-        if self.process.state() == QProcess.Running:
+        if self.is_active and self._n_running_jobs:
             self.aborted = True
-            self.process.terminate()
+            self._abort_event.set()
 
     def abortFrom(self, src_addr, src_path):
         self.abort()
@@ -0,0 +1,235 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from PyQt5.QtCore import QObject, QSocketNotifier
+
+from daemon_tools import Terminal
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+              | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def getLibc():
+    global _libc
+
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+            _libc.inotify_init1
+            _libc.inotify_add_watch
+            _libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            _libc = False
+
+    return _libc
+
+
+class FsWatcher(QObject):
+    # watch recursively a directory with inotify,
+    # and keep the set of paths changed since last takeDirtyPaths().
+    # if inotify is not available or misses events,
+    # isReliable() returns False and users have to scan the directory.
+    def __init__(self, excluded=()):
+        QObject.__init__(self)
+        self.root = ''
+        self.excluded = tuple(excluded)
+
+        self._fd = -1
+        self._notifier = None
+        self._wds = {}
+        self._dirty_paths = set()
+        self._reliable = False
+
+    def isReliable(self):
+        return self._reliable
+
+    def setRoot(self, root):
+        self.stop()
+        self.root = root
+
+        if not root or not os.path.isdir(root):
+            return
+
+        libc = getLibc()
+        if not libc:
+            return
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            Terminal.warning("inotify unavailable: %s"
+                             % os.strerror(ctypes.get_errno()))
+            return
+
+        self._fd = fd
+        self._reliable = True
+
+        self.addWatchRecursive(root)
+        if not self._reliable:
+            self.stop()
+            return
+
+        self._notifier = QSocketNotifier(self._fd, QSocketNotifier.Read)
+        self._notifier.activated.connect(self.readEvents)
+
+    def stop(self):
+        if self._notifier is not None:
+            self._notifier.setEnabled(False)
+            self._notifier.activated.disconnect()
+            self._notifier = None
+
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+        self._wds.clear()
+        self._dirty_paths.clear()
+        self._reliable = False
+
+    def isExcluded(self, path):
+        for excluded in self.excluded:
+            excluded_path = "%s/%s" % (self.root, excluded)
+            if (path == excluded_path
+                    or path.startswith(excluded_path + '/')):
+                return True
+        return False
+
+    def addWatch(self, path):
+        wd = getLibc().inotify_add_watch(self._fd, os.fsencode(path),
+                                         WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                Terminal.warning(
+                    "inotify watch limit reached, "
+                    "session changes will be checked by scanning")
+                self._reliable = False
+            elif err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                self._reliable = False
+            return False
+
+        self._wds[wd] = path
+        return True
+
+    def addWatchRecursive(self, path):
+        if self.isExcluded(path) or not self.addWatch(path):
+            return
+
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return
+
+        for entry in entries:
+            if not self._reliable:
+                return
+
+            if entry.is_dir(follow_symlinks=False):
+                self.addWatchRecursive(entry.path)
+
+    def removeWatchRecursive(self, path):
+        for wd, wd_path in list(self._wds.items()):
+            if wd_path == path or wd_path.startswith(path + '/'):
+                getLibc().inotify_rm_watch(self._fd, wd)
+                del self._wds[wd]
+
+    def readEvents(self):
+        while self._fd >= 0:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.stop()
+                return
+
+            self.parseEvents(data)
+
+    def parseEvents(self, data):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events have been lost
+                self._reliable = False
+                continue
+
+            dir_path = self._wds.get(wd)
+            if dir_path is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self._wds[wd]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if dir_path == self.root:
+                    # session folder itself moved or removed
+                    self._reliable = False
+                continue
+
+            path = dir_path
+            if name:
+                path = "%s/%s" % (dir_path, os.fsdecode(name))
+
+            if self.isExcluded(path):
+                continue
+
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    # watches are re-added with the new path at IN_MOVED_TO
+                    self.removeWatchRecursive(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self.addWatchRecursive(path)
+                    # files may have been created before the watch
+                    self.markTreeDirty(path)
+
+            self._dirty_paths.add(path)
+
+    def markTreeDirty(self, path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                self._dirty_paths.add("%s/%s" % (root, name))
+
+    def takeDirtyPaths(self):
+        # returns paths changed since last call, relative to root
+        self.readEvents()
+
+        dirty_paths = set()
+        for path in self._dirty_paths:
+            if path.startswith(self.root + '/'):
+                dirty_paths.add(path[len(self.root)+1:])
+
+        self._dirty_paths.clear()
+        return dirty_paths
+
+    def hasDirtyPaths(self):
+        self.readEvents()
+        return bool(self._dirty_paths)
@@ -0,0 +1,341 @@
+import hashlib
+import json
+import os
+import stat
+import threading
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from daemon_tools import Terminal
+from file_copier import copyRegularFile, CopyAborted
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def hashFile(file_path, abort_event):
+    hasher = hashlib.blake2b(digest_size=20)
+
+    with open(file_path, 'rb') as file:
+        while True:
+            if abort_event.is_set():
+                raise CopyAborted
+
+            data = file.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+
+    return hasher.hexdigest()
+
+
+class MediaStore(QObject):
+    # content addressed store of session files excluded from git
+    # (too big files, ignored extensions).
+    # blobs are keyed by their hash, so an unchanged file is stored once
+    # whatever the number of snapshots referencing it.
+    # snapshots reference blobs with {rel_path: [key, size, mode]}.
+    work_finished = pyqtSignal(object, str)
+
+    def __init__(self, store_dir='media'):
+        QObject.__init__(self)
+        self.store_dir = store_dir
+        self._next_function = None
+        self._thread = None
+        self._abort_event = threading.Event()
+
+        self.work_finished.connect(self.workFinished)
+
+    def getStorePath(self, gitdir_path):
+        return "%s/%s" % (gitdir_path, self.store_dir)
+
+    def getBlobPath(self, store_path, key):
+        return "%s/objects/%s/%s" % (store_path, key[:2], key[2:])
+
+    def getIndexPath(self, store_path):
+        return "%s/index.json" % store_path
+
+    def isRunning(self):
+        return self._next_function is not None
+
+    def readIndex(self, store_path):
+        # rel_path -> [size, mtime_ns, inode, key]
+        # of session files at last store or restore
+        try:
+            index_file = open(self.getIndexPath(store_path), 'r')
+            index = json.load(index_file)
+            index_file.close()
+        except:
+            return {}
+
+        if not isinstance(index, dict):
+            return {}
+
+        return index
+
+    def writeIndex(self, store_path, index):
+        try:
+            index_file = open(self.getIndexPath(store_path) + '.tmp', 'w')
+            json.dump(index, index_file)
+            index_file.close()
+            os.rename(self.getIndexPath(store_path) + '.tmp',
+                      self.getIndexPath(store_path))
+        except:
+            Terminal.warning("unable to write media store index in %s"
+                             % store_path)
+
+    def getIndexKey(self, index, rel_path, file_stat):
+        infos = index.get(rel_path)
+        if (isinstance(infos, list) and len(infos) == 4
+                and infos[:3] == [file_stat.st_size, file_stat.st_mtime_ns,
+                                  file_stat.st_ino]):
+            return infos[3]
+        return ''
+
+    def addBlob(self, store_path, file_path, index_key):
+        # executed in the worker thread, returns the key of the stored file
+        if index_key and os.path.exists(self.getBlobPath(store_path,
+                                                         index_key)):
+            return index_key
+
+        key = hashFile(file_path, self._abort_event)
+        blob_path = self.getBlobPath(store_path, key)
+        if os.path.exists(blob_path):
+            return key
+
+        # copy (or reflink) before to hash again,
+        # file could be written during the copy.
+        tmp_path = "%s/tmp-%i" % (store_path, threading.get_ident())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        copyRegularFile(file_path, tmp_path, self._abort_event,
+                        lambda size: None)
+
+        key = hashFile(tmp_path, self._abort_event)
+        blob_path = self.getBlobPath(store_path, key)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, blob_path)
+        return key
+
+    def storeWork(self, spath, store_path, rel_paths):
+        # executed in the worker thread
+        media = {}
+        index = self.readIndex(store_path)
+        new_index = {}
+
+        for rel_path in rel_paths:
+            if self._abort_event.is_set():
+                raise CopyAborted
+
+            file_path = "%s/%s" % (spath, rel_path)
+
+            try:
+                file_stat = os.stat(file_path)
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+
+                key = self.addBlob(store_path, file_path,
+                                   self.getIndexKey(index, rel_path,
+                                                    file_stat))
+            except OSError as e:
+                Terminal.warning("unable to store %s in media store: %s"
+                                 % (file_path, str(e)))
+                continue
+
+            media[rel_path] = [key, file_stat.st_size,
+                               stat.S_IMODE(file_stat.st_mode)]
+            new_index[rel_path] = [file_stat.st_size, file_stat.st_mtime_ns,
+                                   file_stat.st_ino, key]
+
+        self.writeIndex(store_path, new_index)
+        return media
+
+    def isInScope(self, rel_path, scope):
+        for scope_path in scope:
+            if (not scope_path or rel_path == scope_path
+                    or rel_path.startswith(scope_path + '/')):
+                return True
+        return False
+
+    def removeWork(self, spath, index, media, remove_scope):
+        # executed in the worker thread,
+        # remove stored files in remove_scope which are not in media.
+        # files modified since stored are kept, their contents
+        # are in no snapshot.
+        for rel_path in list(index.keys()):
+            if (rel_path in media
+                    or not self.isInScope(rel_path, remove_scope)):
+                continue
+
+            file_path = "%s/%s" % (spath, rel_path)
+
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                del index[rel_path]
+                continue
+
+            if not self.getIndexKey(index, rel_path, file_stat):
+                continue
+
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                Terminal.warning("unable to remove %s: %s"
+                                 % (file_path, str(e)))
+                continue
+
+            del index[rel_path]
+
+    def restoreWork(self, spath, store_path, media, remove_scope):
+        # executed in the worker thread
+        index = self.readIndex(store_path)
+
+        if remove_scope is not None:
+            self.removeWork(spath, index, media, remove_scope)
+
+        for rel_path, infos in media.items():
+            if self._abort_event.is_set():
+                raise CopyAborted
+
+            if not (isinstance(infos, list) and len(infos) == 3):
+                continue
+
+            key, size, mode = infos
+            file_path = "%s/%s" % (spath, rel_path)
+
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                file_stat = None
+
+            if (file_stat is not None
+                    and self.getIndexKey(index, rel_path, file_stat) == key):
+                # file has not been modified since stored or restored
+                continue
+
+            blob_path = self.getBlobPath(store_path, key)
+            if not os.path.exists(blob_path):
+                Terminal.warning("media store misses %s for %s"
+                                 % (key, rel_path))
+                continue
+
+            tmp_path = "%s.ray-media-tmp" % file_path
+
+            try:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                copyRegularFile(blob_path, tmp_path, self._abort_event,
+                                lambda size: None)
+                os.chmod(tmp_path, mode)
+                os.replace(tmp_path, file_path)
+                file_stat = os.stat(file_path)
+            except CopyAborted:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            except OSError as e:
+                Terminal.warning("unable to restore %s from media store: %s"
+                                 % (file_path, str(e)))
+                continue
+
+            index[rel_path] = [file_stat.st_size, file_stat.st_mtime_ns,
+                               file_stat.st_ino, key]
+
+        self.writeIndex(store_path, index)
+        return None
+
+    def runWork(self, work, *args):
+        # executed in the worker thread
+        try:
+            os.nice(15)
+        except OSError:
+            pass
+
+        result = None
+        error = ''
+
+        try:
+            result = work(*args)
+        except CopyAborted:
+            error = 'aborted'
+        except OSError as e:
+            error = str(e)
+
+        self.work_finished.emit(result, error)
+
+    def startWork(self, next_function, work, *args):
+        self._next_function = next_function
+        self._abort_event.clear()
+        self._thread = threading.Thread(target=self.runWork,
+                                        args=(work, *args))
+        self._thread.start()
+
+    def workFinished(self, result, error):
+        self._thread.join()
+        self._thread = None
+
+        next_function = self._next_function
+        self._next_function = None
+
+        if error and error != 'aborted':
+            Terminal.warning("media store error: %s" % error)
+
+        if next_function is not None:
+            next_function(result)
+
+    def store(self, spath, gitdir_path, rel_paths, next_function):
+        # next_function is called with {rel_path: [key, size, mode]}
+        # or None if store failed or has been aborted.
+        store_path = self.getStorePath(gitdir_path)
+
+        try:
+            os.makedirs("%s/objects" % store_path, exist_ok=True)
+        except OSError:
+            next_function(None)
+            return
+
+        self.startWork(next_function, self.storeWork,
+                       spath, store_path, sorted(rel_paths))
+
+    def restore(self, spath, gitdir_path, media, next_function,
+                remove_scope=None):
+        # restore files of media if they differ from session files.
+        # remove_scope is None or a list of relative paths
+        # ('' for all session) where stored files not in media are removed.
+        if not media and remove_scope is None:
+            next_function(None)
+            return
+
+        self.startWork(next_function, self.restoreWork,
+                       spath, self.getStorePath(gitdir_path), media,
+                       remove_scope)
+
+    def prune(self, gitdir_path, kept_keys):
+        # remove blobs not referenced by kept_keys
+        objects_path = "%s/objects" % self.getStorePath(gitdir_path)
+        if not os.path.isdir(objects_path):
+            return
+
+        for prefix in os.listdir(objects_path):
+            prefix_path = "%s/%s" % (objects_path, prefix)
+            try:
+                names = os.listdir(prefix_path)
+            except OSError:
+                continue
+
+            for name in names:
+                if prefix + name in kept_keys:
+                    continue
+
+                try:
+                    os.remove("%s/%s" % (prefix_path, name))
+                except OSError:
+                    continue
+
+            if not os.listdir(prefix_path):
+                try:
+                    os.rmdir(prefix_path)
+                except OSError:
+                    pass
+
+    def abort(self):
+        self._abort_event.set()
@@ -16,6 +16,10 @@ from daemon_tools import (TemplateRoots, CommandLineArgs, Terminal, RS,
 instance = None
 signaler = Signaler.instance()
 
+# max size in bytes of a list reply message,
+# far under the max size of an UDP datagram.
+REPLY_CHUNK_SIZE = 8192
+
 
 def pathIsValid(path):
     return not bool('../' in path)
@@ -41,11 +45,79 @@ def ray_method(path, types):
         return wrapper
     return decorated
 
+def oscStringSize(string):
+    # OSC strings are null terminated and padded to 4 bytes
+    return (len(string.encode()) // 4 + 1) * 4
+
+
 class Controller:
     addr = None
     pid = 0
 
 
+class ChunkedReply:
+    # send a list of strings as replies of path to src_addr,
+    # in messages sized to fit in an UDP datagram.
+    # GUIs and ray_control receive '/reply_chunk' messages
+    # with path and a sequence number, then an empty chunk with
+    # the number of chunks as end of list marker.
+    # Others receive '/reply' messages and a last empty '/reply'.
+    def __init__(self, sender, src_addr, path, sent_callback=None):
+        self.sender = sender
+        self.src_addr = src_addr
+        self.path = path
+        self.sent_callback = sent_callback
+
+        server = OscServerThread.getInstance()
+        self.chunked = bool(server and server.acceptsReplyChunks(src_addr))
+
+        self.seq = 0
+        self.items = []
+        # address, path, sequence number and type tags
+        self.header_size = (oscStringSize('/reply_chunk')
+                            + oscStringSize(path) + 4 + 8)
+        self.size = self.header_size
+
+    def add(self, *items):
+        for item in items:
+            # item string and its type tag
+            item_size = oscStringSize(item) + 1
+
+            if self.items and self.size + item_size > REPLY_CHUNK_SIZE:
+                self.flush()
+
+            self.items.append(item)
+            self.size += item_size
+
+    def flush(self):
+        if not self.items:
+            return
+
+        items = self.items
+        self.items = []
+        self.size = self.header_size
+
+        if self.chunked:
+            self.sender.send(self.src_addr, '/reply_chunk', self.path,
+                             self.seq, *items)
+        else:
+            self.sender.send(self.src_addr, '/reply', self.path, *items)
+
+        self.seq += 1
+
+        if self.sent_callback is not None:
+            self.sent_callback(items)
+
+    def end(self):
+        self.flush()
+
+        if self.chunked:
+            self.sender.send(self.src_addr, '/reply_chunk', self.path,
+                             self.seq)
+        else:
+            self.sender.send(self.src_addr, '/reply', self.path)
+
+
 # Osc server thread separated in many classes for confort.
 
 # ClientCommunicating contains NSM protocol.
@@ -311,6 +383,8 @@ class OscServerThread(ClientCommunicating):
             'daemon/auto_snapshot', True, type=bool)
         self.option_session_scripts = RS.settings.value(
             'daemon/session_scripts', True, type=bool)
+        self.option_hardlink_media = RS.settings.value(
+            'daemon/hardlink_media', False, type=bool)
 
         self.option_has_wmctrl = bool(shutil.which('wmctrl'))
         if not self.option_has_wmctrl:
@@ -326,6 +400,7 @@ class OscServerThread(ClientCommunicating):
             self.option_desktops_memory = False
             self.option_snapshots = False
             self.option_session_scripts = False
+            self.option_hardlink_media = False
 
         global instance
         instance = self
@@ -430,8 +505,7 @@ class OscServerThread(ClientCommunicating):
     @ray_method('/ray/server/list_path', '')
     def rayServerListPath(self, path, args, types, src_addr):
         exec_list = []
-        tmp_exec_list = []
-        n = 0
+        reply = ChunkedReply(self, src_addr, path)
 
         pathlist = os.getenv('PATH').split(':')
         for pathdir in pathlist:
@@ -444,38 +518,23 @@ class OscServerThread(ClientCommunicating):
                             and os.access(fullexe, os.X_OK)
                             and not exe in exec_list):
                         exec_list.append(exe)
-                        tmp_exec_list.append(exe)
-                        n += len(exe)
-
-                        if n >= 20000:
-                            self.send(src_addr, '/reply',
-                                      path, *tmp_exec_list)
-                            tmp_exec_list.clear()
-                            n = 0
+                        reply.add(exe)
 
-        if tmp_exec_list:
-            self.send(src_addr, '/reply', path, *tmp_exec_list)
+        reply.end()
 
     @ray_method('/ray/server/list_session_templates', '')
     def rayServerListSessionTemplates(self, path, args, types, src_addr):
         if not os.path.isdir(TemplateRoots.user_sessions):
             return False
 
-        template_list = []
+        reply = ChunkedReply(self, src_addr, path)
 
         all_files = os.listdir(TemplateRoots.user_sessions)
         for file in all_files:
             if os.path.isdir("%s/%s" % (TemplateRoots.user_sessions, file)):
-                template_list.append(file)
+                reply.add(file)
 
-                if len(template_list) == 100:
-                    self.send(src_addr, '/reply', path, *template_list)
-                    template_list.clear()
-
-        if template_list:
-            self.send(src_addr, '/reply', path, *template_list)
-
-        self.send(src_addr, '/reply', path)
+        reply.end()
 
     @ray_method('/ray/server/list_user_client_templates', '')
     def rayServerListUserClientTemplates(self, path, args, types, src_addr):
@@ -553,6 +612,20 @@ class OscServerThread(ClientCommunicating):
     def rayServerListSessionsWithNet(self, path, args, types, src_addr):
         self.list_asker_addr = src_addr
 
+    @ray_method('/ray/server/list_sessions', None)
+    def rayServerListSessionsWithOptions(self, path, args, types, src_addr):
+        if not ray.areTheyAllString(args):
+            self.unknownMessage(path, types, src_addr)
+            return False
+
+        self.list_asker_addr = src_addr
+
+    @ray_method('/ray/server/list_sessions_details', None)
+    def rayServerListSessionsDetails(self, path, args, types, src_addr):
+        if not ray.areTheyAllString(args):
+            self.unknownMessage(path, types, src_addr)
+            return False
+
     @ray_method('/ray/server/new_session', None)
     def rayServerNewSession(self, path, args, types, src_addr):
         if not ray.areTheyAllString(args):
@@ -690,6 +763,8 @@ class OscServerThread(ClientCommunicating):
                 self.option_snapshots = option_value
             elif option == 'session_scripts':
                 self.option_session_scripts = option_value
+            elif option == 'hardlink_media':
+                self.option_hardlink_media = option_value
 
         options = self.getOptions()
 
@@ -714,6 +789,8 @@ class OscServerThread(ClientCommunicating):
             option_value = self.option_snapshots
         elif option == 'session_scripts':
             option_value = self.option_session_scripts
+        elif option == 'hardlink_media':
+            option_value = self.option_hardlink_media
         else:
             self.send(src_addr, '/error', path, ray.Err.GENERAL_ERROR,
                       "option \"%s\" doesn't exists" % option)
@@ -759,6 +836,13 @@ class OscServerThread(ClientCommunicating):
     def raySessionTakeSnapshot(self, path, args, types, src_addr):
         pass
 
+    @ray_method('/ray/session/clean_snapshots', '')
+    def raySessionCleanSnapshots(self, path, args, types, src_addr):
+        if not self.session.path:
+            self.send(src_addr, "/error", path, ray.Err.NO_SESSION_OPEN,
+                      "No session to clean snapshots.")
+            return False
+
     @ray_method('/ray/session/close', '')
     def raySessionClose(self, path, args, types, src_addr):
         if not self.session.path:
@@ -1223,7 +1307,8 @@ class OscServerThread(ClientCommunicating):
             + ray.Option.DESKTOPS_MEMORY * self.option_desktops_memory
             + ray.Option.HAS_GIT * self.option_has_git
             + ray.Option.SNAPSHOTS * self.option_snapshots
-            + ray.Option.SESSION_SCRIPTS * self.option_session_scripts)
+            + ray.Option.SESSION_SCRIPTS * self.option_session_scripts
+            + ray.Option.HARDLINK_MEDIA * self.option_hardlink_media)
 
         return options
 
@@ -1316,3 +1401,12 @@ class OscServerThread(ClientCommunicating):
             if ray.areSameOscPort(gui_addr.url, addr.url):
                 return True
         return False
+
+    def acceptsReplyChunks(self, addr):
+        if self.isGuiAddress(addr):
+            return True
+
+        for controller in self.controller_list:
+            if ray.areSameOscPort(controller.addr.url, addr.url):
+                return True
+        return False
@@ -13,6 +13,8 @@ from daemon_tools import (initDaemonTools, RS, getCodeRoot,
 from osc_server_thread import OscServerThread
 from multi_daemon_file import MultiDaemonFile
 from session_signaled import SignaledSession
+from session_index import SessionIndex
+from client_stats import ClientStats
 
 def signalHandler(sig, frame):
     if sig in (signal.SIGINT, signal.SIGTERM):
@@ -66,6 +68,12 @@ if __name__ == '__main__':
             sys.exit(1)
 
 
+    #index sessions in session_root
+    session_index = SessionIndex(session_root)
+
+    #durations of clients announce, open and save
+    client_stats = ClientStats()
+
     #create session
     session = SignaledSession(session_root)
 
@@ -129,6 +137,10 @@ if __name__ == '__main__':
     #update multi_daemon_file without this server
     multi_daemon_file.quit()
 
+    #keep session index for next start
+    session_index.writeCacheFile()
+    client_stats.writeFile()
+
     #save RS.settings
     RS.settings.setValue('daemon/non_active_list', RS.non_active_clients)
     RS.settings.setValue('daemon/favorites', RS.favorites)
@@ -140,6 +152,8 @@ if __name__ == '__main__':
                              server.option_desktops_memory)
         RS.settings.setValue('daemon/session_scripts',
                              server.option_session_scripts)
+        RS.settings.setValue('daemon/hardlink_media',
+                             server.option_hardlink_media)
 
     RS.settings.sync()
 
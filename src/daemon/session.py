@@ -6,6 +6,7 @@ import shutil
 import string
 import subprocess
 import sys
+import time
 from liblo import Address
 from PyQt5.QtCore import QCoreApplication, QTimer, QProcess
 from PyQt5.QtXml  import QDomDocument
@@ -16,10 +17,12 @@ from bookmarker        import BookMarker
 from desktops_memory   import DesktopsMemory
 from snapshoter        import Snapshoter
 from multi_daemon_file import MultiDaemonFile
+from session_index     import SessionIndex
 from signaler          import Signaler
 from server_sender     import ServerSender
 from file_copier       import FileCopier
 from client            import Client
+import client_stats
 from scripter          import StepScripter
 from daemon_tools import (TemplateRoots, RS, Terminal,
                           getGitDefaultUnAndIgnored)
@@ -41,6 +44,10 @@ class Session(ServerSender):
         self.is_dummy = False
 
         self.clients = []
+        # indexes of self.clients, rebuilt when a client is not found.
+        # They have to be reset when clients are removed.
+        self._clients_by_id = {}
+        self._clients_by_url = {}
         self.future_clients = []
         self.trashed_clients = []
         self.future_trashed_clients = []
@@ -104,6 +111,10 @@ class Session(ServerSender):
         if multi_daemon_file:
             multi_daemon_file.update()
 
+        session_index = SessionIndex.getInstance()
+        if session_index:
+            session_index.setRoot(self.root)
+
     def setName(self, session_name):
         self.name = session_name
 
@@ -122,11 +133,17 @@ class Session(ServerSender):
         if self.is_dummy:
             return
 
+        self.snapshoter.setSessionPath(self.path)
+
         multi_daemon_file = MultiDaemonFile.getInstance()
         if multi_daemon_file:
             multi_daemon_file.update()
 
         if self.path:
+            session_index = SessionIndex.getInstance()
+            if session_index:
+                session_index.setLastOpened(self.path)
+
             server = self.getServer()
             if server and server.option_bookmark_session:
                 self.bookmarker.setDaemonPort(server.port)
@@ -139,6 +156,10 @@ class Session(ServerSender):
         self.future_trashed_clients.clear()
         self.future_notes = ""
 
+    def hasLinkMediaOption(self):
+        server = self.getServer()
+        return bool(server and server.option_hardlink_media)
+
     def getShortPath(self):
         if self.path.startswith("%s/" % self.root):
             return self.path.replace("%s/" % self.root, '', 1)
@@ -156,10 +177,24 @@ class Session(ServerSender):
 
         return spath
 
+    def resetClientsIndex(self):
+        self._clients_by_id = {}
+        self._clients_by_url = {}
+
+    def findClient(self, client_id):
+        client = self._clients_by_id.get(client_id)
+        if client is not None and client.client_id == client_id:
+            return client
+
+        # new client or client_id changed
+        self._clients_by_id = dict([(client.client_id, client)
+                                    for client in self.clients])
+        return self._clients_by_id.get(client_id)
+
     def getClient(self, client_id):
-        for client in self.clients:
-            if client.client_id == client_id:
-                return client
+        client = self.findClient(client_id)
+        if client is not None:
+            return client
 
         sys.stderr.write("client_id %s is not in ray-daemon session\n")
 
@@ -167,9 +202,15 @@ class Session(ServerSender):
         if not addr:
             return None
 
-        for client in self.clients:
-            if client.addr and client.addr.url == addr.url:
-                return client
+        client = self._clients_by_url.get(addr.url)
+        if client is not None and client.addr and client.addr.url == addr.url:
+            return client
+
+        # client announced since last index
+        self._clients_by_url = dict([(client.addr.url, client)
+                                     for client in self.clients
+                                     if client.addr])
+        return self._clients_by_url.get(addr.url)
 
     def newClient(self, executable, client_id=None):
         client = Client(self)
@@ -207,6 +248,7 @@ class Session(ServerSender):
             client.sendGuiClientProperties(removed=True)
 
         self.clients.remove(client)
+        self.resetClientsIndex()
 
     def removeClient(self, client):
         client.terminateScripts()
@@ -219,6 +261,7 @@ class Session(ServerSender):
         client.setStatus(ray.ClientStatus.REMOVED)
 
         self.clients.remove(client)
+        self.resetClientsIndex()
 
     def restoreClient(self, client)->bool:
         client.sent_to_gui = False
@@ -471,9 +514,14 @@ class OperatingSession(Session):
         self.expected_clients = []
 
         self.timer_launch = QTimer()
-        self.timer_launch.setInterval(100)
+        self.timer_launch.setInterval(50)
         self.timer_launch.timeout.connect(self.timerLaunchTimeOut)
         self.clients_to_launch = []
+        # [client, launch_time] of clients launched but not settled
+        self.launching_clients = []
+
+        # clients waiting for other clients to save before saving
+        self.clients_to_save = []
 
         self.timer_quit = QTimer()
         self.timer_quit.setInterval(100)
@@ -574,6 +622,60 @@ class OperatingSession(Session):
         else:
             follow()
 
+    def getSaveDependencies(self, client):
+        # expected clients which have to save before client
+        save_after_ids = client.getSaveAfterIds()
+        return [c for c in self.expected_clients
+                if c.client_id in save_after_ids]
+
+    def getSaveChainTime(self, client, chain_times, visiting):
+        # learned save timeout of client added to the longest chain
+        # of save timeouts of clients it has to wait for.
+        if client in chain_times:
+            return chain_times[client]
+
+        if client in visiting:
+            # circular dependencies, clients will save together
+            return 0
+
+        visiting.add(client)
+        deps_time = max([self.getSaveChainTime(c, chain_times, visiting)
+                         for c in self.getSaveDependencies(client)],
+                        default=0)
+        visiting.discard(client)
+
+        chain_times[client] = (client.getTimeout(client_stats.SAVE, 10000)
+                               + deps_time)
+        return chain_times[client]
+
+    def getSaveWaitTime(self):
+        # clients with save dependencies save one after another
+        chain_times = {}
+        return max([self.getSaveChainTime(client, chain_times, set())
+                    for client in self.expected_clients], default=10000)
+
+    def releaseClientsToSave(self):
+        self.clients_to_save = [c for c in self.clients_to_save
+                                if c in self.expected_clients]
+
+        while self.clients_to_save:
+            released = [c for c in self.clients_to_save
+                        if not self.getSaveDependencies(c)]
+
+            if not released:
+                if len(self.clients_to_save) < len(self.expected_clients):
+                    # wait for other clients replies
+                    return
+
+                # circular dependencies, save all
+                Terminal.warning("circular save dependencies between %s"
+                    % ' '.join([c.client_id for c in self.clients_to_save]))
+                released = self.clients_to_save.copy()
+
+            for client in released:
+                self.clients_to_save.remove(client)
+                client.save()
+
     def endTimerIfLastExpected(self, client):
         if self.wait_for == ray.WaitFor.QUIT and client in self.clients:
             self.removeClient(client)
@@ -581,6 +683,9 @@ class OperatingSession(Session):
         if client in self.expected_clients:
             self.expected_clients.remove(client)
 
+            if self.wait_for == ray.WaitFor.REPLY and self.clients_to_save:
+                self.releaseClientsToSave()
+
             if self.timer_redondant:
                 self.timer.start()
                 if self.timer_waituser_progress.isActive():
@@ -679,13 +784,53 @@ class OperatingSession(Session):
         self.steps_order.__delitem__(0)
         next_function(*arguments)
 
-    def timerLaunchTimeOut(self):
+    def getLaunchGroup(self, client):
+        launch_first = RS.settings.value(
+            'daemon/launch_first',
+            ['ray-jackpatch', 'non-mixer', 'jack_mixer'], type=list)
+
+        executable = os.path.basename(client.executable_path)
+        if executable in launch_first:
+            return launch_first.index(executable)
+        return len(launch_first)
+
+    def startLaunchingClients(self):
+        # clients of a launch group are started together,
+        # once clients of previous groups are settled.
+        self.clients_to_launch.sort(key=self.getLaunchGroup)
+        self.launching_clients.clear()
+        self.timerLaunchTimeOut()
+
         if self.clients_to_launch:
-            self.clients_to_launch[0].start()
-            self.clients_to_launch.__delitem__(0)
+            self.timer_launch.start()
+
+    def timerLaunchTimeOut(self):
+        self.launching_clients = [
+            lc for lc in self.launching_clients
+            if not lc[0].isLaunchSettled(lc[1])]
+
+        concurrency = max(1, RS.settings.value(
+            'daemon/launch_concurrency', 8, type=int))
+
+        while (self.clients_to_launch
+                and len(self.launching_clients) < concurrency):
+            client = self.clients_to_launch[0]
+            group = self.getLaunchGroup(client)
+
+            for launching_client, launch_time in self.launching_clients:
+                if self.getLaunchGroup(launching_client) < group:
+                    break
+            else:
+                self.clients_to_launch.__delitem__(0)
+                client.start()
+                self.launching_clients.append([client, time.time()])
+                continue
+
+            break
 
         if not self.clients_to_launch:
             self.timer_launch.stop()
+            self.launching_clients.clear()
 
     def timerQuitTimeOut(self):
         if self.clients_to_quit:
@@ -867,10 +1012,20 @@ class OperatingSession(Session):
         self.sendGuiMessage(_translate('GUIMSG', '-- Saving session %s --')
                                 % ray.highlightText(self.getShortPath()))
 
+        self.clients_to_save.clear()
+
         for client in self.clients:
             if client.canSaveNow():
                 self.expected_clients.append(client)
-            client.save()
+
+        for client in self.clients:
+            if (client in self.expected_clients
+                    and self.getSaveDependencies(client)):
+                self.clients_to_save.append(client)
+            else:
+                client.save()
+
+        self.releaseClientsToSave()
 
         if self.expected_clients:
             if len(self.expected_clients) == 1:
@@ -882,9 +1037,29 @@ class OperatingSession(Session):
                     _translate('GUIMSG', 'waiting for %i clients to save...')
                         % len(self.expected_clients))
 
-        self.waitAndGoTo(10000, (self.save_substep1, outing), ray.WaitFor.REPLY)
+        self.waitAndGoTo(self.getSaveWaitTime(),
+                         (self.save_substep1, outing),
+                         ray.WaitFor.REPLY)
 
     def save_substep1(self, outing=False):
+        if self.clients_to_save:
+            # dependencies didn't reply in time, save what can be saved
+            # and wait for these clients.
+            released = [c for c in self.clients_to_save
+                        if c in self.expected_clients]
+            self.clients_to_save.clear()
+
+            for client in released:
+                client.save()
+
+            if released:
+                self.waitAndGoTo(
+                    max([c.getTimeout(client_stats.SAVE, 10000)
+                         for c in released]),
+                    (self.save_substep1, outing),
+                    ray.WaitFor.REPLY)
+                return
+
         self.cleanExpected()
 
         if outing:
@@ -1020,11 +1195,23 @@ class OperatingSession(Session):
         if not force:
             server = self.getServer()
             if not (server and server.option_snapshots
-                    and not self.snapshoter.isAutoSnapshotPrevented()
-                    and self.snapshoter.hasChanges()):
+                    and not self.snapshoter.isAutoSnapshotPrevented()):
                 self.nextFunction()
                 return
 
+            self.snapshoter.hasChanges(
+                functools.partial(self.snapshot_substep0, snapshot_name,
+                                  rewind_snapshot, outing))
+            return
+
+        self.snapshot_substep0(snapshot_name, rewind_snapshot, outing, True)
+
+    def snapshot_substep0(self, snapshot_name, rewind_snapshot, outing,
+                          has_changes):
+        if not has_changes:
+            self.nextFunction()
+            return
+
         if outing:
             self.setServerStatus(ray.ServerStatus.OUT_SNAPSHOT)
         else:
@@ -1046,6 +1233,44 @@ class OperatingSession(Session):
         self.setServerStatus(ray.ServerStatus.READY)
         self.sendReply("Snapshot taken.")
 
+    def cleanSnapshots(self):
+        self.setServerStatus(ray.ServerStatus.SNAPSHOT)
+        self.sendGuiMessage(
+            _translate('GUIMSG', "snapshots cleaning started..."))
+        self.snapshoter.clean(self.cleanSnapshots_substep1,
+                              self.cleanSnapshotsError)
+
+    def cleanSnapshots_substep1(self, n_removed):
+        self.sendGuiMessage(
+            _translate('GUIMSG', '...snapshots cleaned, %i removed.')
+                % n_removed)
+        self.nextFunction()
+
+    def cleanSnapshotsDone(self):
+        self.setServerStatus(ray.ServerStatus.READY)
+        self.sendReply("Snapshots cleaned.")
+
+    def cleanSnapshotsError(self, err, info_str=''):
+        m = _translate('Snapshot Error', "Unknown error")
+        if err == ray.Err.SUBPROCESS_CRASH:
+            m = _translate('Snapshot Error',
+                           "git crashes.\n%s") % info_str
+        elif err == ray.Err.SUBPROCESS_EXITCODE:
+            m = _translate('Snapshot Error',
+                           "git exit with an error code.\n%s") % info_str
+        elif err == ray.Err.CREATE_FAILED:
+            m = _translate('Snapshot Error',
+                           "impossible to write history file.")
+        elif err == ray.Err.ABORT_ORDERED:
+            m = _translate('Snapshot Error',
+                           "%s aborted by user") % info_str
+        self.message(m)
+        self.sendGuiMessage(m)
+        self.sendError(err, m)
+
+        self.setServerStatus(ray.ServerStatus.READY)
+        self.steps_order.clear()
+
     def snapshotError(self, err_snapshot, info_str=''):
         m = _translate('Snapshot Error', "Unknown error")
         if err_snapshot == ray.Err.SUBPROCESS_UNTERMINATED:
@@ -1205,6 +1430,7 @@ class OperatingSession(Session):
     def closeDone(self):
         self.cleanExpected()
         self.clients.clear()
+        self.resetClientsIndex()
         self.setPath('')
         self.sendGui("/ray/gui/session/name", "", "")
         self.noFuture()
@@ -1216,6 +1442,7 @@ class OperatingSession(Session):
     def abortDone(self):
         self.cleanExpected()
         self.clients.clear()
+        self.resetClientsIndex()
         self.setPath('')
         self.sendGui("/ray/gui/session/name", "", "")
         self.noFuture()
@@ -1257,8 +1484,8 @@ for better organization.""")
 
     def initSnapshot(self, spath, snapshot):
         self.setServerStatus(ray.ServerStatus.REWIND)
-        if self.snapshoter.load(spath, snapshot, self.initSnapshotError):
-            self.nextFunction()
+        self.snapshoter.load(spath, snapshot, self.nextFunction,
+                             self.initSnapshotError)
 
     def initSnapshotError(self, err, info_str=''):
         m = _translate('Snapshot Error', "Snapshot error")
@@ -1274,6 +1501,9 @@ for better organization.""")
         elif err == ray.Err.NO_SUCH_FILE:
             m = _translate('Snapshot Error',
                            "error reading file:\n%s") % info_str
+        elif err == ray.Err.ABORT_ORDERED:
+            m = _translate('Snapshot Error',
+                           "%s aborted by user") % info_str
         self.message(m)
         self.sendGuiMessage(m)
         self.sendError(err, m)
@@ -1325,7 +1555,8 @@ for better organization.""")
                                           spath,
                                           self.duplicate_substep2,
                                           self.duplicateAborted,
-                                          [new_session_full_name])
+                                          [new_session_full_name],
+                                          link_media=self.hasLinkMediaOption())
 
     def duplicate_substep2(self, new_session_full_name):
         self.cleanExpected()
@@ -1365,6 +1596,8 @@ for better organization.""")
                             % (self.root, TemplateRoots.net_session_name)
 
         spath = "%s/%s" % (template_root, template_name)
+        link_media = self.hasLinkMediaOption()
+        sync = False
 
         #overwrite existing template
         if os.path.isdir(spath):
@@ -1378,7 +1611,11 @@ for better organization.""")
                 self.setServerStatus(ray.ServerStatus.READY)
                 return
 
-            shutil.rmtree(spath)
+            # hardlinked media must never be rewritten in place
+            if link_media:
+                shutil.rmtree(spath)
+            else:
+                sync = True
 
         if not os.path.exists(template_root):
             os.makedirs(template_root)
@@ -1405,11 +1642,22 @@ for better organization.""")
         self.sendGuiMessage(
             _translate('GUIMSG', 'start session copy to template...'))
 
+        if sync:
+            self.file_copier.startSessionSync(
+                self.path, spath,
+                self.saveSessionTemplate_substep_1,
+                self.saveSessionTemplateAborted,
+                [template_name, net],
+                with_blocks=RS.settings.value(
+                    'daemon/sync_block_checksums', False, type=bool))
+            return
+
         self.file_copier.startSessionCopy(self.path,
                                           spath,
                                           self.saveSessionTemplate_substep_1,
                                           self.saveSessionTemplateAborted,
-                                          [template_name, net])
+                                          [template_name, net],
+                                          link_media=link_media)
 
     def saveSessionTemplate_substep_1(self, template_name, net):
         tp_mode = ray.Template.SESSION_SAVE
@@ -1427,7 +1675,7 @@ for better organization.""")
         self.sendReply("Saved as template.")
         self.setServerStatus(ray.ServerStatus.READY)
 
-    def saveSessionTemplateAborted(self, template_name):
+    def saveSessionTemplateAborted(self, template_name, net=False):
         self.steps_order.clear()
         self.sendReply("Session template aborted")
         self.setServerStatus(ray.ServerStatus.READY)
@@ -1482,7 +1730,8 @@ for better organization."""))
                                           spath,
                                           self.prepareTemplate_substep1,
                                           self.prepareTemplateAborted,
-                                          [new_session_full_name])
+                                          [new_session_full_name],
+                                          link_media=self.hasLinkMediaOption())
 
     def prepareTemplate_substep1(self, new_session_full_name):
         self.adjustFilesAfterCopy(new_session_full_name,
@@ -1853,9 +2102,28 @@ for better organization."""))
         #* dumb clients will never send an 'announce message', so we need
         #* to give up waiting on them fairly soon. */
 
-        self.timer_launch.start()
+        n_launch = len(self.clients_to_launch)
+        self.startLaunchingClients()
+
+        # learned timeouts count from client launch,
+        # clients can be delayed by the launch scheduler.
+        default_time = 4000 + len(self.expected_clients) * 1000
+        concurrency = max(1, RS.settings.value(
+            'daemon/launch_concurrency', 8, type=int))
+        launch_delay = (1000 * math.ceil(n_launch / concurrency)
+                        + 1000 * len(set([self.getLaunchGroup(c)
+                                          for c in self.expected_clients])))
+
+        wait_time = 0
+        for client in self.expected_clients:
+            learned_time = client.getTimeout(client_stats.ANNOUNCE, 0)
+            if learned_time:
+                wait_time = max(wait_time, learned_time + launch_delay)
+            else:
+                wait_time = max(wait_time, default_time)
 
-        wait_time = 4000 + len(self.expected_clients) * 1000
+        if not self.expected_clients:
+            wait_time = default_time
 
         self.waitAndGoTo(wait_time, self.load_substep4, ray.WaitFor.ANNOUNCE)
 
@@ -1889,9 +2157,16 @@ for better organization."""))
                             'waiting for %s clients to load their project...')
                         % n_expected)
 
-        wait_time = 8000 + len(self.expected_clients) * 2000
+        default_time = 8000 + len(self.expected_clients) * 2000
+        wait_time = 0
         for client in self.expected_clients:
-            wait_time = max(2 * 1000 * client.last_open_duration, wait_time)
+            client_default = int(max(2 * 1000 * client.last_open_duration,
+                                     default_time))
+            wait_time = max(client.getTimeout(client_stats.OPEN,
+                                              client_default),
+                            wait_time)
+        if not self.expected_clients:
+            wait_time = default_time
 
         self.waitAndGoTo(wait_time, self.load_substep5, ray.WaitFor.REPLY)
 
@@ -2154,10 +2429,13 @@ for better organization.""")
 
     def loadClientSnapshot(self, client_id, snapshot):
         self.setServerStatus(ray.ServerStatus.REWIND)
-        if self.snapshoter.loadClientExclusive(client_id, snapshot,
-                                               self.loadClientSnapshotError):
-            self.setServerStatus(ray.ServerStatus.READY)
-            self.nextFunction()
+        self.snapshoter.loadClientExclusive(client_id, snapshot,
+                                            self.loadClientSnapshot_substep1,
+                                            self.loadClientSnapshotError)
+
+    def loadClientSnapshot_substep1(self):
+        self.setServerStatus(ray.ServerStatus.READY)
+        self.nextFunction()
 
     def loadClientSnapshotError(self, err, info_str=''):
         m = _translate('Snapshot Error', "Snapshot error")
@@ -2173,6 +2451,9 @@ for better organization.""")
         elif err == ray.Err.NO_SUCH_FILE:
             m = _translate('Snapshot Error',
                            "error reading file:\n%s") % info_str
+        elif err == ray.Err.ABORT_ORDERED:
+            m = _translate('Snapshot Error',
+                           "%s aborted by user") % info_str
         self.message(m)
         self.sendGuiMessage(m)
         self.sendError(err, m)
@@ -0,0 +1,781 @@
+import fnmatch
+import hashlib
+import os
+import time
+from collections import deque
+from PyQt5.QtCore import QTimer, QFileSystemWatcher
+from PyQt5.QtXml import QDomDocument
+
+import ray
+from daemon_tools import Terminal, getAppCachePath
+from server_sender import ServerSender
+from osc_server_thread import ChunkedReply
+
+instance = None
+
+SESSION_FILES = ('raysession.xml', 'session.nsm')
+NOTES_EXCERPT_LENGTH = 240
+
+def getMtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+def getDirSize(path):
+    size = 0
+
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                size += getDirSize(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+
+    return size
+
+
+class SessionDetails:
+    def __init__(self):
+        self.session_mtime = 0.0
+        self.notes_mtime = 0.0
+        self.snapshots_mtime = 0.0
+
+        self.n_clients = 0
+        self.executables = []
+        self.notes = ''
+        self.size = 0
+        self.n_snapshots = 0
+
+    def readSessionFile(self, spath):
+        self.n_clients = 0
+        self.executables.clear()
+
+        ray_file_path = "%s/raysession.xml" % spath
+
+        if os.path.isfile(ray_file_path):
+            xml = QDomDocument()
+            try:
+                file = open(ray_file_path, 'r')
+                xml.setContent(file.read())
+                file.close()
+            except:
+                return
+
+            nodes = xml.documentElement().childNodes()
+            for i in range(nodes.count()):
+                node = nodes.at(i)
+                if node.toElement().tagName() != 'Clients':
+                    continue
+
+                clients_xml = node.toElement().childNodes()
+                for j in range(clients_xml.count()):
+                    executable = clients_xml.at(j).toElement().attribute(
+                                                                'executable')
+                    self.n_clients += 1
+                    if executable and not executable in self.executables:
+                        self.executables.append(executable)
+            return
+
+        try:
+            file = open("%s/session.nsm" % spath, 'r')
+            contents = file.read()
+            file.close()
+        except:
+            return
+
+        for line in contents.split('\n'):
+            elements = line.split(':')
+            if len(elements) >= 3:
+                self.n_clients += 1
+                if not elements[1] in self.executables:
+                    self.executables.append(elements[1])
+
+    def readNotes(self, spath):
+        self.notes = ''
+
+        try:
+            file = open("%s/%s" % (spath, ray.NOTES_PATH), 'r')
+            self.notes = file.read(NOTES_EXCERPT_LENGTH).replace('\n', ' ')
+            file.close()
+        except:
+            return
+
+    def countSnapshots(self, spath):
+        tags = set()
+        gitdir = "%s/.ray-snapshots" % spath
+
+        try:
+            tags.update(os.listdir("%s/refs/tags" % gitdir))
+        except OSError:
+            pass
+
+        try:
+            file = open("%s/packed-refs" % gitdir, 'r')
+            for line in file.read().split('\n'):
+                sha, space, ref = line.partition(' ')
+                if ref.startswith('refs/tags/'):
+                    tags.add(ref.replace('refs/tags/', '', 1))
+            file.close()
+        except:
+            pass
+
+        self.n_snapshots = len(tags)
+
+    def update(self, spath, session_mtime):
+        notes_mtime = getMtime("%s/%s" % (spath, ray.NOTES_PATH))
+        snapshots_mtime = max(
+            getMtime("%s/.ray-snapshots/refs/tags" % spath),
+            getMtime("%s/.ray-snapshots/packed-refs" % spath))
+
+        changed = False
+
+        if session_mtime != self.session_mtime:
+            self.readSessionFile(spath)
+
+        if notes_mtime != self.notes_mtime:
+            self.readNotes(spath)
+            changed = True
+
+        if snapshots_mtime != self.snapshots_mtime:
+            self.countSnapshots(spath)
+            changed = True
+
+        if (session_mtime != self.session_mtime
+                or snapshots_mtime != self.snapshots_mtime):
+            self.size = getDirSize(spath)
+            changed = True
+
+        self.session_mtime = session_mtime
+        self.notes_mtime = notes_mtime
+        self.snapshots_mtime = snapshots_mtime
+
+        return changed
+
+    def getMessage(self, rel_path, last_opened):
+        return "\n".join((
+            "session:%s" % rel_path,
+            "clients:%i" % self.n_clients,
+            "executables:%s" % ' '.join(self.executables),
+            "size:%i" % self.size,
+            "last_save:%i" % int(self.session_mtime),
+            "last_opened:%i" % int(last_opened),
+            "snapshots:%i" % self.n_snapshots,
+            "notes:%s" % self.notes))
+
+    def readXml(self, el):
+        try:
+            self.session_mtime = float(el.attribute('session_mtime'))
+            self.notes_mtime = float(el.attribute('notes_mtime'))
+            self.snapshots_mtime = float(el.attribute('snapshots_mtime'))
+            self.n_clients = int(el.attribute('clients'))
+            self.size = int(el.attribute('size'))
+            self.n_snapshots = int(el.attribute('snapshots'))
+        except ValueError:
+            return False
+
+        self.executables = [
+            e for e in el.attribute('executables').split(' ') if e]
+        self.notes = el.attribute('notes')
+        return True
+
+    def writeXml(self, el):
+        el.setAttribute('session_mtime', repr(self.session_mtime))
+        el.setAttribute('notes_mtime', repr(self.notes_mtime))
+        el.setAttribute('snapshots_mtime', repr(self.snapshots_mtime))
+        el.setAttribute('clients', self.n_clients)
+        el.setAttribute('executables', ' '.join(self.executables))
+        el.setAttribute('notes', self.notes)
+        el.setAttribute('size', str(self.size))
+        el.setAttribute('snapshots', self.n_snapshots)
+
+
+class SessionIndex(ServerSender):
+    def __init__(self, root=''):
+        ServerSender.__init__(self)
+        self.root = ''
+
+        # relative dir path -> dir mtime at last scan
+        self._dirs = {}
+        # relative dir path -> set of relative sub dir paths
+        self._children = {}
+        self._sessions = set()
+        # relative session path -> time of last session open
+        self._last_opened = {}
+        # relative session path -> SessionDetails
+        self._details = {}
+
+        # sessions in the order they are found during first scan
+        self._found = []
+        self._listers = []
+
+        self._to_scan = deque()
+        self._is_ready = False
+        self._cache_dirty = False
+
+        self.watcher = QFileSystemWatcher()
+        self.watcher.directoryChanged.connect(self.directoryChanged)
+        self._watched = set()
+        self._unwatched = set()
+
+        self.scan_timer = QTimer()
+        self.scan_timer.setInterval(0)
+        self.scan_timer.timeout.connect(self.scanStep)
+
+        self.cache_timer = QTimer()
+        self.cache_timer.setInterval(2000)
+        self.cache_timer.setSingleShot(True)
+        self.cache_timer.timeout.connect(self.writeCacheFile)
+
+        global instance
+        instance = self
+
+        if root:
+            self.setRoot(root)
+
+    @staticmethod
+    def getInstance():
+        return instance
+
+    def getFullPath(self, rel_path):
+        if not rel_path:
+            return self.root
+        return "%s/%s" % (self.root, rel_path)
+
+    def getCacheFilePath(self):
+        root_hash = hashlib.sha1(self.root.encode()).hexdigest()[:16]
+        return "%s/session_index_%s.xml" % (getAppCachePath(), root_hash)
+
+    def setRoot(self, root):
+        if root == self.root:
+            return
+
+        if self.root and self._cache_dirty:
+            self.writeCacheFile()
+
+        self.clear()
+        self.root = root
+
+        if not self.root:
+            return
+
+        if self.readCacheFile():
+            # sessions are known from the cache,
+            # only check directories whose mtime changed since.
+            self._is_ready = True
+            self._to_scan.extend([(rel_path, True) for rel_path in self._dirs])
+        else:
+            self._to_scan.append(('', False))
+
+        self.scan_timer.start()
+
+    def clear(self):
+        self.scan_timer.stop()
+
+        # listers can't continue with another root
+        for lister in self._listers.copy():
+            lister.cancel()
+
+        if self._watched:
+            self.watcher.removePaths(
+                [self.getFullPath(rel_path) for rel_path in self._watched])
+
+        self._dirs.clear()
+        self._children.clear()
+        self._sessions.clear()
+        self._last_opened.clear()
+        self._details.clear()
+        self._found.clear()
+        self._watched.clear()
+        self._unwatched.clear()
+        self._to_scan.clear()
+        self._is_ready = False
+        self._cache_dirty = False
+
+    def isReady(self):
+        return self._is_ready
+
+    def watchDir(self, rel_path):
+        if rel_path in self._watched:
+            return
+
+        if self.watcher.addPath(self.getFullPath(rel_path)):
+            self._watched.add(rel_path)
+            self._unwatched.discard(rel_path)
+        else:
+            # inotify not available or out of watches,
+            # this dir will be checked with its mtime.
+            self._unwatched.add(rel_path)
+
+    def forgetDir(self, rel_path):
+        if not rel_path in self._dirs:
+            return
+
+        for child in list(self._children.get(rel_path, ())):
+            self.forgetDir(child)
+
+        self._dirs.pop(rel_path)
+        self._children.pop(rel_path, None)
+        self._sessions.discard(rel_path)
+        self._last_opened.pop(rel_path, None)
+        self._details.pop(rel_path, None)
+        self._unwatched.discard(rel_path)
+
+        parent = os.path.dirname(rel_path)
+        if parent in self._children:
+            self._children[parent].discard(rel_path)
+
+        if rel_path in self._watched:
+            self._watched.discard(rel_path)
+            self.watcher.removePath(self.getFullPath(rel_path))
+
+        self.setCacheDirty()
+
+    def scanDir(self, rel_path, check_mtime=False):
+        full_path = self.getFullPath(rel_path)
+
+        try:
+            mtime = os.stat(full_path).st_mtime
+        except OSError:
+            self.forgetDir(rel_path)
+            return
+
+        self.watchDir(rel_path)
+
+        if check_mtime and self._dirs.get(rel_path) == mtime:
+            return
+
+        try:
+            entries = list(os.scandir(full_path))
+        except OSError:
+            self.forgetDir(rel_path)
+            return
+
+        self._dirs[rel_path] = mtime
+
+        is_session = False
+        if rel_path:
+            for entry in entries:
+                if entry.name in SESSION_FILES and not entry.is_dir():
+                    is_session = True
+                    break
+
+        sub_dirs = set()
+
+        if is_session:
+            if not rel_path in self._sessions:
+                self._sessions.add(rel_path)
+                if not self._is_ready:
+                    self._found.append(rel_path)
+        else:
+            self._sessions.discard(rel_path)
+            self._details.pop(rel_path, None)
+
+            # sub directories of a session are not scanned
+            for entry in entries:
+                if (not entry.name.startswith('.')
+                        and entry.is_dir(follow_symlinks=False)):
+                    if rel_path:
+                        sub_dirs.add("%s/%s" % (rel_path, entry.name))
+                    else:
+                        sub_dirs.add(entry.name)
+
+        old_sub_dirs = self._children.get(rel_path, set())
+        self._children[rel_path] = set(old_sub_dirs)
+
+        for sub_dir in old_sub_dirs - sub_dirs:
+            self.forgetDir(sub_dir)
+
+        for sub_dir in sub_dirs - old_sub_dirs:
+            self._children[rel_path].add(sub_dir)
+            self._to_scan.append((sub_dir, False))
+
+        self.setCacheDirty()
+
+    def scanStep(self):
+        for i in range(64):
+            if not self._to_scan:
+                break
+
+            rel_path, check_mtime = self._to_scan.popleft()
+            self.scanDir(rel_path, check_mtime)
+
+        if not self._to_scan:
+            self.scan_timer.stop()
+            self._is_ready = True
+
+        for lister in self._listers.copy():
+            if self._is_ready:
+                lister.finish()
+            else:
+                lister.update()
+
+        if self._is_ready:
+            self._found.clear()
+
+    def directoryChanged(self, full_path):
+        if full_path == self.root:
+            rel_path = ''
+        elif full_path.startswith(self.root + '/'):
+            rel_path = full_path.replace(self.root + '/', '', 1)
+        else:
+            return
+
+        if not rel_path in self._dirs:
+            return
+
+        self._to_scan.append((rel_path, False))
+        self.scan_timer.start()
+
+    def checkUnwatched(self):
+        if not self._unwatched:
+            return
+
+        for rel_path in self._unwatched:
+            self._to_scan.append((rel_path, True))
+        self.scan_timer.start()
+
+    def getSortedSessions(self, sort_key='name', reverse=False):
+        if sort_key == 'modified':
+            session_list = sorted(self._sessions,
+                                  key=self.getSessionMtime, reverse=True)
+        elif sort_key == 'opened':
+            session_list = sorted(
+                self._sessions,
+                key=lambda s: self._last_opened.get(s, 0.0), reverse=True)
+        else:
+            session_list = sorted(self._sessions, key=str.lower)
+
+        if reverse:
+            session_list.reverse()
+
+        return session_list
+
+    def getSessionMtime(self, rel_path):
+        for session_file in SESSION_FILES:
+            mtime = getMtime("%s/%s" % (self.getFullPath(rel_path),
+                                        session_file))
+            if mtime:
+                return mtime
+
+        return 0.0
+
+    def getDetailsMessage(self, rel_path):
+        details = self._details.get(rel_path)
+        if details is None:
+            details = SessionDetails()
+            self._details[rel_path] = details
+
+        if details.update(self.getFullPath(rel_path),
+                          self.getSessionMtime(rel_path)):
+            self.setCacheDirty()
+
+        return details.getMessage(rel_path,
+                                  self._last_opened.get(rel_path, 0.0))
+
+    def setLastOpened(self, session_path):
+        if not (self.root and session_path.startswith(self.root + '/')):
+            return
+
+        rel_path = session_path.replace(self.root + '/', '', 1)
+        self._last_opened[rel_path] = time.time()
+        self.setCacheDirty()
+
+    def listSessions(self, src_addr, path, options, with_details=False,
+                     nsm_reply=False):
+        lister = SessionLister(self, src_addr, path, options, with_details,
+                               nsm_reply)
+
+        if not self.root:
+            lister.end()
+            return
+
+        self._listers.append(lister)
+
+        if self._is_ready:
+            self.checkUnwatched()
+            lister.finish()
+            return
+
+        lister.update()
+        self.scan_timer.start()
+
+    def setCacheDirty(self):
+        self._cache_dirty = True
+        if not self.cache_timer.isActive():
+            self.cache_timer.start()
+
+    def readCacheFile(self):
+        cache_file = self.getCacheFilePath()
+        if not os.path.isfile(cache_file):
+            return False
+
+        try:
+            file = open(cache_file, 'r')
+            xml = QDomDocument()
+            xml.setContent(file.read())
+            file.close()
+        except:
+            return False
+
+        content = xml.documentElement()
+        if (content.tagName() != 'SESSION-INDEX'
+                or content.attribute('root') != self.root):
+            return False
+
+        nodes = content.childNodes()
+        for i in range(nodes.count()):
+            el = nodes.at(i).toElement()
+            if el.tagName() != 'Dir':
+                continue
+
+            rel_path = el.attribute('path')
+            try:
+                mtime = float(el.attribute('mtime'))
+            except ValueError:
+                continue
+
+            self._dirs[rel_path] = mtime
+            self._children[rel_path] = set()
+            if el.attribute('session') == '1':
+                self._sessions.add(rel_path)
+
+                last_opened = el.attribute('last_opened')
+                if last_opened:
+                    try:
+                        self._last_opened[rel_path] = float(last_opened)
+                    except ValueError:
+                        pass
+
+                details_el = el.firstChildElement('Details')
+                if not details_el.isNull():
+                    details = SessionDetails()
+                    if details.readXml(details_el):
+                        self._details[rel_path] = details
+
+        if not '' in self._dirs:
+            self.clear()
+            return False
+
+        for rel_path in self._dirs:
+            if rel_path:
+                parent = os.path.dirname(rel_path)
+                if parent in self._children:
+                    self._children[parent].add(rel_path)
+
+        return True
+
+    def writeCacheFile(self):
+        self.cache_timer.stop()
+
+        if not (self.root and self._is_ready and self._cache_dirty):
+            return
+
+        xml = QDomDocument()
+        content = xml.createElement('SESSION-INDEX')
+        content.setAttribute('VERSION', ray.VERSION)
+        content.setAttribute('root', self.root)
+
+        for rel_path in sorted(self._dirs):
+            el = xml.createElement('Dir')
+            el.setAttribute('path', rel_path)
+            el.setAttribute('mtime', repr(self._dirs[rel_path]))
+            if rel_path in self._sessions:
+                el.setAttribute('session', 1)
+                if rel_path in self._last_opened:
+                    el.setAttribute('last_opened',
+                                    repr(self._last_opened[rel_path]))
+                if rel_path in self._details:
+                    details_el = xml.createElement('Details')
+                    self._details[rel_path].writeXml(details_el)
+                    el.appendChild(details_el)
+            content.appendChild(el)
+
+        xml.appendChild(content)
+
+        cache_file = self.getCacheFilePath()
+
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+
+            file = open(cache_file, 'w')
+            file.write(xml.toString())
+            file.close()
+        except:
+            Terminal.warning("unable to write session index file %s"
+                             % cache_file)
+            return
+
+        self._cache_dirty = False
+
+
+class SessionLister:
+    details_batch_size = 10
+
+    def __init__(self, session_index, src_addr, path, options,
+                 with_details=False, nsm_reply=False):
+        self.session_index = session_index
+        self.src_addr = src_addr
+        self.path = path
+        self.with_details = with_details
+        # NSM protocol replies one session per message,
+        # and an empty string as end of list.
+        self.nsm_reply = nsm_reply
+        self.reply = ChunkedReply(session_index, src_addr, path)
+
+        self.offset = 0
+        self.limit = -1
+        self.pattern = ''
+        self.sort_key = ''
+        self.reverse = False
+
+        self.is_finished = False
+        self._finish_asked = False
+        self._pos = 0
+        self._n_matching = 0
+        self._n_sent = 0
+
+        # details are read progressively to not freeze the daemon
+        self._pending_details = deque()
+        self.details_timer = QTimer()
+        self.details_timer.setInterval(0)
+        self.details_timer.timeout.connect(self.sendDetailsBatch)
+
+        for option in options:
+            if not isinstance(option, str):
+                continue
+
+            key, colon, value = option.partition(':')
+
+            if key in ('offset', 'limit'):
+                if value.isdigit():
+                    setattr(self, key, int(value))
+            elif key == 'filter':
+                self.pattern = value
+            elif key == 'sort':
+                if value in ('name', 'modified', 'opened'):
+                    self.sort_key = value
+            elif key == 'reverse':
+                self.reverse = True
+
+    def matches(self, rel_path):
+        if not self.pattern:
+            return True
+
+        if any(c in self.pattern for c in '*?['):
+            return fnmatch.fnmatchcase(rel_path, self.pattern)
+
+        return rel_path.startswith(self.pattern)
+
+    def select(self, session_list):
+        selected = []
+
+        for rel_path in session_list:
+            if 0 <= self.limit <= self._n_sent:
+                break
+
+            if not self.matches(rel_path):
+                continue
+
+            self._n_matching += 1
+            if self._n_matching <= self.offset:
+                continue
+
+            selected.append(rel_path)
+            self._n_sent += 1
+
+        return selected
+
+    def sendSessions(self, session_list):
+        selected = self.select(session_list)
+
+        if self.with_details:
+            self._pending_details.extend(selected)
+            if self._pending_details:
+                self.details_timer.start()
+            return
+
+        # sessions are sent as soon as they are found
+        if self.nsm_reply:
+            for rel_path in selected:
+                self.session_index.send(self.src_addr, '/reply',
+                                        self.path, rel_path)
+            return
+
+        self.reply.add(*selected)
+        self.reply.flush()
+
+    def sendDetailsBatch(self):
+        batch = []
+
+        while self._pending_details and len(batch) < self.details_batch_size:
+            batch.append(self.session_index.getDetailsMessage(
+                self._pending_details.popleft()))
+
+        if batch:
+            self.reply.add(*batch)
+            self.reply.flush()
+
+        if not self._pending_details:
+            self.details_timer.stop()
+            if self._finish_asked:
+                self.end()
+
+    def update(self):
+        if self._finish_asked:
+            return
+
+        # without sort key nor paging,
+        # sessions are sent as soon as they are found.
+        # paged requests wait for the name order of the finished scan,
+        # to get the same pages whatever the index state.
+        if (self.sort_key or self.reverse
+                or self.offset or self.limit >= 0):
+            return
+
+        found = self.session_index._found
+        self.sendSessions(found[self._pos:])
+        self._pos = len(found)
+
+    def finish(self):
+        if self._finish_asked:
+            return
+
+        if self._pos:
+            self.sendSessions(self.session_index._found[self._pos:])
+        else:
+            self.sendSessions(self.session_index.getSortedSessions(
+                self.sort_key, self.reverse))
+
+        self._finish_asked = True
+
+        if not self._pending_details:
+            self.end()
+
+    def cancel(self):
+        # end the reply with the sessions already sent
+        self.details_timer.stop()
+        self._pending_details.clear()
+        self._finish_asked = True
+        self.end()
+
+    def end(self):
+        if self.is_finished:
+            return
+
+        if self.nsm_reply:
+            self.session_index.send(self.src_addr, '/reply', self.path, '')
+        else:
+            self.reply.end()
+        self.is_finished = True
+
+        if self in self.session_index._listers:
+            self.session_index._listers.remove(self)
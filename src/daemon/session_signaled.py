@@ -11,9 +11,11 @@ import ray
 
 from client import Client
 from multi_daemon_file import MultiDaemonFile
+from osc_server_thread import ChunkedReply
 from signaler import Signaler
 from daemon_tools import Terminal
 from session import OperatingSession
+from session_index import SessionIndex
 
 _translate = QCoreApplication.translate
 signaler = Signaler.instance()
@@ -49,6 +51,18 @@ def session_operation(func):
         return response
     return wrapper
 
+# NSM paths managed as ray paths
+# /nsm/server/list is not used here because it doesn't
+# works as /ray/server/list_sessions
+nsm_equivs = {"/nsm/server/add" : "/ray/session/add_executable",
+              "/nsm/server/save": "/ray/session/save",
+              "/nsm/server/open": "/ray/server/open_session",
+              "/nsm/server/new" : "/ray/server/new_session",
+              "/nsm/server/duplicate": "/ray/session/duplicate",
+              "/nsm/server/close": "/ray/session/close",
+              "/nsm/server/abort": "/ray/session/abort",
+              "/nsm/server/quit" : "/ray/server/quit"}
+
 def client_action(func):
     def wrapper(*args, **kwargs):
         if len(args) < 4:
@@ -58,15 +72,12 @@ def client_action(func):
 
         client_id = osc_args.pop(0)
 
-        for client in sess.clients:
-            if client.client_id == client_id:
-                response = func(*args, client)
-                break
-        else:
+        client = sess.findClient(client_id)
+        if client is None:
             sess.sendErrorNoClient(src_addr, path, client_id)
             return
 
-        return response
+        return func(*args, client)
     return wrapper
 
 
@@ -76,29 +87,28 @@ class SignaledSession(OperatingSession):
     def __init__(self, root):
         OperatingSession.__init__(self, root)
 
+        # path -> function, or None if path has no function here
+        self._osc_functions = {}
+
         signaler.osc_recv.connect(self.oscReceive)
         #signaler.script_finished.connect(self.scriptFinished)
         signaler.dummy_load_and_template.connect(self.dummyLoadAndTemplate)
 
-    def oscReceive(self, path, args, types, src_addr):
-        nsm_equivs = {"/nsm/server/add" : "/ray/session/add_executable",
-                      "/nsm/server/save": "/ray/session/save",
-                      "/nsm/server/open": "/ray/server/open_session",
-                      "/nsm/server/new" : "/ray/server/new_session",
-                      "/nsm/server/duplicate": "/ray/session/duplicate",
-                      "/nsm/server/close": "/ray/session/close",
-                      "/nsm/server/abort": "/ray/session/abort",
-                      "/nsm/server/quit" : "/ray/server/quit"}
-                      # /nsm/server/list is not used here because it doesn't
-                      # works as /ray/server/list_sessions
-
+    def getOscFunction(self, path):
         nsm_path = nsm_equivs.get(path)
         func_path = nsm_path if nsm_path else path
 
         func_name = func_path.replace('/', '_')
+        return getattr(self, func_name, None)
+
+    def oscReceive(self, path, args, types, src_addr):
+        if path in self._osc_functions:
+            function = self._osc_functions[path]
+        else:
+            function = self.getOscFunction(path)
+            self._osc_functions[path] = function
 
-        if func_name in self.__dir__():
-            function = self.__getattribute__(func_name)
+        if function is not None:
             function(path, args, src_addr)
 
     def sendErrorNoClient(self, src_addr, path, client_id):
@@ -263,6 +273,8 @@ class SignaledSession(OperatingSession):
         if multi_daemon_file:
             multi_daemon_file.update()
 
+        SessionIndex.getInstance().setRoot(self.root)
+
         self.send(src_addr, '/reply', path,
                   "root folder changed to %s" % self.root)
         self.sendGui('/ray/gui/server/root', self.root)
@@ -278,11 +290,23 @@ class SignaledSession(OperatingSession):
 
         template_list = [] # list of template names
 
-        # list of (template_name, client_template)
+        # dict of {template_name: client_template}
         # where client_template is a fake client with all template properties
-        tmp_template_list = []
+        template_clients = {}
 
         factory = bool('factory' in path)
+
+        def sendTemplatesUpdate(template_names):
+            # GUI needs templates properties after names
+            if not src_addr_is_gui:
+                return
+
+            for template_name in template_names:
+                self.sendGui('/ray/gui/client_template_update',
+                             int(factory), template_name,
+                             *template_clients.pop(template_name).spread())
+
+        reply = ChunkedReply(self, src_addr, path, sendTemplatesUpdate)
         search_paths = self.getSearchTemplateDirs(factory)
         file_rewritten = False
 
@@ -367,32 +391,11 @@ class SignaledSession(OperatingSession):
                     template_client.updateInfosFromDesktopFile()
 
                 template_list.append(template_name)
-                tmp_template_list.append((template_name, template_client))
-
-                if len(tmp_template_list) == 20:
-                    self.send(src_addr, '/reply', path,
-                            *[t[0] for t in tmp_template_list])
-
-                    if src_addr_is_gui:
-                        for template_name, template_client in tmp_template_list:
-                            self.sendGui('/ray/gui/client_template_update',
-                                        int(factory), template_name,
-                                        *template_client.spread())
-
-                    tmp_template_list.clear()
-
-        if tmp_template_list:
-            self.send(src_addr, '/reply', path,
-                    *[t[0] for t in tmp_template_list])
-
-            if src_addr_is_gui:
-                for template_name, template_client in tmp_template_list:
-                    self.sendGui('/ray/gui/client_template_update',
-                                int(factory), template_name,
-                                *template_client.spread())
+                template_clients[template_name] = template_client
+                reply.add(template_name)
 
         # send a last empty reply to say list is finished
-        self.send(src_addr, '/reply', path)
+        reply.end()
 
         if file_rewritten:
             try:
@@ -411,8 +414,10 @@ class SignaledSession(OperatingSession):
 
     def _ray_server_list_sessions(self, path, args, src_addr):
         with_net = False
-        if args:
+        if args and isinstance(args[0], int):
             with_net = args[0]
+        elif 'with_net' in args:
+            with_net = True
 
         if with_net:
             for client in self.clients:
@@ -425,56 +430,25 @@ class SignaledSession(OperatingSession):
                       "no session root, so no sessions to list")
             return
 
-        session_list = []
-        n = 0
-
-        for root, dirs, files in os.walk(self.root):
-            #exclude hidden files and dirs
-            files = [f for f in files if not f.startswith('.')]
-            dirs[:] = [d for d in dirs  if not d.startswith('.')]
-
-            if root == self.root:
-                continue
-
-            already_sent = False
+        SessionIndex.getInstance().listSessions(src_addr, path, args)
 
-            for file in files:
-                if file in ('raysession.xml', 'session.nsm'):
-                    if already_sent:
-                        continue
-
-                    basefolder = root.replace(self.root + '/', '', 1)
-                    session_list.append(basefolder)
-
-                    if n >= 16000:
-                        self.send(src_addr, "/reply", path,
-                                    *session_list)
-
-                        session_list.clear()
-                        n = 0
-                    already_sent = True
-
-        if session_list:
-            self.send(src_addr, "/reply", path, *session_list)
+    def _ray_server_list_sessions_details(self, path, args, src_addr):
+        if not self.root:
+            self.send(src_addr, '/error', path, ray.Err.GENERAL_ERROR,
+                      "no session root, so no sessions to list")
+            return
 
-        self.send(src_addr, "/reply", path)
+        SessionIndex.getInstance().listSessions(src_addr, path, args,
+                                                with_details=True)
 
     def _nsm_server_list(self, path, args, src_addr):
-        if self.root:
-            for root, dirs, files in os.walk(self.root):
-                #exclude hidden files and dirs
-                files = [f for f in files if not f.startswith('.')]
-                dirs[:] = [d for d in dirs  if not d.startswith('.')]
-
-                if root == self.root:
-                    continue
-
-                for file in files:
-                    if file in ('raysession.xml', 'session.nsm'):
-                        basefolder = root.replace(self.root + '/', '', 1)
-                        self.send(src_addr, '/reply', path, basefolder)
+        if not self.root:
+            self.send(src_addr, '/reply', path, "")
+            return
 
-        self.send(src_addr, '/reply', path, "")
+        # replies are sent while the session index scans
+        SessionIndex.getInstance().listSessions(src_addr, path, [],
+                                                nsm_reply=True)
 
     @session_operation
     def _ray_server_new_session(self, path, args, src_addr):
@@ -646,6 +620,10 @@ class SignaledSession(OperatingSession):
         self.steps_order += [(self.snapshot, snapshot_name, '', True),
                                self.snapshotDone]
 
+    @session_operation
+    def _ray_session_clean_snapshots(self, path, args, src_addr):
+        self.steps_order = [self.cleanSnapshots, self.cleanSnapshotsDone]
+
     @session_operation
     def _ray_session_close(self, path, args, src_addr):
         self.steps_order = [(self.save, True),
@@ -1028,24 +1006,9 @@ class SignaledSession(OperatingSession):
             self.snapshoter.isAutoSnapshotPrevented())
         self.sendGui('/ray/gui/session/auto_snapshot', int(auto_snapshot))
 
-        snapshots = self.snapshoter.list(client_id)
-
-        i = 0
-        snap_send = []
-
-        for snapshot in snapshots:
-            if i == 20:
-                self.send(src_addr, '/reply', path, *snap_send)
-
-                snap_send.clear()
-                i = 0
-            else:
-                snap_send.append(snapshot)
-                i += 1
-
-        if snap_send:
-            self.send(src_addr, '/reply', path, *snap_send)
-        self.send(src_addr, '/reply', path)
+        reply = ChunkedReply(self, src_addr, path)
+        reply.add(*self.snapshoter.list(client_id))
+        reply.end()
 
     def _ray_session_set_auto_snapshot(self, path, args, src_addr):
         self.snapshoter.setAutoSnapshot(bool(args[0]))
@@ -1107,19 +1070,17 @@ class SignaledSession(OperatingSession):
                 else:
                     client_id_list.append(client.client_id)
 
-        if client_id_list:
-            self.send(src_addr, '/reply', path, *client_id_list)
-        self.send(src_addr, '/reply', path)
+        reply = ChunkedReply(self, src_addr, path)
+        reply.add(*client_id_list)
+        reply.end()
 
     def _ray_session_list_trashed_clients(self, path, args, src_addr):
-        client_id_list = []
+        reply = ChunkedReply(self, src_addr, path)
 
         for trashed_client in self.trashed_clients:
-            client_id_list.append(trashed_client.client_id)
+            reply.add(trashed_client.client_id)
 
-        if client_id_list:
-            self.send(src_addr, '/reply', path, *client_id_list)
-        self.send(src_addr, '/reply', path)
+        reply.end()
 
     def _ray_session_run_step(self, path, args, src_addr):
         if not self.step_scripter.isRunning():
@@ -0,0 +1,203 @@
+import os
+from collections import deque
+from PyQt5.QtCore import QObject, QProcess, QProcessEnvironment
+
+import ray
+from daemon_tools import RS, Terminal
+
+# paths given as arguments to one checkout process
+# when git is too old for --pathspec-from-file
+PATHS_BATCH_SIZE = 200
+
+class RestoreJob:
+    def __init__(self, paths):
+        self.paths = paths
+        self.slot = -1
+        self.process = None
+
+
+class SnapshotRestorer(QObject):
+    # restore paths from a snapshot commit to the work tree
+    # with several git processes running together.
+    # Each process uses its own index file, so they don't wait
+    # for the session index lock.
+    def __init__(self, snapshoter):
+        QObject.__init__(self)
+        self.snapshoter = snapshoter
+        self._spath = ''
+        self._commit = ''
+        self._pathspec_file = True
+        self._pending_jobs = deque()
+        self._running_jobs = []
+        self._free_slots = []
+        self._n_paths = 0
+        self._n_restored_paths = 0
+        self._next_function = None
+        self._error_function = None
+        self._aborted = False
+
+    def isRunning(self):
+        return self._next_function is not None
+
+    def getSlotPath(self, slot, name):
+        return "%s/%s/restore-%s-%i" % (self._spath, self.snapshoter.gitdir,
+                                        name, slot)
+
+    def start(self, spath, commit, groups, next_function, error_function):
+        # groups is a list of paths lists, paths of a group
+        # are restored by the same git process.
+        self._spath = spath
+        self._commit = commit
+        self._next_function = next_function
+        self._error_function = error_function
+        self._aborted = False
+
+        groups = [group for group in groups if group]
+
+        self._pathspec_file = self.snapshoter.canUsePathspecFile('checkout')
+        if not self._pathspec_file:
+            # paths are given as arguments, split too big groups
+            groups = [group[i:i+PATHS_BATCH_SIZE]
+                      for group in groups
+                      for i in range(0, len(group), PATHS_BATCH_SIZE)]
+
+        # biggest groups first, to not finish with a long lonely process
+        groups.sort(key=len, reverse=True)
+
+        self._pending_jobs = deque([RestoreJob(group) for group in groups])
+        self._n_paths = sum([len(group) for group in groups])
+        self._n_restored_paths = 0
+
+        n_workers = RS.settings.value('daemon/restore_workers', 4, type=int)
+        self._free_slots = list(range(max(1, min(n_workers, len(groups)))))
+
+        self.startJobs()
+
+    def startJobs(self):
+        while self._pending_jobs and self._free_slots:
+            job = self._pending_jobs.popleft()
+            job.slot = self._free_slots.pop(0)
+
+            if self._pathspec_file:
+                pathspec_args = ['--pathspec-from-file=%s'
+                                     % self.getSlotPath(job.slot, 'paths'),
+                                 '--pathspec-file-nul']
+                try:
+                    pathspec_file = open(self.getSlotPath(job.slot, 'paths'),
+                                         'wb')
+                    pathspec_file.write(
+                        b''.join([os.fsencode(path) + b'\0'
+                                  for path in job.paths]))
+                    pathspec_file.close()
+                except OSError:
+                    self.jobsError(ray.Err.CREATE_FAILED,
+                                   self.getSlotPath(job.slot, 'paths'))
+                    return
+            else:
+                pathspec_args = ['--', *job.paths]
+
+            index_path = self.getSlotPath(job.slot, 'index')
+            if os.path.exists(index_path):
+                os.remove(index_path)
+
+            process_env = QProcessEnvironment.systemEnvironment()
+            process_env.insert('GIT_INDEX_FILE', index_path)
+            process_env.insert('GIT_LITERAL_PATHSPECS', '1')
+
+            job.process = QProcess()
+            job.process.setProcessEnvironment(process_env)
+            job.process.finished.connect(
+                lambda exit_code, exit_status, job=job:
+                    self.jobFinished(job, exit_code, exit_status))
+            job.process.errorOccurred.connect(
+                lambda error, job=job: self.jobErrorOccurred(job, error))
+
+            self._running_jobs.append(job)
+
+            job.process.start(
+                self.snapshoter.git_exec,
+                self.snapshoter.getGitCommandListAt(
+                    self._spath, 'checkout', self._commit, *pathspec_args))
+
+        if not self._running_jobs:
+            self.jobsFinished()
+
+    def removeSlotFiles(self, slot):
+        for name in ('paths', 'index'):
+            try:
+                os.remove(self.getSlotPath(slot, name))
+            except OSError:
+                pass
+
+    def jobErrorOccurred(self, job, error):
+        if error == QProcess.FailedToStart:
+            self.jobFinished(job, 1, QProcess.CrashExit)
+
+    def jobFinished(self, job, exit_code, exit_status):
+        if not job in self._running_jobs:
+            return
+
+        self._running_jobs.remove(job)
+        self.removeSlotFiles(job.slot)
+        self._free_slots.append(job.slot)
+
+        if self._next_function is None:
+            return
+
+        if self._aborted:
+            if not self._running_jobs:
+                self.jobsError(ray.Err.ABORT_ORDERED, 'snapshot loading')
+            return
+
+        if exit_status:
+            self.jobsError(ray.Err.SUBPROCESS_CRASH, 'checkout')
+            return
+
+        if exit_code:
+            self.jobsError(ray.Err.SUBPROCESS_EXITCODE, 'checkout')
+            return
+
+        self._n_restored_paths += len(job.paths)
+        if self._n_paths:
+            self.snapshoter.session.sendGui(
+                '/ray/gui/server/progress',
+                self._n_restored_paths / self._n_paths)
+
+        self.startJobs()
+
+    def jobsFinished(self):
+        next_function = self._next_function
+        self._next_function = None
+        self._error_function = None
+
+        if next_function is not None:
+            next_function()
+
+    def jobsError(self, err, info_str):
+        error_function = self._error_function
+        self._next_function = None
+        self._error_function = None
+        self._pending_jobs.clear()
+
+        for job in self._running_jobs:
+            job.process.kill()
+
+        if err != ray.Err.ABORT_ORDERED:
+            Terminal.warning("snapshot restore failed: %s" % info_str)
+
+        if error_function is not None:
+            error_function(err, info_str)
+
+    def abort(self):
+        if not self.isRunning():
+            return
+
+        self._aborted = True
+        self._pending_jobs.clear()
+
+        if not self._running_jobs:
+            self.jobsError(ray.Err.ABORT_ORDERED, 'snapshot loading')
+            return
+
+        for job in self._running_jobs:
+            job.process.terminate()
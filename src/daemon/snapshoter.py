@@ -1,11 +1,34 @@
 
+import calendar
+import functools
+import json
 import os
 import socket
-from PyQt5.QtCore import QProcess, QObject, QDateTime
+import stat
+import subprocess
+import time
+from PyQt5.QtCore import QProcess, QProcessEnvironment, QObject, QDateTime
 from PyQt5.QtXml import QDomDocument
 
 import ray
-from daemon_tools import Terminal
+from daemon_tools import Terminal, RS
+from fs_watcher import FsWatcher
+from media_store import MediaStore
+from snapshot_restorer import SnapshotRestorer
+
+# over this number of changed paths, changes are checked in whole session
+MAX_CHANGED_PATHS = 1000
+
+# first git versions supporting --pathspec-from-file per command
+PATHSPEC_FILE_VERSIONS = {'add': (2, 25), 'checkout': (2, 26)}
+
+# paths given as arguments to one git command
+# when --pathspec-from-file is not supported
+PATHS_BATCH_SIZE = 200
+
+# git commands with big outputs used by the daemon only
+QUIET_GIT_COMMANDS = ('for-each-ref', 'show', 'commit-tree', 'rev-parse',
+                      'diff')
 
 def gitStringer(string):
     for char in (' ', '*', '?', '[', ']', '(', ')'):
@@ -27,9 +50,11 @@ class Snapshoter(QObject):
         QObject.__init__(self)
         self.session = session
         self.git_exec = 'git'
+        self.git_version = self.readGitVersion()
         self.gitdir = '.ray-snapshots'
         self.exclude_path = 'info/exclude'
-        self.history_path = "session_history.xml"
+        self.history_path = "session_history.jsonl"
+        self.xml_history_path = "session_history.xml"
         self.max_file_size = 50 #in Mb
 
         self.next_snapshot_name = ''
@@ -38,41 +63,111 @@ class Snapshoter(QObject):
         self.changes_checker = QProcess()
         self.changes_checker.readyReadStandardOutput.connect(
             self.changesCheckerStandardOutput)
-
-        self.adder_process = QProcess()
-        self.adder_process.finished.connect(self.save_step_1)
-        self.adder_process.readyReadStandardOutput.connect(
-            self.adderStandardOutput)
-
-        self._adder_aborted = False
+        self.changes_checker.finished.connect(self.changesCheckerFinished)
+        self.changes_checker.errorOccurred.connect(
+            self.changesCheckerErrorOccurred)
+        self._changes_callback = None
 
         self.git_process = QProcess()
         self.git_process.readyReadStandardOutput.connect(self.standardOutput)
         self.git_process.readyReadStandardError.connect(self.standardError)
+        self.git_process.finished.connect(self.gitProcessFinished)
+        self.git_process.errorOccurred.connect(self.gitProcessErrorOccurred)
         self.git_command = ''
+        self.git_output = b''
+
+        # git steps chain, a step is a tuple of git arguments
+        # (optionally starting with an environment dict)
+        # or a function returning a ray.Err
+        self._steps = []
+        self._n_steps = 0
+        self._steps_spath = ''
+        self._steps_next_function = None
+        self._steps_abort_function = None
+        self._aborted = False
+        self._is_saving = False
 
         self._n_file_changed = 0
         self._n_file_treated = 0
         self._changes_counted = False
+        self._changes_output = b''
+
+        # paths changed in session folder since last snapshot,
+        # reliable only if _changes_tracked is True.
+        self._changed_paths = set()
+        self._changes_tracked = False
+        # changed paths when changes were checked
+        self._checked_paths = set()
+        # None if changes have been checked in the whole session,
+        # else the list of (ls-files tag, path) of changed files
+        self._changed_files = None
+        self._full_check_reliable = False
+        self._exclude_changed = False
+
+        self._clean_dropped = []
 
         self.next_function = None
         self.error_function = None
 
-    def changesCheckerStandardOutput(self):
-        standard_output = self.changes_checker.readAllStandardOutput().data()
-        self._n_file_changed += len(standard_output.decode().split('\n')) -1
+        # relative path -> (size, is_link) of files in session folder
+        self._files = {}
+        self._files_indexed = False
+        self.fs_watcher = FsWatcher((self.gitdir,))
 
-    def adderStandardOutput(self):
-        standard_output = self.adder_process.readAllStandardOutput().data()
-        Terminal.snapshoterMessage(standard_output, ' add -A -v')
+        # files excluded from git are stored in media store if enabled
+        self.media_store = MediaStore()
+        self._media = {}
 
-        if not self._n_file_changed:
-            return
+        self.restorer = SnapshotRestorer(self)
+        self._restore_paths = []
+        self._restore_removed = []
 
-        self._n_file_treated += len(standard_output.decode().split('\n')) -1
+        self.clearHistoryIndex()
 
-        self.session.sendGui('/ray/gui/server/progress',
-                             self._n_file_treated / self._n_file_changed)
+    def setSessionPath(self, session_path):
+        self._files.clear()
+        self._files_indexed = False
+        self.fs_watcher.setRoot(session_path)
+        self._changed_paths.clear()
+        self._changes_tracked = False
+        self.clearHistoryIndex()
+
+    def changesCheckerStandardOutput(self):
+        self._changes_output += \
+            self.changes_checker.readAllStandardOutput().data()
+
+    def changesCheckerFinished(self, exit_code, exit_status):
+        callback = self._changes_callback
+        self._changes_callback = None
+
+        # path -> ls-files tag ('?' for untracked files)
+        changed_files = {}
+        for line in self._changes_output.split(b'\0'):
+            tag, space, path = line.partition(b' ')
+            if path:
+                changed_files[os.fsdecode(path)] = tag.decode()
+        self._changes_output = b''
+
+        changed_files = [(tag, path) for path, tag in changed_files.items()]
+        self._n_file_changed = len(changed_files)
+
+        if exit_code or exit_status:
+            # count as changed to not miss a snapshot
+            self._n_file_changed = max(1, self._n_file_changed)
+            self._full_check_reliable = False
+            self._changed_files = None
+        elif self._changed_files is not None:
+            self._changed_files = changed_files
+
+        if not self._n_file_changed and not self._aborted:
+            self.changesRecorded()
+
+        if callback is not None:
+            callback(bool(self._n_file_changed and not self._aborted))
+
+    def changesCheckerErrorOccurred(self, error):
+        if error == QProcess.FailedToStart:
+            self.changesCheckerFinished(1, QProcess.CrashExit)
 
     def standardError(self):
         standard_error = self.git_process.readAllStandardError().data()
@@ -80,39 +175,127 @@ class Snapshoter(QObject):
 
     def standardOutput(self):
         standard_output = self.git_process.readAllStandardOutput().data()
+        self.git_output += standard_output
+
+        if self.git_command.split(' ')[1] in QUIET_GIT_COMMANDS:
+            return
+
         Terminal.snapshoterMessage(standard_output, self.git_command)
 
+        if (not self.git_command.startswith(' add -A -v')
+                or not self._n_file_changed):
+            return
+
+        self._n_file_treated += len(standard_output.decode().split('\n')) -1
+
+        self.session.sendGui('/ray/gui/server/progress',
+                             min(1.0, self._n_file_treated
+                                      / self._n_file_changed))
+
     def getGitDir(self):
         if not self.session.path:
             raise NameError("attempting to save with no session path !!!")
 
         return "%s/%s" % (self.session.path, self.gitdir)
 
-    def runGitProcess(self, *all_args):
-        return self.runGitProcessAt(self.session.path, *all_args)
+    def isRunning(self):
+        return bool(self._steps_next_function is not None
+                    or self._changes_callback is not None
+                    or self.media_store.isRunning()
+                    or self.restorer.isRunning())
+
+    def runGitSteps(self, spath, steps, next_function, abort_function):
+        # run steps one by one without blocking the event loop,
+        # next_function is called when all steps are done.
+        self._steps = list(steps)
+        self._n_steps = len(self._steps)
+        self._steps_spath = spath
+        self._steps_next_function = next_function
+        self._steps_abort_function = abort_function
+        self._aborted = False
+
+        self.nextGitStep()
+
+    def endGitSteps(self):
+        self._steps.clear()
+        self._steps_next_function = None
+        self._steps_abort_function = None
+
+    def nextGitStep(self):
+        if self._aborted:
+            abort_function = self._steps_abort_function
+            self.endGitSteps()
+            if abort_function is not None:
+                abort_function()
+            return
 
-    def runGitProcessAt(self, spath, *all_args):
-        self.git_command = ''
-        for arg in all_args:
-            self.git_command += ' %s' % arg
+        if self._n_steps:
+            self.session.sendGui(
+                '/ray/gui/server/progress',
+                (self._n_steps - len(self._steps)) / self._n_steps)
+
+        while self._steps:
+            step = self._steps.pop(0)
+
+            if isinstance(step, tuple):
+                process_env = QProcessEnvironment.systemEnvironment()
+                if step and isinstance(step[0], dict):
+                    for key, value in step[0].items():
+                        process_env.insert(key, value)
+                    step = step[1:]
+                self.git_process.setProcessEnvironment(process_env)
+
+                self.git_command = ''
+                for arg in step:
+                    self.git_command += ' %s' % arg
+                self.git_output = b''
+
+                git_args = self.getGitCommandListAt(self._steps_spath, *step)
+                self.git_process.start(self.git_exec, git_args)
+                # self.git_process.finished calls self.nextGitStep
+                return
 
-        err = ray.Err.OK
+            err = step()
+            if err:
+                self.stepError(err, getattr(step, '__name__', ''))
+                return
 
-        git_args = self.getGitCommandListAt(spath, *all_args)
-        self.git_process.start(self.git_exec, git_args)
-        if not self.git_process.waitForFinished(2000):
-            self.git_process.kill()
-            err = ray.Err.SUBPROCESS_UNTERMINATED
-        else:
-            if self.git_process.exitStatus():
+        next_function = self._steps_next_function
+        self.endGitSteps()
+        if next_function is not None:
+            next_function()
+
+    def insertGitSteps(self, steps):
+        # used by function steps to add following steps
+        self._steps[0:0] = steps
+        self._n_steps += len(steps)
+
+    def stepError(self, err, info_str):
+        self.endGitSteps()
+        self._is_saving = False
+        if self.error_function:
+            self.error_function(err, info_str)
+
+    def gitProcessFinished(self, exit_code, exit_status):
+        if self._steps_next_function is None:
+            return
+
+        if not self._aborted:
+            err = ray.Err.OK
+            if exit_status:
                 err = ray.Err.SUBPROCESS_CRASH
-            elif self.git_process.exitCode():
+            elif exit_code:
                 err = ray.Err.SUBPROCESS_EXITCODE
 
-        if err and self.error_function:
-            self.error_function(err, ' '.join(all_args))
+            if err:
+                self.stepError(err, self.git_command)
+                return
+
+        self.nextGitStep()
 
-        return not bool(err)
+    def gitProcessErrorOccurred(self, error):
+        if error == QProcess.FailedToStart:
+            self.gitProcessFinished(1, QProcess.CrashExit)
 
     def getGitCommandList(self, *args):
         return self.getGitCommandListAt(self.session.path, *args)
@@ -127,11 +310,15 @@ class Snapshoter(QObject):
         return "%s/%s/%s" % (
                         self.session.path, self.gitdir, self.history_path)
 
+    def getXmlHistoryFullPath(self):
+        return "%s/%s/%s" % (
+                        self.session.path, self.gitdir, self.xml_history_path)
+
     def getHistoryXmlDocumentElement(self):
         if not self.isInit():
             return None
 
-        file_path = self.getHistoryFullPath()
+        file_path = self.getXmlHistoryFullPath()
 
         xml = QDomDocument()
 
@@ -148,36 +335,181 @@ class Snapshoter(QObject):
 
         return SNS_xml
 
-    def list(self, client_id=""):
+    def migrateXmlHistory(self):
+        # convert history.xml written by previous versions
+        # to the append only history file
+        if os.path.exists(self.getHistoryFullPath()):
+            return
+
         SNS_xml = self.getHistoryXmlDocumentElement()
         if not SNS_xml:
-            return []
+            return
 
+        lines = []
         nodes = SNS_xml.childNodes()
 
-        all_tags = []
-        all_snaps = []
-        prv_session_name = self.session.name
-
         for i in range(nodes.count()):
             node = nodes.at(i)
             el = node.toElement()
+            if el.tagName() != 'Snapshot':
+                continue
+
+            snapshot = {}
+            for attr in ('ref', 'name', 'rewind_snapshot',
+                         'session_name', 'VERSION'):
+                snapshot[attr] = el.attribute(attr)
+
+            clients = []
+            client_nodes = node.childNodes()
+
+            for j in range(client_nodes.count()):
+                client_node = client_nodes.at(j)
+                client_el = client_node.toElement()
+
+                properties = {}
+                attributes = client_el.attributes()
+                for k in range(attributes.count()):
+                    attribute = attributes.item(k).toAttr()
+                    if attribute.name() != 'client_id':
+                        properties[attribute.name()] = attribute.value()
+
+                files = []
+                file_nodes = client_node.childNodes()
+                for k in range(file_nodes.count()):
+                    file_path = file_nodes.at(k).toElement().attribute('path')
+                    if file_path:
+                        files.append(file_path)
+
+                clients.append(
+                    {'client_id': client_el.attribute('client_id'),
+                     'properties': properties,
+                     'files': files})
+
+            snapshot['clients'] = clients
+            lines.append(json.dumps(snapshot) + '\n')
+
+        try:
+            history_file = open(self.getHistoryFullPath(), 'w')
+            history_file.write(''.join(lines))
+            history_file.close()
+        except:
+            Terminal.warning("unable to convert snapshots history to %s"
+                             % self.getHistoryFullPath())
+
+    def clearHistoryIndex(self):
+        # (ref, name, rewind_snapshot, session_name) of all snapshots
+        self._history = []
+        # ref -> offset of the snapshot line in history file
+        self._ref_offsets = {}
+        # ref -> index of first snapshot with this ref in self._history
+        self._ref_indexes = {}
+        # client_id -> indexes in self._history of snapshots with client
+        self._client_snapshots = {}
+        self._history_indexed_size = 0
+
+    def indexSnapshot(self, snapshot, offset):
+        ref = str(snapshot.get('ref', ''))
+        index = len(self._history)
+
+        self._history.append((ref,
+                              str(snapshot.get('name', '')),
+                              str(snapshot.get('rewind_snapshot', '')),
+                              str(snapshot.get('session_name', ''))))
+
+        if not ref in self._ref_indexes:
+            self._ref_indexes[ref] = index
+            self._ref_offsets[ref] = offset
+
+        for client in snapshot.get('clients', []):
+            client_snapshots = self._client_snapshots.setdefault(
+                client.get('client_id'), [])
+            if not client_snapshots or client_snapshots[-1] != index:
+                client_snapshots.append(index)
+
+    def updateHistoryIndex(self):
+        # history file is append only,
+        # only read lines added since last update.
+        if not self.isInit():
+            self.clearHistoryIndex()
+            return
+
+        self.migrateXmlHistory()
+
+        try:
+            history_size = os.path.getsize(self.getHistoryFullPath())
+        except OSError:
+            self.clearHistoryIndex()
+            return
+
+        if history_size == self._history_indexed_size:
+            return
+
+        if history_size < self._history_indexed_size:
+            self.clearHistoryIndex()
 
-            if client_id:
-                client_nodes = node.childNodes()
-                for j in range(client_nodes.count()):
-                    client_node = client_nodes.at(j)
-                    client_el = client_node.toElement()
-                    if client_el.attribute('client_id') == client_id:
-                        break
-                else:
+        try:
+            history_file = open(self.getHistoryFullPath(), 'rb')
+        except:
+            return
+
+        with history_file:
+            history_file.seek(self._history_indexed_size)
+
+            while True:
+                offset = history_file.tell()
+                line = history_file.readline()
+                if not line:
+                    break
+
+                if not line.endswith(b'\n'):
+                    # interrupted or running write, read it next time
+                    break
+
+                self._history_indexed_size = history_file.tell()
+
+                try:
+                    snapshot = json.loads(line.decode())
+                except ValueError:
                     continue
 
-            ref = el.attribute('ref')
-            name = el.attribute('name')
-            rw_sn = el.attribute('rewind_snapshot')
+                if isinstance(snapshot, dict):
+                    self.indexSnapshot(snapshot, offset)
+
+    def readSnapshot(self, ref):
+        self.updateHistoryIndex()
+
+        offset = self._ref_offsets.get(ref)
+        if offset is None:
+            return None
+
+        try:
+            history_file = open(self.getHistoryFullPath(), 'rb')
+            history_file.seek(offset)
+            line = history_file.readline()
+            history_file.close()
+            snapshot = json.loads(line.decode())
+        except:
+            return None
+
+        if not isinstance(snapshot, dict):
+            return None
+
+        return snapshot
+
+    def list(self, client_id=""):
+        self.updateHistoryIndex()
+
+        all_tags = []
+        prv_session_name = self.session.name
+
+        if client_id:
+            indexes = self._client_snapshots.get(client_id, [])
+        else:
+            indexes = range(len(self._history))
+
+        for index in indexes:
+            ref, name, rw_sn, session_name = self._history[index]
             rw_name = ""
-            session_name = el.attribute('session_name')
 
             # don't list snapshot from client before session renamed
             if client_id and session_name != self.session.name:
@@ -203,12 +535,12 @@ class Snapshoter(QObject):
                 rw_sn = ""
 
             if rw_sn:
-                for snap in all_snaps:
-                    if snap[0] == rw_sn and not '\n' in snap[1]:
-                        rw_name = snap[1]
-                        break
+                rw_index = self._ref_indexes.get(rw_sn)
+                if rw_index is not None and rw_index < index:
+                    rw_name = self._history[rw_index][1]
+                    if '\n' in rw_name:
+                        rw_name = ""
 
-            all_snaps.append((ref, name))
             snapsss = fullRefForGui(ref, name, rw_sn, rw_name, ss_name)
             all_tags.append(snapsss)
 
@@ -228,70 +560,139 @@ class Snapshoter(QObject):
 
         return tagdate
 
-    def writeHistoryFile(self, date_str, snapshot_name='', rewind_snapshot=''):
-        if not self.session.path:
-            return ray.Err.NO_SESSION_OPEN
-
-        file_path = self.getHistoryFullPath()
+    def getSnapshotClients(self):
+        clients = []
 
         xml = QDomDocument()
 
-        try:
-            history_file = open(file_path, 'r')
-            xml.setContent(history_file.read())
-            history_file.close()
-        except:
-            pass
-
-        if xml.firstChild().isNull():
-            SNS_xml = xml.createElement('SNAPSHOTS')
-            xml.appendChild(SNS_xml)
-        else:
-            SNS_xml = xml.firstChild()
-
-        snapshot_el = xml.createElement('Snapshot')
-        snapshot_el.setAttribute('ref', date_str)
-        snapshot_el.setAttribute('name', snapshot_name)
-        snapshot_el.setAttribute('rewind_snapshot', rewind_snapshot)
-        snapshot_el.setAttribute('session_name', self.session.name)
-        snapshot_el.setAttribute('VERSION', ray.VERSION)
-
         for client in self.session.clients + self.session.trashed_clients:
             client_el = xml.createElement('client')
             client.writeXmlProperties(client_el)
-            client_el.setAttribute('client_id', client.client_id)
 
+            properties = {}
+            attributes = client_el.attributes()
+            for i in range(attributes.count()):
+                attribute = attributes.item(i).toAttr()
+                properties[attribute.name()] = attribute.value()
+
+            files = []
             for client_file_path in client.getProjectFiles():
-                base_path = client_file_path.replace(
-                    "%s/" % self.session.path, '', 1)
-                file_xml = xml.createElement('file')
-                file_xml.setAttribute('path', base_path)
-                client_el.appendChild(file_xml)
+                files.append(client_file_path.replace(
+                    "%s/" % self.session.path, '', 1))
+
+            clients.append({'client_id': client.client_id,
+                            'properties': properties,
+                            'files': files})
+
+        return clients
+
+    def writeHistoryFile(self, date_str, snapshot_name='', rewind_snapshot=''):
+        if not self.session.path:
+            return ray.Err.NO_SESSION_OPEN
+
+        self.migrateXmlHistory()
 
-            snapshot_el.appendChild(client_el)
+        snapshot = {'ref': date_str,
+                    'name': snapshot_name,
+                    'rewind_snapshot': rewind_snapshot,
+                    'session_name': self.session.name,
+                    'VERSION': ray.VERSION,
+                    'clients': self.getSnapshotClients()}
 
-        SNS_xml.appendChild(snapshot_el)
+        if self._media or self.isMediaStoreEnabled():
+            # even empty, media files added later are removed at restore
+            snapshot['media'] = self._media
 
+        self.updateHistoryIndex()
+        line = (json.dumps(snapshot) + '\n').encode()
+
+        # history is append only, one snapshot per line
         try:
-            history_file = open(file_path, 'w')
-            history_file.write(xml.toString())
+            history_file = open(self.getHistoryFullPath(), 'ab')
+            offset = history_file.tell()
+            history_file.write(line)
             history_file.close()
         except:
             return ray.Err.CREATE_FAILED
 
+        if offset == self._history_indexed_size:
+            self.indexSnapshot(snapshot, offset)
+            self._history_indexed_size = offset + len(line)
+
         return ray.Err.OK
 
     def getExcludeFileFullPath(self):
         return "%s/%s/%s" % (
                         self.session.path, self.gitdir, self.exclude_path)
 
-    def writeExcludeFile(self):
-        file_path = self.getExcludeFileFullPath()
+    def indexFile(self, rel_path):
+        try:
+            file_stat = os.lstat("%s/%s" % (self.session.path, rel_path))
+        except OSError:
+            file_stat = None
+
+        if file_stat is None or stat.S_ISDIR(file_stat.st_mode):
+            if file_stat is None:
+                # removed or moved dir, forget all its files
+                prefix = rel_path + '/'
+                for indexed_path in [p for p in self._files
+                                     if p.startswith(prefix)]:
+                    del self._files[indexed_path]
+
+            if rel_path in self._files:
+                del self._files[rel_path]
+            return
 
+        if stat.S_ISLNK(file_stat.st_mode):
+            self._files[rel_path] = (0, True)
+        elif stat.S_ISREG(file_stat.st_mode):
+            self._files[rel_path] = (file_stat.st_size, False)
+        elif rel_path in self._files:
+            del self._files[rel_path]
+
+    def scanFiles(self, dir_path, rel_dir):
         try:
-            exclude_file = open(file_path, 'w')
-        except:
-            return ray.Err.CREATE_FAILED
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            return
+
+        for entry in entries:
+            if not rel_dir and entry.name == self.gitdir:
+                continue
+
+            rel_path = "%s/%s" % (rel_dir, entry.name) if rel_dir \
+                       else entry.name
+
+            try:
+                if entry.is_symlink():
+                    self._files[rel_path] = (0, True)
+                elif entry.is_dir():
+                    self.scanFiles(entry.path, rel_path)
+                elif entry.is_file():
+                    self._files[rel_path] = (entry.stat().st_size, False)
+            except OSError:
+                continue
+
+    def updateFilesIndex(self):
+        # update files sizes with paths changed since last update,
+        # or scan the whole session folder if changes are not known.
+        if self._files_indexed and self.fs_watcher.isReliable():
+            for rel_path in sorted(self.takeChangedPaths()):
+                self.indexFile(rel_path)
+            return
+
+        if not self.fs_watcher.isReliable():
+            # restart watcher before scan to not miss any change
+            self.fs_watcher.setRoot(self.session.path)
+            self._changes_tracked = False
+        self.takeChangedPaths()
+
+        self._files.clear()
+        self.scanFiles(self.session.path, '')
+        self._files_indexed = True
+
+    def writeExcludeFile(self):
+        file_path = self.getExcludeFileFullPath()
 
         contents = ""
         contents += "# This file is generated by ray-daemon at each snapshot\n"
@@ -350,46 +751,43 @@ class Snapshoter(QObject):
         contents += '\n'
         contents += "# Too big Files\n"
 
-        no_check_list = (self.gitdir)
-        # check too big files
-        for foldername, subfolders, filenames in os.walk(self.session.path):
-            subfolders[:] = [d for d in subfolders if d not in no_check_list]
+        self.updateFilesIndex()
 
-            if foldername == "%s/%s" % (self.session.path, self.gitdir):
+        # check too big files
+        for rel_path in sorted(self._files):
+            file_size, is_link = self._files[rel_path]
+
+            if rel_path.endswith(session_ign_list):
+                if is_link:
+                    contents += '!%s\n' % gitStringer(rel_path)
+                # file with extension globally ignored but
+                # unignored by its client will not be ignored
+                # and that is well as this.
                 continue
 
-            for filename in filenames:
-                if filename.endswith(session_ign_list):
-                    if os.path.islink(filename):
-                        short_folder = foldername.replace(
-                                        self.session.path + '/', '', 1)
-                        line = gitStringer("%s/%s" % (short_folder, filename))
-                        contents += '!%s\n' % line
-                    # file with extension globally ignored but
-                    # unignored by its client will not be ignored
-                    # and that is well as this.
-                    continue
+            if is_link:
+                continue
 
-                if os.path.islink(filename):
-                    continue
+            if file_size > self.max_file_size*1024**2:
+                contents += "%s\n" % gitStringer(rel_path)
 
-                try:
-                    file_size = os.path.getsize(os.path.join(foldername,
-                                                             filename))
-                except:
-                    continue
+        # do not touch exclude file if nothing changed
+        try:
+            exclude_file = open(file_path, 'r')
+            old_contents = exclude_file.read()
+            exclude_file.close()
+        except:
+            old_contents = None
 
-                if file_size > self.max_file_size*1024**2:
-                    if foldername == self.session.path:
-                        line = gitStringer(filename)
-                    else:
-                        short_folder = foldername.replace(
-                                        self.session.path + '/', '', 1)
-                        line = gitStringer("%s/%s" % (short_folder, filename))
+        if contents == old_contents:
+            return ray.Err.OK
 
-                    contents += "%s\n" % line
+        # files ignored by git changed,
+        # changes have to be checked in whole session.
+        self._exclude_changed = True
 
         try:
+            exclude_file = open(file_path, 'w')
             exclude_file.write(contents)
             exclude_file.close()
         except:
@@ -404,63 +802,195 @@ class Snapshoter(QObject):
         return os.path.isfile("%s/%s/%s" % (
                 self.session.path, self.gitdir, self.exclude_path))
 
-    def hasChanges(self):
-        if not self.session.path:
-            return False
+    def hasChanges(self, callback):
+        # callback is called with True if session has changes
+        if (self.session.path and self.isInit()
+                and self.isMediaStoreEnabled()):
+            self.hasGitChanges(
+                functools.partial(self.hasChanges_media, callback))
+            return
 
-        if not self.isInit():
+        self.hasGitChanges(callback)
+
+    def hasChanges_media(self, callback, has_changes):
+        callback(bool(has_changes or self.hasMediaFilesChanged()))
+
+    def hasMediaFilesChanged(self):
+        # compare media files with media store index,
+        # without hashing nor listing ignored files.
+        store_path = self.media_store.getStorePath(self.getGitDir())
+        if not os.path.exists(self.media_store.getIndexPath(store_path)):
+            # media never stored
             return True
 
-        if self.changes_checker.state():
-            self.changes_checker.kill()
+        index = self.media_store.readIndex(store_path)
 
-        self._n_file_changed = 0
-        self._n_file_treated = 0
-        self._changes_counted = True
+        for rel_path in index:
+            try:
+                file_stat = os.stat("%s/%s" % (self.session.path, rel_path))
+            except OSError:
+                return True
 
-        args = self.getGitCommandList('ls-files', '--exclude-standard',
-                                      '--others', '--modified')
-        self.changes_checker.start(self.git_exec, args)
-        self.changes_checker.waitForFinished(2000)
+            if not self.media_store.getIndexKey(index, rel_path, file_stat):
+                return True
+
+        changed_paths = self.getChangedPaths()
+        if changed_paths is None:
+            # new media files can't be known
+            return True
+
+        extensions = self.getMediaExtensions()
 
-        return bool(self._n_file_changed)
+        for rel_path in changed_paths:
+            if rel_path in index:
+                continue
 
-    def canSave(self):
+            try:
+                file_stat = os.lstat("%s/%s" % (self.session.path, rel_path))
+            except OSError:
+                continue
+
+            if (stat.S_ISREG(file_stat.st_mode)
+                    and self.isMediaFile(rel_path, file_stat.st_size,
+                                         extensions)):
+                return True
+
+        return False
+
+    def takeChangedPaths(self):
+        dirty_paths = self.fs_watcher.takeDirtyPaths()
+        self._changed_paths |= dirty_paths
+        # paths changed again after check
+        self._checked_paths -= dirty_paths
+        return dirty_paths
+
+    def getChangedPaths(self):
+        # returns paths changed since last snapshot,
+        # or None if they are not known.
+        self.takeChangedPaths()
+
+        if not (self._changes_tracked and self.fs_watcher.isReliable()):
+            return None
+
+        if (self._exclude_changed
+                or len(self._changed_paths) > MAX_CHANGED_PATHS):
+            return None
+
+        for path in self._changed_paths:
+            if os.path.basename(path) == '.gitignore':
+                return None
+
+        return sorted(self._changed_paths)
+
+    def changesRecorded(self):
+        # session files are the same as in git for checked paths
+        if self._changed_files is None:
+            # whole session has been checked
+            self._changes_tracked = bool(self._full_check_reliable
+                                         and self.fs_watcher.isReliable())
+            self._exclude_changed = False
+
+        self._changed_paths -= self._checked_paths
+        self._checked_paths = set()
+        return ray.Err.OK
+
+    def hasGitChanges(self, callback):
         if not self.session.path:
-            return False
+            callback(False)
+            return
 
         if not self.isInit():
-            if not self.runGitProcess('init'):
-                return False
+            self._changed_files = None
+            self._full_check_reliable = False
+            callback(True)
+            return
 
-            user_name = os.getenv('USER')
-            if not user_name:
-                user_name = 'someone'
+        if self.changes_checker.state():
+            self._changes_callback = None
+            self.changes_checker.kill()
+            self.changes_checker.waitForFinished(500)
 
-            machine_name = socket.gethostname()
-            if not machine_name:
-                machine_name = 'somewhere'
+        self._n_file_changed = 0
+        self._n_file_treated = 0
+        self._changes_counted = True
+        self._changes_output = b''
+        self._aborted = False
+
+        changed_paths = self.getChangedPaths()
+        self._checked_paths = set(self._changed_paths)
+        self._changed_files = None if changed_paths is None else []
+        # events are recorded from now, in case of whole session check
+        self._full_check_reliable = self.fs_watcher.isReliable()
+
+        if changed_paths is not None and not changed_paths:
+            # nothing changed since last snapshot, no need to ask git
+            self._changes_callback = None
+            callback(False)
+            return
 
-            if not self.runGitProcess('config', 'user.email',
-                                      '%s@%s' % (user_name, machine_name)):
-                return False
+        self._changes_callback = callback
 
-            user_name = os.getenv('USER')
-            if not user_name:
-                user_name = 'someone'
+        args = self.getGitCommandList('ls-files', '-z', '-t',
+                                      '--exclude-standard', '--others',
+                                      '--modified')
+        if changed_paths is not None:
+            args += ['--'] + changed_paths
 
-            if not self.runGitProcess('config', 'user.name', user_name):
-                return False
+        process_env = QProcessEnvironment.systemEnvironment()
+        process_env.insert('GIT_LITERAL_PATHSPECS', '1')
+        self.changes_checker.setProcessEnvironment(process_env)
+        self.changes_checker.start(self.git_exec, args)
 
-        if not self.isInit():
-            return False
+    def readGitVersion(self):
+        # (major, minor) of git, (0, 0) if unknown
+        try:
+            output = subprocess.check_output([self.git_exec, '--version'],
+                                             stderr=subprocess.DEVNULL)
+            major, minor = output.decode().split()[2].split('.')[:2]
+            version = (int(major), int(minor))
+        except (OSError, subprocess.CalledProcessError,
+                IndexError, ValueError):
+            return (0, 0)
+
+        min_version = max(PATHSPEC_FILE_VERSIONS.values())
+        if version < min_version:
+            Terminal.warning(
+                "git %i.%i is older than %i.%i, "
+                "snapshots will give paths to git by batches, "
+                "update git for faster snapshots"
+                % (*version, *min_version))
+
+        return version
+
+    def canUsePathspecFile(self, git_command):
+        return self.git_version >= PATHSPEC_FILE_VERSIONS[git_command]
+
+    def getInitSteps(self):
+        if self.isInit():
+            return []
+
+        user_name = os.getenv('USER')
+        if not user_name:
+            user_name = 'someone'
+
+        machine_name = socket.gethostname()
+        if not machine_name:
+            machine_name = 'somewhere'
 
-        return True
+        return [('init',),
+                ('config', 'user.email', '%s@%s' % (user_name, machine_name)),
+                ('config', 'user.name', user_name)]
 
     def errorQuit(self, err):
-        if self.error_function:
-            self.error_function(err)
+        self._is_saving = False
+        self._media = {}
+        self.next_snapshot_name = ''
+        self._rw_snapshot = ''
+
+        error_function = self.error_function
         self.error_function = None
+        if error_function:
+            error_function(err)
 
     def save(self, name='', rewind_snapshot='',
              next_function=None, error_function=None):
@@ -469,59 +999,186 @@ class Snapshoter(QObject):
         self.next_function = next_function
         self.error_function = error_function
 
-        if not self.canSave():
+        if not self.session.path:
             Terminal.message("can't snapshot")
             return
 
-        err = self.writeExcludeFile()
-        if err:
-            self.errorQuit(err)
-            return
+        self._is_saving = True
+        self._media = {}
 
-        self._adder_aborted = False
+        steps = self.getInitSteps() + [self.writeExcludeFile]
+        next_function = self.save_step_1
 
-        if not self._changes_counted:
-            self.hasChanges()
+        if self.isMediaStoreEnabled():
+            steps.append(('ls-files', '-z', '--full-name', '--others',
+                          '--ignored', '--exclude-standard', '--', ':/',
+                          ':(exclude,top)%s' % self.gitdir))
+            next_function = self.save_storeMedia
 
-        self._changes_counted = False
+        self.runGitSteps(self.session.path, steps,
+                         next_function, self.saveAborted)
 
-        if self._n_file_changed:
-            all_args = self.getGitCommandList('add', '-A', '-v')
-            self.adder_process.start(self.git_exec, all_args)
-        else:
-            self.save_step_1()
+    def isMediaStoreEnabled(self):
+        return RS.settings.value('daemon/snapshot_media_store',
+                                 False, type=bool)
+
+    def getMediaExtensions(self):
+        extensions = set(ray.getGitIgnoredExtensions().split(' '))
+        for client in self.session.clients:
+            extensions |= set(client.ignored_extensions.split(' '))
+        return tuple(filter(bool, extensions))
+
+    def isMediaFile(self, rel_path, file_size, extensions):
+        return bool(rel_path.endswith(extensions)
+                    or file_size > self.max_file_size*1024**2)
+
+    def getMediaPaths(self, ls_output):
+        # files ignored by git because too big or with an ignored extension,
+        # files ignored by user .gitignore are not stored.
+        extensions = self.getMediaExtensions()
+        rel_paths = []
+
+        for path in ls_output.split(b'\0'):
+            rel_path = os.fsdecode(path)
+            if not rel_path or rel_path.startswith(self.gitdir + '/'):
+                continue
+
+            file_infos = self._files.get(rel_path)
+            if file_infos is None:
+                continue
+
+            file_size, is_link = file_infos
+            if is_link:
+                continue
+
+            if self.isMediaFile(rel_path, file_size, extensions):
+                rel_paths.append(rel_path)
+
+        return rel_paths
 
-        # self.adder_process.finished is connected to self.save_step_1
+    def hasMediaChanged(self):
+        self.updateHistoryIndex()
+
+        last_media = {}
+        if self._history:
+            snapshot = self.readSnapshot(self._history[-1][0])
+            if snapshot is not None:
+                last_media = snapshot.get('media', {})
+
+        return bool(self._media != last_media)
+
+    def save_storeMedia(self):
+        self.media_store.store(self.session.path, self.getGitDir(),
+                               self.getMediaPaths(self.git_output),
+                               self.save_storeMediaDone)
+
+    def save_storeMediaDone(self, media):
+        if self._aborted:
+            self.saveAborted()
+            return
+
+        self._media = media if media else {}
+        self.save_step_1()
+
+    def saveAborted(self):
+        self._is_saving = False
+        self._media = {}
+        self.error_function = None
+        self.next_snapshot_name = ''
+        self._rw_snapshot = ''
+
+        if self.next_function:
+            self.next_function(aborted=True)
 
     def save_step_1(self):
-        if self._adder_aborted:
-            if self.next_function:
-                self.next_function(aborted=True)
+        if not self.isInit():
+            self.errorQuit(ray.Err.CREATE_FAILED)
             return
 
-        if self._n_file_changed:
-            if not self.runGitProcess('commit', '-m', 'ray'):
-                return
+        if self._changes_counted and not self._exclude_changed:
+            self.save_step_2(bool(self._n_file_changed))
+            return
+
+        self.hasGitChanges(self.save_step_2)
+
+    def save_step_2(self, has_changes):
+        self._changes_counted = False
 
+        if self._aborted:
+            self.saveAborted()
+            return
+
+        steps = []
 
+        if has_changes:
+            if self._changed_files is None:
+                steps.append(('add', '-A', '-v'))
+            else:
+                # only add files known as changed
+                steps.append(self.addChangedFiles)
+            steps += [('commit', '-m', 'ray'), self.changesRecorded]
+        elif not self._aborted:
+            self.changesRecorded()
 
-        if (self._n_file_changed
-                or self.next_snapshot_name or self._rw_snapshot):
+        if (has_changes or self.next_snapshot_name or self._rw_snapshot
+                or (self._media and self.hasMediaChanged())):
             ref = self.getTagDate()
+            steps += [('tag', '-a', ref, '-m', 'ray'),
+                      functools.partial(self.save_step_3, ref)]
 
-            if not self.runGitProcess('tag', '-a', ref, '-m', 'ray'):
-                return
+        self.runGitSteps(self.session.path, steps,
+                         self.save_step_4, self.saveAborted)
+
+    def getAddPathspecFilePath(self):
+        return "%s/add-paths" % self.getGitDir()
+
+    def addChangedFiles(self):
+        paths = []
+        for tag, path in self._changed_files:
+            if tag == '?' and not os.path.lexists(
+                    "%s/%s" % (self.session.path, path)):
+                # untracked file removed since checked
+                continue
+            paths.append(path)
 
-            err = self.writeHistoryFile(ref, self.next_snapshot_name,
+        if not self.canUsePathspecFile('add'):
+            self.insertGitSteps(
+                [({'GIT_LITERAL_PATHSPECS': '1'}, 'add', '-A', '-v', '--',
+                  *paths[i:i+PATHS_BATCH_SIZE])
+                 for i in range(0, len(paths), PATHS_BATCH_SIZE)])
+            return ray.Err.OK
+
+        try:
+            pathspec_file = open(self.getAddPathspecFilePath(), 'wb')
+            pathspec_file.write(
+                b''.join([os.fsencode(path) + b'\0' for path in paths]))
+            pathspec_file.close()
+        except:
+            return ray.Err.CREATE_FAILED
+
+        self.insertGitSteps([({'GIT_LITERAL_PATHSPECS': '1'},
+                              'add', '-A', '-v',
+                              '--pathspec-from-file=%s'
+                                  % self.getAddPathspecFilePath(),
+                              '--pathspec-file-nul')])
+        return ray.Err.OK
+
+    def save_step_3(self, ref):
+        err = self.writeHistoryFile(ref, self.next_snapshot_name,
                                     self._rw_snapshot)
-            if err:
-                if self.error_function:
-                    self.error_function(err)
+        if err:
+            if self.error_function:
+                self.error_function(err)
+
+        # not really a reply, not strong.
+        self.session.sendGui('/reply', '/ray/session/list_snapshots',
+                             fullRefForGui(ref, self.next_snapshot_name,
+                                           self._rw_snapshot))
+        return ray.Err.OK
 
-            # not really a reply, not strong.
-            self.session.sendGui('/reply', '/ray/session/list_snapshots',
-                                fullRefForGui(ref, self.next_snapshot_name,
-                                            self._rw_snapshot))
+    def save_step_4(self):
+        self._is_saving = False
+        self._media = {}
         self.error_function = None
         self.next_snapshot_name = ''
         self._rw_snapshot = ''
@@ -529,72 +1186,530 @@ class Snapshoter(QObject):
         if self.next_function:
             self.next_function()
 
-    def load(self, spath, snapshot, error_function):
+    def loadAborted(self):
+        if self.error_function:
+            self.error_function(ray.Err.ABORT_ORDERED, 'snapshot loading')
+
+    def load(self, spath, snapshot, next_function, error_function):
         self.error_function = error_function
 
         snapshot_ref = snapshot.partition('\n')[0].partition(':')[0]
+        self._changes_tracked = False
+
+        # restore only files which differ from the snapshot
+        self.runGitSteps(spath,
+                         [('diff', '--name-status', '-z', '--no-renames',
+                           snapshot_ref),
+                          self.load_step_1],
+                         functools.partial(self.load_step_2, spath,
+                                           snapshot_ref, None, next_function),
+                         self.loadAborted)
+
+    def loadClientExclusive(self, client_id, snapshot,
+                            next_function, error_function):
+        self.error_function = error_function
 
-        if not self.runGitProcessAt(spath, 'reset', '--hard'):
-            return False
+        snap = self.readSnapshot(snapshot)
+        if snap is None:
+            self.error_function(ray.Err.NO_SUCH_FILE,
+                                self.getHistoryFullPath())
+            return
 
-        if not self.runGitProcessAt(spath, 'checkout', snapshot_ref):
-            return False
-        return True
+        client_path_list = []
+
+        for client in snap.get('clients', []):
+            if client.get('client_id') != client_id:
+                continue
+
+            for file_path in client.get('files', []):
+                if file_path:
+                    client_path_list.append(file_path)
+
+        if not client_path_list:
+            self.load_restoreMedia(self.session.path, snapshot,
+                                   client_path_list, next_function)
+            return
 
-    def loadClientExclusive(self, client_id, snapshot, error_function):
+        self.runGitSteps(self.session.path,
+                         [({'GIT_LITERAL_PATHSPECS': '1'},
+                           'diff', '--name-status', '-z', '--no-renames',
+                           snapshot, '--', *client_path_list),
+                          self.load_step_1],
+                         functools.partial(self.load_step_2,
+                                           self.session.path, snapshot,
+                                           client_path_list, next_function),
+                         self.loadAborted)
+
+    def load_step_1(self):
+        # diff between snapshot and work tree,
+        # files added since snapshot have to be removed.
+        self._restore_paths = []
+        self._restore_removed = []
+
+        diff_output = self.git_output.split(b'\0')
+
+        for i in range(0, len(diff_output) - 1, 2):
+            status = diff_output[i]
+            path = os.fsdecode(diff_output[i+1])
+
+            if status == b'A':
+                self._restore_removed.append(path)
+            else:
+                self._restore_paths.append(path)
+
+        return ray.Err.OK
+
+    def getRestoreGroups(self, spath, snapshot_ref, rel_paths):
+        # group paths per client, or per client file
+        # for a client exclusive restore.
+        owners = {}
+
+        if rel_paths is None:
+            snapshot = self.readSnapshotAt(spath, snapshot_ref)
+            if snapshot is not None:
+                for client in snapshot.get('clients', []):
+                    for file_path in client.get('files', []):
+                        owners[file_path] = client.get('client_id')
+        else:
+            for rel_path in rel_paths:
+                owners[rel_path] = rel_path
+
+        groups = {}
+
+        for path in self._restore_paths:
+            owner = owners.get(path, '')
+            index = path.find('/')
+
+            while not owner and index > 0:
+                owner = owners.get(path[:index], '')
+                index = path.find('/', index + 1)
+
+            groups.setdefault(owner, []).append(path)
+
+        return list(groups.values())
+
+    def removeRestoredPath(self, spath, path):
+        try:
+            os.remove("%s/%s" % (spath, path))
+        except OSError:
+            return
+
+        # remove empty parent dirs as git does
+        dir_path = os.path.dirname(path)
+        while dir_path:
+            try:
+                os.rmdir("%s/%s" % (spath, dir_path))
+            except OSError:
+                break
+            dir_path = os.path.dirname(dir_path)
+
+    def load_step_2(self, spath, snapshot_ref, rel_paths, next_function):
+        for path in self._restore_removed:
+            self.removeRestoredPath(spath, path)
+
+        self.restorer.start(
+            spath, snapshot_ref,
+            self.getRestoreGroups(spath, snapshot_ref, rel_paths),
+            functools.partial(self.load_step_3, spath, snapshot_ref,
+                              rel_paths, next_function),
+            self.loadRestoreError)
+
+        self._restore_paths = []
+        self._restore_removed = []
+
+    def load_step_3(self, spath, snapshot_ref, rel_paths, next_function):
+        if rel_paths is not None:
+            self.load_restoreMedia(spath, snapshot_ref, rel_paths,
+                                   next_function)
+            return
+
+        # work tree is restored, detach HEAD to the snapshot
+        # and reset index to it.
+        self.runGitSteps(spath,
+                         [('update-ref', '--no-deref', 'HEAD',
+                           snapshot_ref + '^{commit}'),
+                          ('reset', '-q')],
+                         functools.partial(self.load_restoreMedia, spath,
+                                           snapshot_ref, None, next_function),
+                         self.loadAborted)
+
+    def loadRestoreError(self, err, info_str):
+        if self.error_function:
+            self.error_function(err, info_str)
+
+    def readSnapshotAt(self, spath, ref):
+        if spath == self.session.path:
+            return self.readSnapshot(ref)
+
+        # session is not loaded, its history is not indexed
+        try:
+            history_file = open("%s/%s/%s" % (spath, self.gitdir,
+                                              self.history_path), 'r')
+        except:
+            return None
+
+        snapshot = None
+
+        with history_file:
+            for line in history_file:
+                try:
+                    line_snapshot = json.loads(line)
+                except ValueError:
+                    continue
+
+                if (isinstance(line_snapshot, dict)
+                        and line_snapshot.get('ref') == ref):
+                    snapshot = line_snapshot
+                    break
+
+        return snapshot
+
+    def load_restoreMedia(self, spath, snapshot_ref, rel_paths,
+                          next_function):
+        # git doesn't restore files excluded from git,
+        # restore them from media store if snapshot has some.
+        snapshot = self.readSnapshotAt(spath, snapshot_ref)
+        media = snapshot.get('media') if snapshot is not None else None
+
+        # stored media files not in snapshot are removed,
+        # only if snapshot has been taken with media store.
+        remove_scope = None
+        if isinstance(media, dict):
+            remove_scope = rel_paths if rel_paths is not None else ['']
+        else:
+            media = {}
+
+        if rel_paths is not None:
+            media = dict([(media_path, infos)
+                          for media_path, infos in media.items()
+                          for rel_path in rel_paths
+                          if (media_path == rel_path
+                              or media_path.startswith(rel_path + '/'))])
+
+        self.media_store.restore(
+            spath, "%s/%s" % (spath, self.gitdir), media,
+            functools.partial(self.load_restoreMediaDone, next_function),
+            remove_scope)
+
+    def load_restoreMediaDone(self, next_function, result):
+        if self._aborted:
+            self.loadAborted()
+            return
+
+        next_function()
+
+    def getRefTime(self, ref):
+        # refs are UTC dates written by getTagDate()
+        try:
+            return calendar.timegm(time.strptime(ref, '%Y_%m_%d_%H_%M_%S'))
+        except ValueError:
+            return None
+
+    def getKeptRefs(self):
+        # returns refs of snapshots to keep with retention policy:
+        # all recent snapshots, then one per hour, one per day,
+        # one per week. Named snapshots are always kept.
+        keep_all = 3600 * RS.settings.value(
+            'daemon/snapshots_keep_all_hours', 48, type=int)
+        keep_hourly = 86400 * RS.settings.value(
+            'daemon/snapshots_keep_hourly_days', 7, type=int)
+        keep_daily = 7 * 86400 * RS.settings.value(
+            'daemon/snapshots_keep_daily_weeks', 8, type=int)
+        # 0 means weekly snapshots are kept forever
+        keep_weekly = 7 * 86400 * RS.settings.value(
+            'daemon/snapshots_keep_weekly_weeks', 0, type=int)
+
+        now = time.time()
+        kept_refs = set()
+        buckets = set()
+
+        for ref, name, rw_sn, session_name in reversed(self._history):
+            ref_time = self.getRefTime(ref)
+            if ref_time is None or (name and not '\n' in name):
+                kept_refs.add(ref)
+                continue
+
+            age = now - ref_time
+
+            if age < keep_all:
+                kept_refs.add(ref)
+                continue
+
+            if age < keep_hourly:
+                bucket = ('h', int(ref_time // 3600))
+            elif age < keep_daily:
+                bucket = ('d', int(ref_time // 86400))
+            elif not keep_weekly or age < keep_weekly:
+                bucket = ('w', int(ref_time // (7 * 86400)))
+            else:
+                continue
+
+            # keep the last snapshot of each period
+            if not bucket in buckets:
+                buckets.add(bucket)
+                kept_refs.add(ref)
+
+        return kept_refs
+
+    def clean(self, next_function, error_function):
+        # remove snapshots not kept by retention policy,
+        # rewrite the commits chain of kept snapshots,
+        # then let git remove unreachable objects.
         self.error_function = error_function
+        self.next_function = next_function
+        self._clean_dropped = []
 
-        SNS_xml = self.getHistoryXmlDocumentElement()
-        if not SNS_xml:
-            self.error_function(ray.Err.NO_SUCH_FILE,
-                                self.getHistoryFullPath())
-            return False
+        self.updateHistoryIndex()
+        if not self._history:
+            next_function(0)
+            return
 
-        nodes = SNS_xml.childNodes()
+        kept_refs = self.getKeptRefs()
 
-        client_path_list = []
+        self._clean_kept = []
+        for ref, name, rw_sn, session_name in self._history:
+            if ref in kept_refs:
+                if not ref in self._clean_kept:
+                    self._clean_kept.append(ref)
+            elif not ref in self._clean_dropped:
+                self._clean_dropped.append(ref)
 
-        for i in range(nodes.count()):
-            node = nodes.at(i)
-            el = node.toElement()
+        if not self._clean_dropped:
+            next_function(0)
+            return
+
+        self.runGitSteps(
+            self.session.path,
+            [('for-each-ref',
+              '--format=%(refname) %(objectname) %(*objectname)',
+              'refs/tags', 'refs/heads'),
+             self.clean_step_1],
+            self.clean_step_5, self.cleanAborted)
+
+    def cleanAborted(self):
+        if self.error_function:
+            self.error_function(ray.Err.ABORT_ORDERED, 'snapshots cleaning')
+
+    def clean_step_1(self):
+        self._clean_commits = {}
+        self._clean_heads = {}
+
+        for line in self.git_output.decode().splitlines():
+            refname, space, objects = line.partition(' ')
+            object_name, space, peeled_name = objects.partition(' ')
+            commit = peeled_name if peeled_name else object_name
+
+            if refname.startswith('refs/tags/'):
+                self._clean_commits[refname[10:]] = commit
+            elif refname.startswith('refs/heads/'):
+                self._clean_heads[refname] = commit
+
+        # snapshots without tag can't be kept
+        self._clean_kept = [ref for ref in self._clean_kept
+                            if ref in self._clean_commits]
+
+        commits = [self._clean_commits[ref] for ref in self._clean_kept]
+        commits += list(self._clean_heads.values())
+
+        self.insertGitSteps([('rev-parse', 'HEAD',
+                              '--symbolic-full-name', 'HEAD'),
+                             self.clean_step_2,
+                             ('show', '-s', '--format=%H %T %at %ct',
+                              *set(commits)),
+                             self.clean_step_3])
+        return ray.Err.OK
+
+    def clean_step_2(self):
+        lines = self.git_output.decode().splitlines()
+        self._clean_head = lines[0] if lines else ''
+        # 'HEAD' if HEAD is detached, else its branch
+        self._clean_head_ref = lines[1] if len(lines) > 1 else 'HEAD'
+        return ray.Err.OK
 
-            if el.attribute('ref') != snapshot:
+    def clean_step_3(self):
+        commit_infos = {}
+        for line in self.git_output.decode().splitlines():
+            infos = line.split(' ')
+            if len(infos) == 4:
+                commit_infos[infos[0]] = infos[1:]
+
+        # new commit -> old commit
+        self._clean_new_commits = {}
+        self._clean_parent = ''
+
+        steps = []
+        kept_commits = set()
+
+        for ref in self._clean_kept:
+            commit = self._clean_commits[ref]
+            if not commit in commit_infos or commit in kept_commits:
+                # commit of many refs is rewritten once,
+                # clean_step_4 moves all its refs.
                 continue
 
-            client_nodes = node.childNodes()
+            kept_commits.add(commit)
+            steps += [self.getCommitTreeStep(commit_infos[commit]),
+                      functools.partial(self.clean_step_4, commit)]
 
-            for j in range(client_nodes.count()):
-                client_node = client_nodes.at(j)
-                client_el = client_node.toElement()
+        # branch heads or HEAD without kept snapshot are rewritten on top
+        for commit in (list(self._clean_heads.values())
+                       + [self._clean_head]):
+            if (commit in commit_infos
+                    and not commit in kept_commits
+                    and not commit in self._clean_new_commits):
+                # prevent to rewrite twice the same commit
+                self._clean_new_commits[commit] = ''
+                steps += [self.getCommitTreeStep(commit_infos[commit]),
+                          functools.partial(self.clean_step_4, commit)]
+
+        steps.append(self.clean_finish)
+
+        self.insertGitSteps(steps)
+        return ray.Err.OK
+
+    def getCommitTreeStep(self, commit_info):
+        tree, author_date, commit_date = commit_info
+        env = {'GIT_AUTHOR_DATE': '%s +0000' % author_date,
+               'GIT_COMMITTER_DATE': '%s +0000' % commit_date}
+
+        # parent is read when the step is run
+        return functools.partial(self.clean_commitTree, env, tree)
+
+    def clean_commitTree(self, env, tree):
+        if self._clean_parent:
+            self.insertGitSteps([(env, 'commit-tree', tree,
+                                  '-p', self._clean_parent, '-m', 'ray')])
+        else:
+            self.insertGitSteps([(env, 'commit-tree', tree, '-m', 'ray')])
+        return ray.Err.OK
 
-                if client_el.attribute('client_id') != client_id:
+    def clean_step_4(self, old_commit):
+        new_commit = self.git_output.decode().strip()
+        if not new_commit:
+            return ray.Err.SUBPROCESS_EXITCODE
+
+        self._clean_new_commits[old_commit] = new_commit
+        self._clean_parent = new_commit
+
+        steps = []
+
+        if old_commit == self._clean_head and self._clean_head_ref == 'HEAD':
+            # detached HEAD, else HEAD follows its branch
+            steps.append(('update-ref', '--no-deref', 'HEAD', new_commit))
+
+        for refname, commit in self._clean_heads.items():
+            if commit == old_commit:
+                steps.append(('update-ref', refname, new_commit))
+
+        for ref in self._clean_kept:
+            if self._clean_commits[ref] == old_commit:
+                steps.append(('tag', '-f', '-a', ref, new_commit, '-m', 'ray'))
+
+        self.insertGitSteps(steps)
+        return ray.Err.OK
+
+    def clean_finish(self):
+        # all kept commits are rewritten, remove dropped snapshots.
+        # history is rewritten first, an abort or a failure
+        # must not leave it listing snapshots without tag.
+        steps = [self.clean_rewriteHistory]
+
+        dropped_tags = [ref for ref in self._clean_dropped
+                        if ref in self._clean_commits]
+        for i in range(0, len(dropped_tags), 200):
+            steps.append(('tag', '-d', *dropped_tags[i:i+200]))
+
+        steps += [self.clean_pruneMedia,
+                  ('reflog', 'expire', '--expire=now', '--all'),
+                  ('gc', '--prune=now', '--quiet')]
+
+        self.insertGitSteps(steps)
+        return ray.Err.OK
+
+    def clean_rewriteHistory(self):
+        dropped = set(self._clean_dropped)
+        lines = []
+
+        try:
+            history_file = open(self.getHistoryFullPath(), 'r')
+            for line in history_file:
+                try:
+                    snapshot = json.loads(line)
+                except ValueError:
                     continue
 
-                file_nodes = client_node.childNodes()
+                if (isinstance(snapshot, dict)
+                        and not snapshot.get('ref') in dropped):
+                    lines.append(line if line.endswith('\n')
+                                 else line + '\n')
+            history_file.close()
 
-                for k in range(file_nodes.count()):
-                    file_node = file_nodes.at(k)
-                    file_el = file_node.toElement()
-                    file_path = file_el.attribute('path')
-                    if file_path:
-                        client_path_list.append(file_path)
+            tmp_path = self.getHistoryFullPath() + '.tmp'
+            history_file = open(tmp_path, 'w')
+            history_file.write(''.join(lines))
+            history_file.close()
+            os.rename(tmp_path, self.getHistoryFullPath())
+        except:
+            return ray.Err.CREATE_FAILED
 
-        if not self.runGitProcess('reset', '--hard'):
-            return False
+        self.clearHistoryIndex()
+        return ray.Err.OK
 
-        if not self.runGitProcess('checkout', snapshot, '--',
-                                  *client_path_list):
-            return False
-        return True
+    def clean_pruneMedia(self):
+        # remove media files not referenced anymore by snapshots
+        kept_keys = set()
+
+        try:
+            history_file = open(self.getHistoryFullPath(), 'r')
+        except:
+            return ray.Err.OK
+
+        with history_file:
+            for line in history_file:
+                try:
+                    snapshot = json.loads(line)
+                except ValueError:
+                    continue
+
+                if not isinstance(snapshot, dict):
+                    continue
+
+                media = snapshot.get('media')
+                if not isinstance(media, dict):
+                    continue
+
+                for infos in media.values():
+                    if isinstance(infos, list) and infos:
+                        kept_keys.add(infos[0])
+
+        self.media_store.prune(self.getGitDir(), kept_keys)
+        return ray.Err.OK
+
+    def clean_step_5(self):
+        n_dropped = len(self._clean_dropped)
+        self._clean_dropped = []
+        self.error_function = None
+
+        if self.next_function:
+            self.next_function(n_dropped)
 
     def abort(self):
-        if not self.adder_process.state():
+        if not self.isRunning():
             return
 
-        self.setAutoSnapshot(False)
+        if self._is_saving:
+            self.setAutoSnapshot(False)
+
+        self._aborted = True
+
+        if self.changes_checker.state():
+            self.changes_checker.kill()
+
+        if self.git_process.state():
+            self.git_process.terminate()
 
-        self._adder_aborted = True
-        self.adder_process.terminate()
+        self.media_store.abort()
+        self.restorer.abort()
 
     def setAutoSnapshot(self, bool_snapshot):
         auto_snap_file = "%s/%s/prevent_auto_snapshot" % (self.session.path,
@@ -681,6 +681,15 @@ class AbortSessionDialog(ChildDialog):
             self.reject()
 
 
+def copySpeedText(speed, eta):
+    if eta < 0:
+        return _translate('abort_copy', "%.1f MB/s") % speed
+
+    minutes, seconds = divmod(int(eta), 60)
+    return _translate('abort_copy', "%.1f MB/s, %i:%02i remaining") % (
+        speed, minutes, seconds)
+
+
 class AbortServerCopyDialog(ChildDialog):
     def __init__(self, parent):
         ChildDialog.__init__(self, parent)
@@ -688,6 +697,7 @@ class AbortServerCopyDialog(ChildDialog):
         self.ui.setupUi(self)
 
         self._signaler.server_progress.connect(self.setProgress)
+        self._signaler.copy_speed.connect(self.setSpeed)
 
         self.serverStatusChanged(self._session.server_status)
 
@@ -700,6 +710,12 @@ class AbortServerCopyDialog(ChildDialog):
     def setProgress(self, progress):
         self.ui.progressBar.setValue(progress * 100)
 
+    def setSpeed(self, client_id, speed, eta):
+        if client_id:
+            return
+
+        self.ui.labelSpeed.setText(copySpeedText(speed, eta))
+
 
 class AbortClientCopyDialog(ChildDialog):
     def __init__(self, parent, client_id):
@@ -710,6 +726,7 @@ class AbortClientCopyDialog(ChildDialog):
         self.client_id = client_id
 
         self._signaler.client_progress.connect(self.setProgress)
+        self._signaler.copy_speed.connect(self.setSpeed)
 
     def setProgress(self, client_id, progress):
         if client_id != self.client_id:
@@ -717,6 +734,12 @@ class AbortClientCopyDialog(ChildDialog):
 
         self.ui.progressBar.setValue(progress * 100)
 
+    def setSpeed(self, client_id, speed, eta):
+        if client_id != self.client_id:
+            return
+
+        self.ui.labelSpeed.setText(copySpeedText(speed, eta))
+
     def serverStatusChanged(self, server_status):
         if not self.server_copying:
             self.reject()
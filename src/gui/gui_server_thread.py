@@ -32,6 +32,10 @@ class GUIServerThread(liblo.ServerThread):
     def __init__(self):
         liblo.ServerThread.__init__(self)
 
+        # reply_path -> [next sequence number, number of chunks,
+        #                {seq: items} of chunks waiting previous ones]
+        self._reply_chunks = {}
+
         global _instance
         _instance = self
 
@@ -62,7 +66,42 @@ class GUIServerThread(liblo.ServerThread):
 
         new_args = args.copy()
         reply_path = new_args.pop(0)
+        self.emitReplyItems(reply_path, new_args)
+
+    @ray_method('/reply_chunk', None)
+    def _reply_chunk(self, path, args, types, src_addr):
+        if not (len(args) >= 2 and isinstance(args[0], str)
+                and isinstance(args[1], int)
+                and ray.areTheyAllString(args[2:])):
+            return False
+
+        reply_path, seq = args[:2]
+        items = args[2:]
+
+        if seq == 0 and items:
+            # a new list begins
+            self._reply_chunks[reply_path] = [0, -1, {}]
+
+        chunks = self._reply_chunks.get(reply_path)
+        if chunks is None:
+            chunks = [0, -1, {}]
+            self._reply_chunks[reply_path] = chunks
 
+        if items:
+            chunks[2][seq] = items
+        else:
+            # end of list, seq is the number of chunks
+            chunks[1] = seq
+
+        # emit chunks in their order, even if received in disorder
+        while chunks[0] in chunks[2]:
+            self.emitReplyItems(reply_path, chunks[2].pop(chunks[0]))
+            chunks[0] += 1
+
+        if 0 <= chunks[1] <= chunks[0]:
+            del self._reply_chunks[reply_path]
+
+    def emitReplyItems(self, reply_path, new_args):
         if reply_path == '/ray/server/list_sessions':
             self._signaler.add_sessions_to_list.emit(new_args)
         elif reply_path == '/ray/server/list_path':
@@ -120,6 +159,12 @@ class GUIServerThread(liblo.ServerThread):
         progress = args[0]
         self._signaler.server_progress.emit(progress)
 
+    @ray_method('/ray/gui/server/progress', 'fff')
+    def _server_progress_speed(self, path, args, types, src_addr):
+        progress, speed, eta = args
+        self._signaler.server_progress.emit(progress)
+        self._signaler.copy_speed.emit('', speed, eta)
+
     @ray_method('/ray/gui/server/message', 's')
     def _server_message(self, path, args, types, src_addr):
         pass
@@ -177,6 +222,11 @@ class GUIServerThread(liblo.ServerThread):
     def _client_progress(self, path, args, types, src_addr):
         pass
 
+    @ray_method('/ray/gui/client/progress', 'sfff')
+    def _client_progress_speed(self, path, args, types, src_addr):
+        client_id, progress, speed, eta = args
+        self._signaler.copy_speed.emit(client_id, speed, eta)
+
     @ray_method('/ray/gui/client/dirty', 'si')
     def _client_dirty(self, path, args, types, src_addr):
         pass
@@ -286,12 +286,14 @@ class SignaledSession(Session):
         self._main_win.clientStatusChanged(client_id, status)
 
     def _ray_gui_client_progress(self, path, args):
-        client_id, progress = args
+        client_id, progress, *rest = args
 
         client = self.getClient(client_id)
         if client:
             client.setProgress(progress)
 
+        self._signaler.client_progress.emit(client_id, progress)
+
     def _ray_gui_client_dirty(self, path, args):
         client_id, int_dirty = args
         client = self.getClient(client_id)
@@ -595,6 +595,7 @@ class MainWindow(QMainWindow):
                 ray.ServerStatus.COPY,
                 ray.ServerStatus.SNAPSHOT,
                 ray.ServerStatus.OUT_SNAPSHOT,
+                ray.ServerStatus.REWIND,
                 ray.ServerStatus.WAIT_USER):
             return
 
@@ -611,7 +612,8 @@ class MainWindow(QMainWindow):
             self.toDaemon('/ray/server/abort_copy')
 
         elif status in (ray.ServerStatus.SNAPSHOT,
-                        ray.ServerStatus.OUT_SNAPSHOT):
+                        ray.ServerStatus.OUT_SNAPSHOT,
+                        ray.ServerStatus.REWIND):
             self.showSnapshotProgressDialog()
 
         elif status == ray.ServerStatus.WAIT_USER:
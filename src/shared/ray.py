@@ -96,6 +96,7 @@ class Option:
     HAS_GIT = 0x020
     SNAPSHOTS = 0x040
     SESSION_SCRIPTS = 0x080
+    HARDLINK_MEDIA = 0x100
 
 class Err:
     OK = 0